@@ -15,6 +15,10 @@ Simplest function call is diffusion1D(length, diffusivity, time)
     Step 2. Pass these parameters into diffusion1D_params(params)
     Step 3. Plot with plot_diffusion1D
 With profiles in styles, use profile.plot_diffusion() and fitD()
+For heating and cooling ramps and changing surface concentrations, use
+the Crank-Nicolson diffusion1D_history_kernel, or forward_model='history'
+in fitD. For concentration-dependent diffusivity, use diffusion1D_DC_kernel
+or diffusion1D_DC_params, or forward_model='DC' in fitD.
 
 ### 3-dimensional diffusion without path integration: 3Dnpi ###
 Simplest: diffusion3Dnpi(lengths, D's, time) to get a figure
@@ -27,72 +31,185 @@ Simplest: diffusion3Dnpi(lengths, D's, time) to get a figure
     Step 1. Create parameters with params = params_setup3D 
             Same as for non-path integrated 3D.
     Step 2. Pass parameters into diffusion3Dwb(params)
+For cases that are not separable (concentration-dependent D, reactions),
+diffusion3Dadi_kernel and diffusion3Dadi_params use an alternating 
+direction implicit finite-difference model instead.
 
 ### pynams module Profile and WholeBlock classes have bound functions to 
 plot and fit diffusivities using these functions: plot_diffusion,
 fitDiffusivity, and fitD
 
+### Uncertainties ###
+fit_diffusion1D_ensemble and fit_diffusion3D_ensemble refit Monte Carlo
+copies of the data with errors in positions, lengths, and areas.
+sample_diffusion3D draws posterior distributions of whole-block 
+diffusivities with an affine-invariant ensemble MCMC sampler.
+
 ### Arrhenius diagrams ###
 class Diffusivities() groups together temperatures and diffusivities
 for use in plotting directly onto Arrhenius diagrams
+fit_arrhenius3D and Diffusivities.fit_Ea_D0_wholeblocks fit Ea and D0
+straight to whole-block profiles from experiments at many temperatures.
 
 
 """
 import lmfit
 import numpy as np
 import scipy
+import scipy.linalg
+import scipy.optimize
+import scipy.sparse
 import matplotlib.pyplot as plt
 import matplotlib.lines as mlines
 from mpl_toolkits.axes_grid1.parasite_axes import SubplotHost
 import styles
 from uncertainties import ufloat
 import sys
+import os
+import warnings
+import zipfile
+import multiprocessing
 
 GAS_CONSTANT = 0.00831 # kJ/mol K
 
 #%% 1D Diffusion in a thin slab; Eq 4.18 in Crank, 1975
-def diffusionThinSlab(log10D_m2s, thickness_microns, max_time_hours=2000, 
-                      infinity=200, timesteps=300):
+def diffusionThinSlab(log10D_m2s, thickness_microns, max_time_hours=2000,
+                      infinity=200, timesteps=300, tolerance=1e-6,
+                      max_elements=4e6):
     """ Takes log10 of the diffusivity D in m2/s, thickness in microns,
-    and maximum time in hours, and returns time array in hours and corresponding 
-    curve of C/C0, the concentration divided by the initial concentration
+    and maximum time in hours, and returns time array in hours and corresponding
+    curve of C/C0, the concentration divided by the initial concentration.
+
+    log10D_m2s and thickness_microns can each be a single value or a list
+    or array. The whole time x term x D x thickness sum is evaluated at
+    once, and the returned curves have shape (D, thickness, time) with the
+    D and/or thickness axis dropped if that input was a single value, so
+    one D and one thickness still returns a single curve.
+
+    The series is cut off after the smallest number of terms that keeps
+    the truncation error below tolerance at every time > 0, but never
+    more than infinity terms. Set tolerance=None to always use infinity
+    terms. max_elements limits the size of the temporary arrays.
     """
     t_hours = np.linspace(0., max_time_hours, timesteps)
     t_seconds = t_hours * 3600.
-    L_meters = thickness_microns / 2.E6
-    cc = np.zeros_like(t_seconds)
-    D_m2s = 10.**log10D_m2s
-
-    for idx in range(len(t_seconds)):
-        infsum = 0.
-        for n in range(infinity):
-            exponent_top = D_m2s * (((2.*n)+1.)**2.) * (np.pi**2.) * t_seconds[idx] 
-            exponent_bot = 4. * (L_meters**2)
-            exponent = np.exp(-1. * exponent_top / exponent_bot)
-            addme = 8. * (1. / ((((2.*n)+1)**2.) * (np.pi**2.))) * exponent
-            infsum = infsum + addme
-        cc[idx] = infsum
-    
+    D_m2s = 10.**np.atleast_1d(np.array(log10D_m2s, dtype=float))
+    L_meters = np.atleast_1d(np.array(thickness_microns, dtype=float)) / 2.E6
+
+    # Each term n goes as exp(-(2n+1)^2 * kt) with kt = D pi^2 t / 4L^2
+    k = D_m2s[:, None] * (np.pi**2.) / (4. * (L_meters[None, :]**2))
+    kt = k[:, :, None] * t_seconds[None, None, :]
+
+    if tolerance is None or not np.any(kt > 0.):
+        nterms = infinity
+    else:
+        # Bound on the sum of all terms from N onward for the slowest curve
+        kt_min = np.min(kt[kt > 0.])
+        N = np.arange(1, infinity + 1)
+        tail = ((8. / (np.pi**2.)) * np.exp(-((2.*N)+1.)**2. * kt_min) /
+                (2. * ((2.*N)-1.)))
+        converged = np.nonzero(tail <= tolerance)[0]
+        if len(converged) > 0:
+            nterms = N[converged[0]]
+        else:
+            nterms = infinity
+
+    cc = np.zeros_like(kt)
+    chunk = max(1, int(max_elements // kt.size))
+    for start in range(0, nterms, chunk):
+        n = np.arange(start, min(start + chunk, nterms))
+        odd2 = ((2.*n) + 1.)**2.
+        addme = (8. / (odd2 * (np.pi**2.))) * np.exp(-odd2 * kt[..., None])
+        cc = cc + addme.sum(axis=-1)
+
+    # The sum converges to exactly 1 at t=0 but only very slowly
+    cc[..., t_seconds == 0.] = 1.
+
+    if np.ndim(thickness_microns) == 0:
+        cc = cc[:, 0]
+    if np.ndim(log10D_m2s) == 0:
+        cc = cc[0]
     return t_hours, cc
-    
+
+
+#%% Automatic grids for model profiles
+#
+# With points='auto', the model grids are made for the diffusivity at hand
+# instead of always having the same number of evenly spaced points. The 
+# nodes are spread so that linear interpolation between them is off by 
+# about grid_tolerance at most, which puts them close together near the 
+# rims where the erf profile bends over a distance of sqrt(Dt) and far 
+# apart in the flat middle. The grid is remade every time the model is 
+# calculated, so it keeps up with D as a fit moves it around.
+#
+def auto_grid(microns, log10D_m2s, time_seconds, tolerance=1e-4, 
+              min_points=11, max_points=2001):
+    """Returns node positions in microns, centered on 0 and symmetric 
+    about the middle, for a 1D erf profile across length microns.
+    The spacing keeps the error of linear interpolation between nodes 
+    to about tolerance (in unit concentration) by following the curvature
+    of the profile. Always an odd number of nodes between min_points and 
+    max_points, including both edges and the center."""
+    a = microns / 2.
+    sqrtDt = (10.**log10D_m2s * time_seconds)**0.5 * 1e6
+    min_half = max(int(min_points) // 2, 1)
+    max_half = max(int(max_points) // 2, min_half)
+    if not sqrtDt > 0.:
+        return np.linspace(-a, a, 2*min_half + 1)
+
+    # distance from the rim, with extra resolution within a few sqrt(Dt)
+    d = np.unique(np.concatenate((np.linspace(0., a, 2001),
+                                  np.linspace(0., min(a, 10.*sqrtDt), 2001))))
+    u_near = d / (2. * sqrtDt)
+    u_far = (2.*a - d) / (2. * sqrtDt)
+    curvature = np.abs(u_near * np.exp(-u_near**2) + 
+                       u_far * np.exp(-u_far**2)) / (np.pi**0.5 * sqrtDt**2)
+
+    # local spacing where the interpolation error h**2 f'' / 8 = tolerance
+    density = np.maximum((curvature / (8. * tolerance))**0.5, min_half / a)
+    cumulative = np.concatenate(([0.], np.cumsum(np.diff(d) * 
+                                 (density[1:] + density[:-1]) / 2.)))
+    nhalf = int(np.clip(np.ceil(cumulative[-1]), min_half, max_half))
+    d_nodes = np.interp(np.linspace(0., cumulative[-1], nhalf + 1), 
+                        cumulative, d)
+    d_nodes[0] = 0.
+    d_nodes[-1] = a
+    half = a - d_nodes
+    return np.concatenate((-half, half[-2::-1])) + 0.
+
+def trapezoid_weights(x):
+    """Returns weights that give the trapezoid rule average of values at
+    the (possibly uneven) positions x"""
+    x = np.array(x, dtype=float)
+    widths = np.diff(x)
+    weights = np.zeros(len(x))
+    weights[:-1] = weights[:-1] + widths / 2.
+    weights[1:] = weights[1:] + widths / 2.
+    return weights / np.sum(weights)
 
 #%% 1D diffusion profiles
 def params_setup1D(microns, log10D_m2s, time_seconds, init=1., fin=0.,
-                   vD=True, vinit=False, vfin=False):
+                   vD=True, vinit=False, vfin=False, log10D_slope=None,
+                   vslope=True):
     """Takes required info for diffusion in 1D - length, diffusivity, time,
     and whether or not to vary them - vD, vinit, vfin. 
-    Return appropriate lmfit params to pass into diffusion1D_params"""
+    Return appropriate lmfit params to pass into diffusion1D_params.
+    Set log10D_slope to add the concentration dependence used by
+    diffusion1D_DC_params."""
     params = lmfit.Parameters()
     params.add('microns', microns, False, None, None, None)
     params.add('log10D_m2s', log10D_m2s, vD, None, None, None)
     params.add('time_seconds', time_seconds, False, None, None, None)
     params.add('initial_unit_value', init, vinit, None, None, None)
     params.add('final_unit_value', fin, vfin, None, None, None)
+    if log10D_slope is not None:
+        params.add('log10D_slope', log10D_slope, vslope, None, None, None)
     return params
 
 def diffusion1D_params(params, data_x_microns=None, data_y_unit_areas=None, 
                  erf_or_sum='erf', need_to_center_x_data=True,
-                 infinity=100, points=50):
+                 infinity=100, points=50, tolerance=1e-8, 
+                 grid_tolerance=1e-4):
     """Function set up to follow lmfit fitting requirements.
     Requires input as lmfit parameters value dictionary 
     passing in key information as 'length_microns',
@@ -102,11 +219,18 @@ def diffusion1D_params(params, data_x_microns=None, data_y_unit_areas=None,
     x_microns and y as vectors of length points (default 50). 
 
     Optional keywords:    
-     - erf_or_sum: whether to use python's error functions (default) 
-       or infinite sums
+     - erf_or_sum: whether to use python's error functions (default),
+       infinite sums ('infsum'), or the MasterCurve table ('master'),
+       which only applies to the model grid, not to data positions. 
+       The first 'master' call for a number of points makes the table 
+       and saves it as an .npz file in ~/.pynams.
      - whether to center x data
      - points sets how many points to calculate in profile. Default is 50.
-     - what 'infinity' is if using infinite sum approximation
+       points='auto' makes an uneven grid for the current D with 
+       auto_grid instead, good to about grid_tolerance
+     - what 'infinity' is if using infinite sum approximation, which
+       stops sooner once the truncation error is below tolerance. If it 
+       is not enough, there is a warning (once).
      
     If not including data, returns the x vector and model y values.
     With data, return the residual for use in fitting.
@@ -115,11 +239,54 @@ def diffusion1D_params(params, data_x_microns=None, data_y_unit_areas=None,
     """
     # extract important values from parameter dictionary passed in
     p = params.valuesdict()
-    L_meters = p['microns'] / 1e6
-    t = p['time_seconds']
-    D = 10.**p['log10D_m2s']
-    initial_value = p['initial_unit_value']
-    final_value = p['final_unit_value']
+
+    # Fitting to data or not? Default is not
+    fitting = False
+    if (data_x_microns is not None) and (data_y_unit_areas is not None):
+        if len(data_x_microns) == len(data_y_unit_areas):
+            fitting = True
+        else:
+            print 'x and y data must be the same length'
+            print 'x', len(data_x_microns)
+            print 'y', len(data_y_unit_areas)
+        
+    # x is assumed centered around 0
+    x_microns = None
+    if fitting is True:
+        x_microns = np.array(data_x_microns, dtype=float)
+        if need_to_center_x_data is True:
+            x_microns = x_microns - p['microns'] / 2.
+
+    profile = diffusion1D_kernel(p['microns'], p['log10D_m2s'], 
+                                 p['time_seconds'], p['initial_unit_value'],
+                                 p['final_unit_value'], x_microns, 
+                                 erf_or_sum, points, infinity, tolerance,
+                                 grid_tolerance)
+    if profile is None or profile is False:
+        return profile
+    x_microns, model = profile
+
+    # If not including data, just return the model values
+    # With data, return the residual for use in fitting.
+    if fitting is False:
+        return x_microns, model
+    return model-data_y_unit_areas
+
+def diffusion1D_kernel(microns, log10D_m2s, time_seconds, init=1., fin=0.,
+                       x_microns=None, erf_or_sum='erf', points=50,
+                       infinity=100, tolerance=1e-8, grid_tolerance=1e-4):
+    """The calculation behind diffusion1D_params using plain numbers
+    instead of lmfit parameters: length, log10D, time, and initial and 
+    final unit values. Positions x_microns are centered on 0, and the 
+    default is points evenly spaced positions from edge to edge, or the 
+    nodes of auto_grid if points='auto'. 
+    Returns x_microns and the 1D diffusion profile.
+    """
+    L_meters = microns / 1e6
+    t = time_seconds
+    D = 10.**log10D_m2s
+    initial_value = init
+    final_value = fin
 
     if initial_value > final_value:
         going_out = True
@@ -131,59 +298,45 @@ def diffusion1D_params(params, data_x_microns=None, data_y_unit_areas=None,
         minimum_value = initial_value
     
     a_meters = L_meters / 2.
-    twoA = L_meters
 
     if t < 0:
         print 'no negative time'
         return           
 
-    # Fitting to data or not? Default is not
-    fitting = False
-    if (data_x_microns is not None) and (data_y_unit_areas is not None):
-        if len(data_x_microns) == len(data_y_unit_areas):
-            fitting = True
-        else:
-            print 'x and y data must be the same length'
-            print 'x', len(data_x_microns)
-            print 'y', len(data_y_unit_areas)
-        
     # x is in meters and assumed centered around 0
-    if fitting is True:
-        # Change x to meters and center it
-        x = np.array(data_x_microns) / 1e6
-        if need_to_center_x_data is True:
-            x = x - a_meters
+    if x_microns is not None:
+        x = np.array(x_microns, dtype=float) / 1e6
+    elif points == 'auto':
+        x = auto_grid(microns, log10D_m2s, t, grid_tolerance) / 1e6
     else:
         x = np.linspace(-a_meters, a_meters, points)
     
     if erf_or_sum == 'infsum':
-        xsum = np.zeros_like(x)
-        for n in range(infinity):
-           # positive number that converges to 1
-            xadd1 = ((-1.)**n) / ((2.*n)+1.)        
-            # time conponent
-            xadd2 = np.exp(
-                            (-D * (((2.*n)+1.)**2.) * (np.pi**2.) * t) / 
-                            (twoA**2.) 
-                            )                        
-            # There the position values come in to create the profile
-            xadd3 = np.cos(
-                            ((2.*n)+1.) * np.pi * x / twoA
-                            )        
-            xadd = xadd1 * xadd2 * xadd3
-            xsum = xsum + xadd
-            
-        model = xsum * 4. / np.pi
-    
+        model, error = infsum_unit_profile(x, a_meters, D, t, tolerance,
+                                           infinity)
+        if error > tolerance:
+            # same message every time so it only shows up once, not on 
+            # every call during a fit
+            warnings.warn(''.join(('infinite sum truncation error is above ',
+                                   'tolerance after infinity terms; raise ',
+                                   'infinity or tolerance')))
 
     elif erf_or_sum == 'erf':
         sqrtDt = (D*t)**0.5
         model = ((scipy.special.erf((a_meters+x)/(2*sqrtDt))) + 
                    (scipy.special.erf((a_meters-x)/(2*sqrtDt))) - 1) 
 
+    elif erf_or_sum == 'master':
+        # other positions are not on the master curve grid
+        if x_microns is not None or points == 'auto':
+            model = erf_unit_profile(x, a_meters, D, t)
+        else:
+            model = get_master_curve(points).unit_profiles(a_meters, D, t)
+
     else:
         print ('erf_or_sum must be set to either "erf" for python built-in ' +
-               'error function approximation (defaul) or "sum" for infinite ' +
+               'error function approximation (defaul), "master" for the ' +
+               'MasterCurve table, or "sum" for infinite ' +
                'sum approximation with infinity=whatever, defaulting to ' + 
                str(infinity))
         return False
@@ -194,13 +347,297 @@ def diffusion1D_params(params, data_x_microns=None, data_y_unit_areas=None,
     concentration_range = solubility - minimum_value
     model = (model * concentration_range) + minimum_value
 
-    x_microns = x * 1e6
+    return x * 1e6, model
+
+def erf_unit_profile(x_meters, a_meters, D_m2s, time_seconds):
+    """Returns the unit error function diffusion profile used by 
+    diffusion1D_params, 1 in the middle and going to 0 at the edges, at
+    positions x_meters centered on 0 in a slab of half-length a_meters"""
+    sqrtDt = (D_m2s*time_seconds)**0.5
+    return ((scipy.special.erf((a_meters+x_meters)/(2*sqrtDt))) + 
+            (scipy.special.erf((a_meters-x_meters)/(2*sqrtDt))) - 1) 
+
+def erf_unit_mean(a_meters, D_m2s, time_seconds):
+    """Returns the exact average of erf_unit_profile from -a to a, 
+    which is what a ray path through the whole slab sees"""
+    u = a_meters / ((D_m2s*time_seconds)**0.5)
+    return (2.*scipy.special.erf(u) - 1. +
+            2.*(np.exp(-u**2.) - 1.) / (np.pi**0.5 * u))
+
+def infsum_unit_profile(x_meters, a_meters, D_m2s, time_seconds, 
+                        tolerance=1e-8, infinity=100, max_elements=4e6):
+    """Infinite sum version of erf_unit_profile, Eq. 4.17 in Crank, 1975,
+    at positions x_meters centered on 0 in a slab of half-length a_meters.
+
+    Term n goes as exp(-(2n+1)^2 k) with k = D pi^2 t / 4a^2, so the 
+    number of terms is the smallest that keeps the truncation error below 
+    tolerance, which is only a few terms for long times, but never more 
+    than infinity terms. All of the terms are added up at once as a 
+    (terms x positions) array, max_elements at a time.
+
+    Returns the profile and the bound on the truncation error it achieved,
+    which is larger than tolerance if infinity terms were not enough.
+    """
+    x = np.array(x_meters, dtype=float)
+    L = 2. * a_meters
+    k = D_m2s * (np.pi**2.) * time_seconds / (L**2.)
+    
+    # Terms drop faster than a geometric series after term N, so the 
+    # sum of all the terms left out is less than bound[N], which is below
+    # tolerance by the time (2N+1)^2 k > log(4 / pi tolerance)
+    if k > 0.:
+        enough = ((np.log(4. / (np.pi * tolerance)) / k)**0.5 - 1.) / 2.
+        infinity = int(min(infinity, max(np.ceil(enough), 1.)))
+    N = np.arange(1, infinity + 1)
+    odd = (2.*N) + 1.
+    with np.errstate(divide='ignore'):
+        bound = ((4. / np.pi) * np.exp(-odd**2. * k) / 
+                 (odd * (1. - np.exp(-8. * (N + 1.) * k))))
+    converged = np.nonzero(bound <= tolerance)[0]
+    if len(converged) > 0:
+        nterms = N[converged[0]]
+        error = bound[converged[0]]
+    else:
+        nterms = infinity
+        error = bound[-1]
+
+    xsum = np.zeros(np.shape(x))
+    chunk = max(1, int(max_elements // max(x.size, 1)))
+    for start in range(0, nterms, chunk):
+        n = np.arange(start, min(start + chunk, nterms))
+        odd = (2.*n) + 1.
+        terms = ((((-1.)**n) / odd) * np.exp(-odd**2. * k))
+        xsum = xsum + np.tensordot(terms, np.cos(np.multiply.outer(odd, 
+                                                 np.pi * x / L)), axes=1)
+    return xsum * 4. / np.pi, error
+
+def erf_unit_profile_dlog10D(x_meters, a_meters, D_m2s, time_seconds):
+    """Returns the derivative of erf_unit_profile with respect to log10D"""
+    sqrtDt = (D_m2s*time_seconds)**0.5
+    u1 = (a_meters+x_meters)/(2*sqrtDt)
+    u2 = (a_meters-x_meters)/(2*sqrtDt)
+    return -(np.log(10.) / np.pi**0.5) * (u1*np.exp(-u1**2.) +
+                                          u2*np.exp(-u2**2.))
+
+def erf_unit_mean_dlog10D(a_meters, D_m2s, time_seconds):
+    """Returns the derivative of erf_unit_mean with respect to log10D"""
+    u = a_meters / ((D_m2s*time_seconds)**0.5)
+    return -(np.log(10.) / np.pi**0.5) * (1. - np.exp(-u**2.)) / u
+
+def jacobian_rows(params, derivatives):
+    """Takes lmfit parameters and a dictionary of the derivatives of the
+    residuals with respect to parameter names and returns them as the 2D
+    array that lmfit.minimize expects from Dfun with col_deriv=1: one row
+    per varied parameter in the order lmfit uses.
+
+    A parameter tied to a varied parameter with an expression such as
+    'log10Dx' or 'log10Dx - 1.' (see params_setup3D) adds its derivative
+    to that parameter's row. Parameters missing from derivatives get
+    a row of zeros.
+    """
+    ndata = len(derivatives.values()[0])
+    rows = []
+    for name, par in params.items():
+        if par.vary is False or par.expr is not None:
+            continue
+        row = np.zeros(ndata)
+        if name in derivatives:
+            row = row + derivatives[name]
+        for tied_name, tied in params.items():
+            if (tied.expr is not None and tied_name in derivatives and
+                name in tied.expr):
+                row = row + derivatives[tied_name]
+        rows.append(row)
+    return np.array(rows)
+
+def diffusion1D_jacobian(params, data_x_microns=None, data_y_unit_areas=None,
+                         erf_or_sum='erf', need_to_center_x_data=True,
+                         infinity=100, points=50, tolerance=1e-8):
+    """Analytic derivatives of the residuals from diffusion1D_params with
+    the erf model. Takes the same arguments so it can be passed to
+    lmfit.minimize with Dfun=diffusion1D_jacobian, col_deriv=1, which saves
+    the extra model evaluations leastsq otherwise uses to estimate them."""
+    p = params.valuesdict()
+    a_meters = p['microns'] / 2e6
+    t = p['time_seconds']
+    D = 10.**p['log10D_m2s']
+    init = p['initial_unit_value']
+    fin = p['final_unit_value']
 
-    # If not including data, just return the model values
-    # With data, return the residual for use in fitting.
-    if fitting is False:
-        return x_microns, model
-    return model-data_y_unit_areas
+    x = np.array(data_x_microns) / 1e6
+    if need_to_center_x_data is True:
+        x = x - a_meters
+
+    # model = fin + E * (init - fin) going in or out
+    E = erf_unit_profile(x, a_meters, D, t)
+    dE = (init - fin) * erf_unit_profile_dlog10D(x, a_meters, D, t)
+    derivatives = {'log10D_m2s' : dE,
+                   'time_seconds' : dE / (t * np.log(10.)),
+                   'initial_unit_value' : E,
+                   'final_unit_value' : 1. - E}
+    return jacobian_rows(params, derivatives)
+
+def fit_diffusion1D_batch(x_list_microns, y_list_unit_areas, lengths_microns,
+                          times_seconds, log10D_guess=None, init_guess=None, 
+                          fin=0., vary_init=True, need_to_center_x_data=True,
+                          max_iterations=200, tolerance=1e-10,
+                          max_step_log10D=1.):
+    """Fits the 1D erf diffusion model of diffusion1D_params to many 
+    profiles at once. Takes lists of x and y data, one per profile, and 
+    the length and time for each profile (or one value for all).
+    log10D_guess, init_guess, and fin can also be one value or one per
+    profile. Without log10D_guess, each profile starts from the best 
+    log10D on the grid of rss_grid1D, and without init_guess from the 
+    best initial value there if vary_init=True (or 1 otherwise).
+
+    The data are padded into 2D arrays so the model and its derivatives 
+    are made for every profile in one go, and all of the separate 
+    least-squares problems take Levenberg-Marquardt steps together, 
+    each with its own damping, until each one stops improving. No step
+    changes log10D by more than max_step_log10D.
+
+    Returns a dictionary of arrays with one value per profile:
+    log10D, log10D_error, initial, initial_error, RSS, npoints, and
+    converged, which is False if the fit ran out of iterations or ended 
+    where the model hardly depends on log10D. Errors are scaled by the reduced chi-square the same way
+    lmfit does by default. initial_error is 0 if vary_init=False.
+    """
+    nprofiles = len(x_list_microns)
+    npoints = np.array([len(x) for x in x_list_microns])
+    X = np.zeros((nprofiles, max(npoints)))
+    Y = np.zeros_like(X)
+    W = np.zeros_like(X)
+    for k in range(nprofiles):
+        X[k, :npoints[k]] = np.array(x_list_microns[k], dtype=float)
+        Y[k, :npoints[k]] = np.array(y_list_unit_areas[k], dtype=float)
+        W[k, :npoints[k]] = 1.
+
+    ones = np.ones(nprofiles)
+    a_meters = ones * np.array(lengths_microns, dtype=float) / 2e6
+    t = ones * np.array(times_seconds, dtype=float)
+    fin = ones * np.array(fin, dtype=float)
+    X = X / 1e6
+    if need_to_center_x_data is True:
+        X = X - a_meters[:, None]
+
+    # Starting guesses from the best of a log10D grid for every profile, 
+    # one grid value at a time for all of them
+    if init_guess is None:
+        grid_init = ones
+    else:
+        grid_init = ones * np.array(init_guess, dtype=float)
+    if log10D_guess is None:
+        best_RSS = np.inf * ones
+        log10D_guess = np.nan * ones
+        best_init = grid_init.copy()
+        for log10D in np.arange(-18., -7.99, 0.02):
+            E = erf_unit_profile(X, a_meters[:, None], 10.**log10D, 
+                                 t[:, None]) * W
+            if vary_init is True:
+                EE = np.sum(E**2, axis=1)
+                EE[EE == 0.] = np.inf
+                inits = fin + np.sum(E * (Y - fin[:, None]), axis=1) / EE
+            else:
+                inits = grid_init
+            grid_RSS = np.sum(((fin[:, None] + E * (inits - fin)[:, None] - 
+                                Y) * W)**2, axis=1)
+            better = grid_RSS < best_RSS
+            best_RSS[better] = grid_RSS[better]
+            log10D_guess[better] = log10D
+            best_init[better] = inits[better]
+        if init_guess is None:
+            init_guess = best_init
+    if init_guess is None:
+        init_guess = 1.
+
+    # theta holds log10D and initial value for each profile
+    theta = np.column_stack((ones * log10D_guess, ones * init_guess))
+    if vary_init is True:
+        nvary = 2
+    else:
+        nvary = 1
+
+    def residuals_and_jacobian(theta):
+        D = 10.**theta[:, 0]
+        drop = theta[:, 1] - fin
+        E = erf_unit_profile(X, a_meters[:, None], D[:, None], t[:, None])
+        dE = erf_unit_profile_dlog10D(X, a_meters[:, None], D[:, None],
+                                      t[:, None])
+        r = (fin[:, None] + E * drop[:, None] - Y) * W
+        J = np.dstack((drop[:, None] * dE, E))[:, :, :nvary] * W[:, :, None]
+        return r, J
+
+    r, J = residuals_and_jacobian(theta)
+    RSS = np.sum(r**2, axis=1)
+    damping = 1e-3 * ones
+    active = np.ones(nprofiles, dtype=bool)
+    converged = np.zeros(nprofiles, dtype=bool)
+    identity = np.eye(nvary)
+
+    for iteration in range(max_iterations):
+        JTJ = np.einsum('npi,npj->nij', J, J)
+        JTr = np.einsum('npi,np->ni', J, r)
+        # Marquardt scaling of the damping by the curvature
+        curvature = np.maximum(np.diagonal(JTJ, axis1=1, axis2=2), 1e-30)
+        A = JTJ + (damping[:, None, None] * curvature[:, :, None] * 
+                   identity[None, :, :])
+        step = -np.linalg.solve(A, JTr[:, :, None])[:, :, 0]
+        step[~active] = 0.
+        # Far from the data the profiles are flat, so keep D from jumping
+        # more than max_step_log10D at a time
+        too_far = np.abs(step[:, 0]) > max_step_log10D
+        step[too_far] = (step[too_far] * max_step_log10D / 
+                         np.abs(step[too_far, 0])[:, None])
+
+        trial = theta.copy()
+        trial[:, :nvary] = trial[:, :nvary] + step
+        r_trial, J_trial = residuals_and_jacobian(trial)
+        RSS_trial = np.sum(r_trial**2, axis=1)
+
+        better = active & (RSS_trial < RSS)
+        done = better & ((RSS - RSS_trial) <= tolerance * RSS)
+        theta[better] = trial[better]
+        r[better] = r_trial[better]
+        J[better] = J_trial[better]
+        RSS[better] = RSS_trial[better]
+        damping[better] = damping[better] * 0.1
+        damping[active & ~better] = damping[active & ~better] * 10.
+
+        # No improvement even with very small steps means at the minimum
+        done = done | (active & (damping > 1e10))
+        converged = converged | done
+        active = active & ~done
+        if not np.any(active):
+            break
+
+    # uncertainties from the curvature at the best fit
+    JTJ = np.einsum('npi,npj->nij', J, J)
+
+    # Stopping on a plateau where the profile no longer changes with D 
+    # (e.g., far too slow to reach any data) isn't converging on D
+    flat = JTJ[:, 0, 0] * max_step_log10D**2 <= tolerance * RSS
+    converged = converged & ~flat
+    errors = np.zeros((nprofiles, 2))
+    dof = npoints - nvary
+    for k in range(nprofiles):
+        if dof[k] <= 0:
+            errors[k, :] = np.nan
+            continue
+        try:
+            covariance = np.linalg.inv(JTJ[k]) * RSS[k] / dof[k]
+        except np.linalg.LinAlgError:
+            errors[k, :nvary] = np.nan
+            continue
+        errors[k, :nvary] = np.diag(covariance)**0.5
+
+    results = {'log10D' : theta[:, 0],
+               'log10D_error' : errors[:, 0],
+               'initial' : theta[:, 1],
+               'initial_error' : errors[:, 1],
+               'RSS' : RSS,
+               'npoints' : npoints,
+               'converged' : converged}
+    return results
 
 def plot_diffusion1D(x_microns, model, initial_value=None,
                      fighandle=None, axishandle=None, top=1.2,
@@ -257,13 +694,10 @@ def diffusion1D(length_microns, log10D_m2s, time_seconds, init=1., fin=0.,
     Defaults assume diffusion 
     out, so init=1. and fin=0. Reverse these for diffusion in.
     Returns figure, axis, x vector in microns, and model y data."""
-    params = params_setup1D(length_microns, log10D_m2s, time_seconds, 
-                            init, fin,
-                            vD=None, vinit=None, vfin=None)
-                            
-    x_microns, model = diffusion1D_params(params, None, None, 
-                                          erf_or_sum, need_to_center_x_data, 
-                                          infinity, points)
+    x_microns, model = diffusion1D_kernel(length_microns, log10D_m2s, 
+                                          time_seconds, init, fin, 
+                                          erf_or_sum=erf_or_sum, 
+                                          points=points, infinity=infinity)
 
     fig, ax = plot_diffusion1D(x_microns, model, initial_value=init, 
                                fighandle=fighandle, axishandle=axishandle,
@@ -273,6 +707,476 @@ def diffusion1D(length_microns, log10D_m2s, time_seconds, init=1., fin=0.,
     return fig, ax, x_microns, model
 
 
+#%% Master curve: interpolated unit erf profiles on the model grid
+class MasterCurve():
+    """Table of erf_unit_profile values on the grid of points used for 
+    model profiles, x = linspace(-a, a, points), for a range of the one
+    dimensionless number that sets the shape, tau = sqrt(Dt)/a. tau is 
+    spaced evenly in log10 from log10_tau_min to log10_tau_max.
+
+    unit_profiles() gets whole profiles for any number of (a, D, t) cases
+    at once by linear interpolation in log10 tau, which is much faster 
+    than the erf when there are many cases, and falls back on the erf for 
+    tau outside the table. Positions that are not on the grid, e.g., data, 
+    still need erf_unit_profile.
+
+    The table is made the first time it is needed and then saved in 
+    folder (default ~/.pynams) so it only has to be made once. The file 
+    is written to a temporary name and renamed, so processes that make 
+    the same table at once do not read each other's partial files. 
+    max_error is the largest difference from the erf halfway between 
+    tau grid values, 1e-5 to 3e-5 for the default table depending on points.
+    Use get_master_curve(points) to share tables.
+    """
+    def __init__(self, points=50, tau_points=801, log10_tau_min=-1.5,
+                 log10_tau_max=1.5, folder=None):
+        self.points = points
+        self.tau_points = tau_points
+        self.log10_tau_min = log10_tau_min
+        self.log10_tau_max = log10_tau_max
+        if folder is None:
+            folder = os.path.join(os.path.expanduser('~'), '.pynams')
+        self.folder = folder
+        self.table = None
+        self.max_error = None
+
+    def filename(self):
+        """Returns the file the table is saved in"""
+        name = ''.join(('erf_master_curve_', str(self.points), 'x', 
+                        str(self.tau_points), '_', str(self.log10_tau_min), 
+                        '_', str(self.log10_tau_max), '.npz'))
+        return os.path.join(self.folder, name)
+
+    def profiles_from_erf(self, log10_tau):
+        """Unit erf profiles on the grid for 1D array of log10 tau"""
+        xi = np.linspace(-1., 1., self.points)
+        tau = 10.**log10_tau
+        return erf_unit_profile(xi[None, :], 1., tau[:, None]**2., 1.)
+
+    def make_table(self):
+        """Makes the table and max_error and tries to save them"""
+        log10_tau = np.linspace(self.log10_tau_min, self.log10_tau_max, 
+                                self.tau_points)
+        self.table = self.profiles_from_erf(log10_tau)
+        
+        # Linear interpolation is worst halfway between grid values
+        halfway = (log10_tau[1:] + log10_tau[:-1]) / 2.
+        interpolated = (self.table[1:] + self.table[:-1]) / 2.
+        self.max_error = np.max(np.abs(interpolated - 
+                                       self.profiles_from_erf(halfway)))
+        filename = self.filename()
+        temporary = ''.join((filename, '.', str(os.getpid()), '.partial'))
+        try:
+            if not os.path.isdir(self.folder):
+                try:
+                    os.makedirs(self.folder)
+                except OSError:
+                    if not os.path.isdir(self.folder):
+                        raise
+            with open(temporary, 'wb') as f:
+                np.savez(f, table=self.table, max_error=self.max_error)
+            if os.path.exists(filename) and os.name == 'nt':
+                os.remove(filename)
+            os.rename(temporary, filename)
+        except (IOError, OSError):
+            print 'Could not save master curve to', filename
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    def load(self):
+        """Loads the saved table or makes it if there isn't one"""
+        try:
+            with np.load(self.filename()) as saved:
+                table = saved['table']
+                max_error = float(saved['max_error'])
+            if table.shape == (self.tau_points, self.points):
+                self.table = table
+                self.max_error = max_error
+                return
+        except (IOError, OSError, KeyError, ValueError, 
+                zipfile.BadZipfile):
+            pass
+        self.make_table()
+
+    def unit_profiles(self, a_meters, D_m2s, time_seconds):
+        """Same as erf_unit_profile on x = linspace(-a, a, points), but
+        from the table, for single values or arrays of a, D, and t. 
+        Returns one profile or a 2D array with one profile per row."""
+        if self.table is None:
+            self.load()
+        a, Dt = np.broadcast_arrays(np.atleast_1d(a_meters), 
+                                    np.atleast_1d(D_m2s * time_seconds))
+        log10_tau = 0.5 * np.log10(Dt / a**2.)
+        
+        # fractional index into the table
+        fj = ((log10_tau - self.log10_tau_min) * (self.tau_points - 1.) /
+              (self.log10_tau_max - self.log10_tau_min))
+        inside = (fj >= 0.) & (fj <= self.tau_points - 1.)
+        j = np.clip(fj, 0., self.tau_points - 2.).astype(int)
+        w = (fj - j)[:, None]
+        E = self.table[j] + w * (self.table[j+1] - self.table[j])
+
+        if not np.all(inside):
+            E[~inside] = self.profiles_from_erf(log10_tau[~inside])
+
+        if np.ndim(a_meters) == 0 and np.ndim(D_m2s * time_seconds) == 0:
+            E = E[0]
+        return E
+
+master_curves = {}
+
+def get_master_curve(points=50):
+    """Returns the shared MasterCurve for model grids of points points"""
+    if points not in master_curves:
+        master_curves[points] = MasterCurve(points)
+    return master_curves[points]
+
+#%% 1D finite-difference diffusion with changing conditions
+#
+# Heating and cooling ramps and changes in the surface concentration
+# (e.g., stepwise fO2 changes) are handled with a Crank-Nicolson solver.
+# Because D only depends on time through temperature, the diffusion
+# equation is solved in the reduced time tau = integral of D dt, so the
+# temperature history only has to be integrated once, and log10D is the
+# diffusivity at a reference temperature.
+#
+# Histories are passed in as [times_seconds, values] and are linear
+# between times, so repeat a time to make a step change.
+#
+def history_values(history, times_seconds):
+    """Values of a [times_seconds, values] history at the times passed in,
+    held constant outside the history's time range"""
+    times, values = history
+    return np.interp(times_seconds, np.array(times, dtype=float),
+                     np.array(values, dtype=float))
+
+def reduced_time(time_seconds, celsius_history=None, Ea_kJmol=0.,
+                 reference_celsius=None, steps=2000):
+    """Takes the total time, a [times_seconds, celsius] history, and the
+    activation energy in kJ/mol. Returns times from 0 to time_seconds and
+    the integral of D(t)/D(reference_celsius) dt up to those times.
+    The reference temperature defaults to the hottest in the history."""
+    times = np.linspace(0., time_seconds, steps)
+    if celsius_history is None or Ea_kJmol == 0.:
+        return times, times.copy()
+
+    # include the history's own times so no corners get cut
+    extra = np.array(celsius_history[0], dtype=float)
+    extra = extra[(extra > 0.) & (extra < time_seconds)]
+    times = np.unique(np.concatenate((times, extra)))
+
+    if reference_celsius is None:
+        reference_celsius = max(celsius_history[1])
+    T = history_values(celsius_history, times) + 273.15
+    Tref = reference_celsius + 273.15
+    D_relative = np.exp(-Ea_kJmol / GAS_CONSTANT * (1./T - 1./Tref))
+    tau = np.concatenate(([0.], np.cumsum(0.5 * (D_relative[1:] +
+                          D_relative[:-1]) * np.diff(times))))
+    return times, tau
+
+def crank_nicolson_step(c, r, boundary):
+    """One Crank-Nicolson step of unit diffusion on a uniform grid with
+    r = dtau / dx**2 and the new boundary value at both ends, solved with
+    a banded tridiagonal factorization in O(len(c))"""
+    n = len(c) - 2
+    rhs = c[1:-1] + 0.5 * r * (c[:-2] - 2.*c[1:-1] + c[2:])
+    rhs[0] = rhs[0] + 0.5 * r * boundary
+    rhs[-1] = rhs[-1] + 0.5 * r * boundary
+    ab = np.empty((3, n))
+    ab[0] = -0.5 * r
+    ab[1] = 1. + r
+    ab[2] = -0.5 * r
+    inside = scipy.linalg.solve_banded((1, 1), ab, rhs,
+                                       overwrite_ab=True, overwrite_b=True,
+                                       check_finite=False)
+    return np.concatenate(([boundary], inside, [boundary]))
+
+def boundary_limit(tau, boundary_tau, boundary_values, side='right'):
+    """Boundary value interpolated at tau, taking the value just after
+    (side='right') or just before (side='left') any step change"""
+    i = np.searchsorted(boundary_tau, tau, side=side)
+    if i == 0:
+        return boundary_values[0]
+    if i == len(boundary_tau):
+        return boundary_values[-1]
+    fraction = (tau - boundary_tau[i-1]) / (boundary_tau[i] - boundary_tau[i-1])
+    return boundary_values[i-1] + fraction * (boundary_values[i] - 
+                                              boundary_values[i-1])
+
+def crank_nicolson_unit(total_tau, init, boundary_tau, boundary_values,
+                        nodes=201, tolerance=1e-5, max_steps=100000,
+                        step=None):
+    """Solves dc/dtau = d2c/dx2 from -1 to 1 starting at init everywhere
+    with the boundary value interpolated from boundary_tau and
+    boundary_values. Time steps adapt by step doubling so the local error
+    stays below tolerance, and never step across a boundary_tau time.
+    step(c, r, boundary) takes one time step and defaults to the linear
+    crank_nicolson_step. A step that returns None gets retried smaller.
+    Returns the node positions and concentrations."""
+    if step is None:
+        step = crank_nicolson_step
+    x = np.linspace(-1., 1., nodes)
+    dx2 = (x[1] - x[0])**2
+    c = np.ones(nodes) * init
+    tau = 0.
+    corners = np.unique(np.append(boundary_tau[(boundary_tau > 0.) &
+                                               (boundary_tau < total_tau)],
+                                  total_tau))
+    dtau = 0.25 * dx2
+    steps = 0
+    while tau < total_tau:
+        if steps > max_steps:
+            print 'Crank-Nicolson stopped after', max_steps, 'steps'
+            break
+        steps = steps + 1
+        next_corner = corners[np.searchsorted(corners, tau, side='right')]
+        if tau + dtau >= next_corner:
+            dtau = next_corner - tau
+
+        c[0] = c[-1] = boundary_limit(tau, boundary_tau, boundary_values)
+        g_half = boundary_limit(tau + 0.5*dtau, boundary_tau, boundary_values)
+        g_full = boundary_limit(tau + dtau, boundary_tau, boundary_values,
+                                side='left')
+
+        one = step(c, dtau/dx2, g_full)
+        half = step(c, 0.5*dtau/dx2, g_half)
+        if one is None or half is None:
+            two = None
+        else:
+            two = step(half, 0.5*dtau/dx2, g_full)
+        if two is None:
+            if dtau < 1e-12 * dx2:
+                print 'Crank-Nicolson step failed at tau', tau
+                break
+            dtau = 0.2 * dtau
+            continue
+        error = np.abs(two - one).max() / 3.
+
+        if error <= tolerance or dtau < 1e-12 * dx2:
+            c = two
+            # restart small after a corner, where a step change in the
+            # boundary would otherwise set off Crank-Nicolson oscillations
+            if tau + dtau >= next_corner:
+                tau = next_corner
+                dtau = 0.25 * dx2
+                continue
+            tau = tau + dtau
+        factor = 0.9 * (tolerance / max(error, 1e-300))**(1./3.)
+        dtau = dtau * min(2., max(0.2, factor))
+    return x, c
+
+def diffusion1D_history_kernel(microns, log10D_m2s, time_seconds, init=1.,
+                               fin=0., x_microns=None, points=50,
+                               celsius_history=None, boundary_history=None,
+                               Ea_kJmol=0., reference_celsius=None,
+                               nodes=201, tolerance=1e-5, max_steps=100000):
+    """Like diffusion1D_kernel but with a temperature history and a
+    surface concentration history in unit values, both given as
+    [times_seconds, values]. log10D_m2s is the diffusivity at the
+    reference temperature, which defaults to the hottest in the history.
+    Without a boundary history, the surface stays at fin.
+    Returns x_microns and the 1D diffusion profile.
+    """
+    if time_seconds < 0:
+        print 'no negative time'
+        return
+
+    a_meters = microns / 2e6
+    times, tau = reduced_time(time_seconds, celsius_history, Ea_kJmol,
+                              reference_celsius)
+
+    # times for the boundary, including its own corners, in unit tau
+    if boundary_history is None:
+        boundary_times = np.array([0.])
+        boundary_values = np.array([fin], dtype=float)
+    else:
+        boundary_times = np.array(boundary_history[0], dtype=float)
+        boundary_values = np.array(boundary_history[1], dtype=float)
+    scale = 10.**log10D_m2s / a_meters**2
+    boundary_tau = np.interp(boundary_times, times, tau) * scale
+
+    xnodes, c = crank_nicolson_unit(tau[-1] * scale, init, boundary_tau,
+                                    boundary_values, nodes, tolerance,
+                                    max_steps)
+
+    if x_microns is not None:
+        x = np.array(x_microns, dtype=float)
+    elif points == 'auto':
+        # the finite-difference nodes themselves
+        x = xnodes * microns / 2.
+    else:
+        x = np.linspace(-microns/2., microns/2., points)
+    model = np.interp(x / (microns/2.), xnodes, c)
+    return x, model
+
+def diffusion1D_history_params(params, data_x_microns=None,
+                               data_y_unit_areas=None,
+                               need_to_center_x_data=True, points=50,
+                               celsius_history=None, boundary_history=None,
+                               Ea_kJmol=0., reference_celsius=None,
+                               nodes=201, tolerance=1e-5, max_steps=100000):
+    """Same as diffusion1D_params but with the finite-difference model
+    in diffusion1D_history_kernel, so it can be called by lmfit.minimize"""
+    p = params.valuesdict()
+    fitting = False
+    if (data_x_microns is not None) and (data_y_unit_areas is not None):
+        fitting = True
+
+    x_microns = None
+    if fitting is True:
+        x_microns = np.array(data_x_microns, dtype=float)
+        if need_to_center_x_data is True:
+            x_microns = x_microns - p['microns'] / 2.
+
+    profile = diffusion1D_history_kernel(p['microns'], p['log10D_m2s'],
+                                p['time_seconds'], p['initial_unit_value'],
+                                p['final_unit_value'], x_microns, points,
+                                celsius_history, boundary_history, Ea_kJmol,
+                                reference_celsius, nodes, tolerance, 
+                                max_steps)
+    if profile is None:
+        return
+    x_microns, model = profile
+    if fitting is False:
+        return x_microns, model
+    return model - data_y_unit_areas
+
+def exponential_D(c, log10D_slope):
+    """Diffusivity relative to its value at unit concentration 1 when
+    log10 D goes up by log10D_slope per unit concentration, and its 
+    derivative with respect to concentration"""
+    d = 10.**(log10D_slope * (c - 1.))
+    return d, d * log10D_slope * np.log(10.)
+
+def nonlinear_crank_nicolson_step(c, r, boundary, log10D_slope=0.,
+                                  max_iterations=20, tolerance=1e-10):
+    """One Crank-Nicolson step of dc/dtau = d/dx(d(c) dc/dx) with the
+    exponential_D concentration dependence, r = dtau / dx**2, and the new 
+    boundary value at both ends. Newton iterations on the whole grid at 
+    once with a banded tridiagonal Jacobian keep each iteration O(len(c)). 
+    Returns None if Newton does not converge."""
+    def flux_divergence(u):
+        d, dd = exponential_D(u, log10D_slope)
+        d_face = 0.5 * (d[1:] + d[:-1])
+        du = np.diff(u)
+        flux = d_face * du
+        return flux[1:] - flux[:-1], d, dd, d_face, du
+
+    L_old = flux_divergence(c)[0]
+    u = c.copy()
+    u[0] = u[-1] = boundary
+    for iteration in range(max_iterations):
+        L_new, d, dd, d_face, du = flux_divergence(u)
+        F = u[1:-1] - c[1:-1] - 0.5 * r * (L_new + L_old)
+
+        # derivatives of the flux divergence at node i with respect to 
+        # nodes i-1, i, and i+1, with faces averaging the node values
+        lower = d_face[:-1] - 0.5 * dd[:-2] * du[:-1]
+        main = (-d_face[1:] - d_face[:-1] + 0.5 * dd[1:-1] * du[1:] - 
+                0.5 * dd[1:-1] * du[:-1])
+        upper = d_face[1:] + 0.5 * dd[2:] * du[1:]
+
+        n = len(F)
+        ab = np.zeros((3, n))
+        ab[0, 1:] = -0.5 * r * upper[:-1]
+        ab[1] = 1. - 0.5 * r * main
+        ab[2, :-1] = -0.5 * r * lower[1:]
+        try:
+            delta = scipy.linalg.solve_banded((1, 1), ab, -F, 
+                                              check_finite=False)
+        except (np.linalg.LinAlgError, ValueError):
+            return
+        u[1:-1] = u[1:-1] + delta
+        if np.abs(delta).max() < tolerance:
+            return u
+    return
+
+def diffusion1D_DC_kernel(microns, log10D_m2s, time_seconds, init=1.,
+                          fin=0., x_microns=None, points=50, 
+                          log10D_slope=0., nodes=401, tolerance=1e-5,
+                          max_steps=100000):
+    """Like diffusion1D_kernel but with a diffusivity that depends on
+    concentration: log10 D = log10D_m2s + log10D_slope * (C - 1) for 
+    unit concentration C, so log10D_m2s is the diffusivity at C = 1.
+    Solved by Crank-Nicolson with Newton iterations.
+    Returns x_microns and the 1D diffusion profile.
+    """
+    if time_seconds < 0:
+        print 'no negative time'
+        return
+
+    a_meters = microns / 2e6
+    total_tau = 10.**log10D_m2s * time_seconds / a_meters**2
+    step = lambda c, r, g: nonlinear_crank_nicolson_step(c, r, g, 
+                                                         log10D_slope)
+    xnodes, c = crank_nicolson_unit(total_tau, init, np.array([0.]),
+                                    np.array([fin], dtype=float), nodes,
+                                    tolerance, max_steps, step)
+
+    if x_microns is not None:
+        x = np.array(x_microns, dtype=float)
+    elif points == 'auto':
+        # the finite-difference nodes themselves
+        x = xnodes * microns / 2.
+    else:
+        x = np.linspace(-microns/2., microns/2., points)
+    model = np.interp(x / (microns/2.), xnodes, c)
+    return x, model
+
+def diffusion1D_DC_params(params, data_x_microns=None, 
+                          data_y_unit_areas=None,
+                          need_to_center_x_data=True, points=50,
+                          nodes=401, tolerance=1e-5, max_steps=100000):
+    """Same as diffusion1D_params but with the concentration-dependent 
+    model in diffusion1D_DC_kernel, so it can be called by lmfit.minimize.
+    The parameter log10D_slope (see params_setup1D) defaults to 0."""
+    p = params.valuesdict()
+    fitting = False
+    if (data_x_microns is not None) and (data_y_unit_areas is not None):
+        fitting = True
+
+    x_microns = None
+    if fitting is True:
+        x_microns = np.array(data_x_microns, dtype=float)
+        if need_to_center_x_data is True:
+            x_microns = x_microns - p['microns'] / 2.
+
+    profile = diffusion1D_DC_kernel(p['microns'], p['log10D_m2s'],
+                                p['time_seconds'], p['initial_unit_value'],
+                                p['final_unit_value'], x_microns, points,
+                                p.get('log10D_slope', 0.), nodes, tolerance,
+                                max_steps)
+    if profile is None:
+        return
+    x_microns, model = profile
+    if fitting is False:
+        return x_microns, model
+    return model - data_y_unit_areas
+
+def diffusion1D_forward(microns, log10D_m2s, time_seconds, init=1., fin=0.,
+                        x_microns=None, points=50, forward_model='erf',
+                        erf_or_sum='erf', history=None):
+    """Picks the 1D forward model: 'erf' for the constant-condition
+    solutions in diffusion1D_kernel, 'history' for
+    diffusion1D_history_kernel, or 'DC' for diffusion1D_DC_kernel, with
+    the extra keywords for either of the last two in the dictionary
+    history. Returns x_microns and the 1D diffusion profile."""
+    if forward_model == 'erf':
+        return diffusion1D_kernel(microns, log10D_m2s, time_seconds, init,
+                                  fin, x_microns, erf_or_sum, points)
+    elif forward_model == 'history':
+        if history is None:
+            history = {}
+        return diffusion1D_history_kernel(microns, log10D_m2s, time_seconds,
+                                          init, fin, x_microns, points,
+                                          **history)
+    elif forward_model == 'DC':
+        if history is None:
+            history = {}
+        return diffusion1D_DC_kernel(microns, log10D_m2s, time_seconds, init,
+                                     fin, x_microns, points, **history)
+    print 'forward_model must be "erf", "history", or "DC"'
+
 #%% 3-dimensional diffusion parameter setup
 def params_setup3D(microns3, log10D3, time_seconds, 
                    initial=1., final=0., isotropic=False, slowb=False,
@@ -303,19 +1207,172 @@ def params_setup3D(microns3, log10D3, time_seconds,
 
     return params
 
-def diffusion3Dnpi_params(params, data_x_microns=None, data_y_unit_areas=None, 
-                 erf_or_sum='erf', centered=True, 
-                 infinity=100, points=50):
+def unit_values_3D(init, fin):
+    """Takes initial and final unit values for 3D diffusion and returns
+    how the product of the 1D profiles gets turned into concentrations: 
+    scale, going_out, and minimum_value as used by SeparableField, 
+    followed by the initial and final values to use for the 1D profiles
+    """
+    # If initial values > 1, scale down to 1 to avoid blow-ups later
+    going_out = True
+    scale = 1.
+    if init > 1.0:
+        scale = init
+        init = 1.
+    if init < fin:
+        going_out = False
+    
+    if init > fin:
+        minimum_value = fin
+    else:
+        minimum_value = init
+    
+    if going_out is False:        
+        # I'm having trouble getting diffusion in to work simply, so this
+        # is a workaround. The main effort happens as diffusion going in, then
+        # I subtract it all from 1.
+        init, fin = fin, init
+    return scale, going_out, minimum_value, init, fin
+
+def unit_values_3D_derivatives(init, fin):
+    """Returns two dictionaries with the derivatives of scale,
+    minimum_value, init1D, and fin1D from unit_values_3D with respect to
+    init and then fin"""
+    # init above 1 goes into scale, and init itself becomes 1
+    dscale = 0.
+    dinit_1 = 1.
+    if init > 1.0:
+        dscale = 1.
+        dinit_1 = 0.
+        init = 1.
+
+    if init < fin:
+        # going in, so 1D init is fin, and 1D fin and minimum are init
+        dinit = {'scale' : dscale, 'minimum_value' : dinit_1, 
+                 'init1D' : 0., 'fin1D' : dinit_1}
+        dfin = {'scale' : 0., 'minimum_value' : 0., 
+                'init1D' : 1., 'fin1D' : 0.}
+    else:
+        dinit = {'scale' : dscale, 'minimum_value' : 0., 
+                 'init1D' : dinit_1, 'fin1D' : 0.}
+        dfin = {'scale' : 0., 'minimum_value' : 1., 
+                'init1D' : 0., 'fin1D' : 1.}
+    return dinit, dfin
+
+def separable_concentration(product, scale=1., going_out=True, 
+                            minimum_value=0.):
+    """Convert product of 1D profiles to 3D concentration"""
+    v = product * scale
+    if going_out is False:
+        v = 1. - v + minimum_value
+    return v
+
+class SeparableField():
+    """3D concentration field in a rectangular parallelepiped stored only
+    as the three 1D profiles that multiply together to make it.
+
+    The concentration at grid point i, j, k is
+    scale * profiles[0][i] * profiles[1][j] * profiles[2][k] for diffusion
+    out, and 1 minus that plus minimum_value for diffusion in.
+
+    Slices, ray path averages, and point values are all calculated from the
+    1D profiles as they are needed. The full points**3 matrix v is only
+    made when make_v() is called.
+
+    For uneven grids, weights holds one array per direction for averaging
+    along ray paths (see trapezoid_weights). Otherwise averages are 
+    plain means like v.mean(axis=axis).
+    """
+    def __init__(self, profiles, positions_microns=None, scale=1.,
+                 going_out=True, minimum_value=0., weights=None):
+        self.profiles = [np.array(y, dtype=float) for y in profiles]
+        self.positions_microns = positions_microns
+        self.scale = scale
+        self.going_out = going_out
+        self.minimum_value = minimum_value
+        self.weights = weights
+        self.shape = tuple([len(y) for y in self.profiles])
+        self.mid = [int(n/2.) for n in self.shape]
+
+    def unit_to_concentration(self, product):
+        """Convert product of the 1D profiles to concentration"""
+        return separable_concentration(product, self.scale, self.going_out,
+                                       self.minimum_value)
+
+    def make_v(self):
+        """Returns the full 3D concentration matrix v as a single
+        outer product of the 1D profiles"""
+        product = np.einsum('i,j,k->ijk', *self.profiles)
+        return self.unit_to_concentration(product)
+
+    def point(self, i, j, k):
+        """Returns concentration at grid indices i, j, k,
+        which can also be arrays of indices"""
+        product = self.profiles[0][i] * self.profiles[1][j] * self.profiles[2][k]
+        return self.unit_to_concentration(product)
+
+    def slice_profile(self, direction):
+        """Returns profile through the center of the block parallel to
+        direction 0, 1, or 2, same as v[:, mid, mid], etc."""
+        product = np.copy(self.profiles[direction])
+        for k in range(3):
+            if k != direction:
+                product = product * self.profiles[k][self.mid[k]]
+        return self.unit_to_concentration(product)
+
+    def slice_profiles(self):
+        """Returns list of the three center slice profiles"""
+        return [self.slice_profile(k) for k in range(3)]
+
+    def profile_mean(self, direction):
+        """Returns the average of the 1D profile in direction 0, 1, or 2"""
+        if self.weights is None:
+            return np.mean(self.profiles[direction])
+        return np.dot(self.weights[direction], self.profiles[direction])
+
+    def path_average(self, axis):
+        """Returns 2D array of concentrations averaged along ray paths
+        parallel to axis 0, 1, or 2, same as v.mean(axis=axis)"""
+        others = [k for k in range(3) if k != axis]
+        product = (self.profile_mean(axis) *
+                   np.outer(self.profiles[others[0]],
+                            self.profiles[others[1]]))
+        return self.unit_to_concentration(product)
+
+    def wholeblock_profile(self, direction, raypath):
+        """Returns whole-block profile parallel to direction 0, 1, or 2
+        measured with the infrared beam parallel to raypath 0, 1, or 2.
+        This is the ray path average through the middle of the block,
+        e.g., path_average(1)[:, mid] for direction 0 and raypath 1, but
+        it only needs the mean of one 1D profile times the other two, so
+        the cost goes as points rather than points**2 or points**3."""
+        other = 3 - direction - raypath
+        product = (self.profiles[direction] * 
+                   self.profile_mean(raypath) *
+                   self.profiles[other][self.mid[other]])
+        return self.unit_to_concentration(product)
+
+def diffusion3Dnpi_params(params, data_x_microns=None, data_y_unit_areas=None,
+                 erf_or_sum='erf', centered=True,
+                 infinity=100, points=50, lazy=False, grid_tolerance=1e-4):
     """ Diffusion in 3 dimensions in a rectangular parallelipiped.
     Takes params - Setup parameters with params_setup3D.
     General setup and options similar to diffusion1D_params.
-    
+
     Returns complete 3D concentration
-    matrix v, slice profiles, and 
+    matrix v, slice profiles, and
     positions of slice profiles.
-    
-    ### NOT COMPLETELY SET UP FOR FITTING JUST YET ###
-    """   
+
+    If lazy=True, returns a SeparableField in place of v, which holds
+    only the three 1D profiles and makes v on request with make_v().
+    With points='auto', each direction gets its own uneven grid from 
+    auto_grid for the current D, good to about grid_tolerance.
+
+    With data, returns the residuals along the three profiles through the
+    middle of the block from diffusion3Dnpi_at_positions, so the model is
+    taken right at the data positions (centered on 0 unless centered=False)
+    and the 3D grid is never made.
+    """
     fitting = False
     if (data_x_microns is not None) and (data_y_unit_areas is not None):
         x_data = np.array(data_x_microns)
@@ -332,96 +1389,77 @@ def diffusion3Dnpi_params(params, data_x_microns=None, data_y_unit_areas=None,
     L3_microns = np.array(p['microns3'])
     t = p['time_seconds']
     init = p['initial_unit_value']
-    vary_init = [params['initial_unit_value'].vary]
     fin = p['final_unit_value']
-    vary_fin = [params['final_unit_value'].vary]
     log10D3 = [p['log10Dx'], p['log10Dy'], p['log10Dz']]
-    vary_D = [params['log10Dx'].vary, 
-              params['log10Dy'].vary, 
-              params['log10Dz'].vary]
 
-    # If initial values > 1, scale down to 1 to avoid blow-ups later
-    going_out = True
-    scale = 1.
-    if init > 1.0:
-        scale = init
-        init = 1.
-    if init < fin:
-        going_out = False
-    
-    if init > fin:
-        minimum_value = fin
-    else:
-        minimum_value = init
-    
-    if going_out is False:        
-        # I'm having trouble getting diffusion in to work simply, so this
-        # is a workaround. The main effort happens as diffusion going in, then
-        # I subtract it all from 1.
-        init, fin = fin, init
-        
+    if fitting is True:
+        values = diffusion3Dnpi_at_positions(L3_microns, log10D3, t, x_data,
+                                             init, fin, centered, erf_or_sum)
+        residuals = []
+        for k in range(3):
+            residuals.append(values[k] - np.array(y_data[k]))
+        return np.concatenate(residuals)
+
+    return diffusion3Dnpi_kernel(L3_microns, log10D3, t, init, fin, points,
+                                 centered, erf_or_sum, infinity, lazy,
+                                 grid_tolerance)
+
+def diffusion3Dnpi_kernel(microns3, log10D3, time_seconds, init=1., fin=0.,
+                          points=50, centered=True, erf_or_sum='erf', 
+                          infinity=100, lazy=False, grid_tolerance=1e-4):
+    """The calculation behind diffusion3Dnpi_params using plain numbers
+    instead of lmfit parameters. Returns 3D concentration matrix v (or a
+    SeparableField if lazy=True), slice profiles, and slice positions.
+    """
+    L3_microns = np.array(microns3, dtype=float)
+    scale, going_out, minimum_value, init, fin = unit_values_3D(init, fin)
+
     # First create 3 1D profiles, 1 in each direction
     xprofiles = []    
     yprofiles = []
-    kwdict = {'points' : points}
-    
     for k in range(3):
-        p1D = lmfit.Parameters()
-        p1D.add('microns', L3_microns[k], False)
-        p1D.add('time_seconds', t, params['time_seconds'].vary)
-        p1D.add('log10D_m2s', log10D3[k], vary_D[k])
-        p1D.add('initial_unit_value', init, vary_init)
-        p1D.add('final_unit_value', fin, vary_fin)
-        
-        x, y = diffusion1D_params(p1D, **kwdict)
-
-        xprofiles.append(x)
-        yprofiles.append(y)
+        profile = diffusion1D_kernel(L3_microns[k], log10D3[k], time_seconds,
+                                     init, fin, erf_or_sum=erf_or_sum, 
+                                     points=points, infinity=infinity,
+                                     grid_tolerance=grid_tolerance)
+        if profile is None or profile is False:
+            return profile
+        xprofiles.append(profile[0])
+        yprofiles.append(profile[1])
                                       
-    # Then multiply them together to get a 3D matrix
-    # I should figure out how to do this without the for-loops
-    v = np.ones((points, points, points))
-    for d in range(0, points):
-        for e in range(0, points):
-            for f in range(0, points):
-                v[d][e][f] = yprofiles[0][d]*yprofiles[1][e]*yprofiles[2][f]
-
-    v = v * scale
-
-    if going_out is False:
-        v = np.ones((points, points, points)) - v
-        v = v + np.ones_like(v)*minimum_value
-
-    mid = int(points/2.)
-    
-    aslice = v[:, mid][:, mid]
-    bslice = v[mid][:, mid]
-    cslice = v[mid][mid]
-    sliceprofiles = [aslice, bslice, cslice]
+    # The 3D matrix is the product of the 1D profiles, so only make it
+    # when it is actually needed
+    weights = None
+    if points == 'auto':
+        weights = [trapezoid_weights(x) for x in xprofiles]
+    field = SeparableField(yprofiles, xprofiles, scale=scale,
+                           going_out=going_out, minimum_value=minimum_value,
+                           weights=weights)
+    sliceprofiles = field.slice_profiles()
+    if lazy is True:
+        v = field
+    else:
+        v = field.make_v()
 
     slice_positions_microns = []
     for k in range(3):
         a = L3_microns[k] / 2.
-        if centered is False:            
+        if points == 'auto':
+            x = xprofiles[k]
+            if centered is False:
+                x = x + a
+        elif centered is False:            
             x = np.linspace(0, a*2., points)
         else:
             x = np.linspace(-a, a, points)
         slice_positions_microns.append(x)
           
-    # Returning full matrix and 
-    # slice profiles in one long list for use in fitting
-    sliceprofiles = [aslice, bslice, cslice]
-    
-    if fitting is False:
-        return v, sliceprofiles, slice_positions_microns
-    else:
-        ### Still need to set up residuals! ###
-        residuals = np.zeros_like(sliceprofiles)
-        return residuals
+    # Returning full matrix, slice profiles, and positions
+    return v, sliceprofiles, slice_positions_microns
 
 def diffusion3Dnpi(lengths_microns, log10Ds_m2s, time_seconds, points=50,
                     initial=1, final=0., top=1.2, plot3=True, centered=True,
-                    styles3=[None]*3, figaxis3=None):
+                    styles3=[None]*3, figaxis3=None, lazy=False):
         """
         Required input:
         list of 3 lengths, list of 3 diffusivities, and time 
@@ -439,11 +1477,14 @@ def diffusion3Dnpi(lengths_microns, log10Ds_m2s, time_seconds, points=50,
         5. y, list of 3 sets of y values plotted
         
         If plot3=False, returns only v, x, y
+
+        If lazy=True, v is returned as a SeparableField, and the full 3D
+        matrix is only made if you call v.make_v()
         """
-        params = params_setup3D(lengths_microns, log10Ds_m2s, time_seconds,
-                                initial=initial, final=final)
-                                                                
-        v, y, x = diffusion3Dnpi_params(params, points=points, centered=False)
+        v, y, x = diffusion3Dnpi_kernel(lengths_microns, log10Ds_m2s, 
+                                        time_seconds, initial, final, 
+                                        points=points, centered=False,
+                                        lazy=lazy)
 
         if centered is True:
             for idx in xrange(3):
@@ -470,24 +1511,316 @@ def diffusion3Dnpi(lengths_microns, log10Ds_m2s, time_seconds, points=50,
             return v, x, y
             
 #%% 3D whole-block: 3-dimensional diffusion with path integration
+def separable_unit_factors(microns3, log10D3, time_seconds, positions_microns,
+                           raypaths=None, centered=True, points=None,
+                           erf_or_sum='erf', grid_tolerance=1e-4):
+    """Returns the unit erf values E and their derivatives dE with respect
+    to log10D that multiply together to give 3D diffusion along the
+    profile through the middle of the block in each direction a, b, c at 
+    the positions in the list of three position lists positions_microns.
+
+    E[k][j] and dE[k][j] are for profile direction k and block direction j:
+    the 1D profile at the positions for j = k, the average along the ray
+    path for j = raypaths[k], and the value in the middle of the block
+    otherwise. With raypaths=None, both other directions use the value in 
+    the middle (no path integration).
+
+    Positions are centered on 0 unless centered=False, in which case they
+    start at 0. The erf profiles and averages are exact unless points is 
+    given, in which case everything is taken from grids of that many points 
+    the way diffusion3Dwb_params does it. On grids, erf_or_sum='master' 
+    takes E from the MasterCurve, which is made and saved in ~/.pynams 
+    the first time. The derivatives always come from the erf.
+    With points='auto', the grids come from auto_grid (good to about 
+    grid_tolerance), averages use trapezoid weights, and values are 
+    interpolated to the positions, as in diffusion3Dwb_params.
+    Returns None for bad raypaths.
+    """
+    a_meters = np.array(microns3, dtype=float) / 2.E6
+    D_m2s = 10.**np.array(log10D3, dtype=float)
+    t = time_seconds
+
+    # mean along the ray path and value at the middle of each direction
+    means = []
+    middles = []
+    grids = []
+    grid_values = []
+    for j in range(3):
+        if points is None:
+            means.append((erf_unit_mean(a_meters[j], D_m2s[j], t),
+                          erf_unit_mean_dlog10D(a_meters[j], D_m2s[j], t)))
+            middles.append((erf_unit_profile(0., a_meters[j], D_m2s[j], t),
+                            erf_unit_profile_dlog10D(0., a_meters[j], 
+                                                     D_m2s[j], t)))
+        elif points == 'auto':
+            # master curves come on even grids, so the erf is used here
+            grid = auto_grid(microns3[j], log10D3[j], t, 
+                             grid_tolerance) / 1E6
+            E = erf_unit_profile(grid, a_meters[j], D_m2s[j], t)
+            dE = erf_unit_profile_dlog10D(grid, a_meters[j], D_m2s[j], t)
+            weights = trapezoid_weights(grid)
+            mid = int(len(grid)/2.)
+            means.append((np.sum(weights * E), np.sum(weights * dE)))
+            middles.append((E[mid], dE[mid]))
+            grids.append(grid)
+            grid_values.append((E, dE))
+        else:
+            grid = np.linspace(-a_meters[j], a_meters[j], points)
+            if erf_or_sum == 'master':
+                E = get_master_curve(points).unit_profiles(a_meters[j], 
+                                                           D_m2s[j], t)
+            else:
+                E = erf_unit_profile(grid, a_meters[j], D_m2s[j], t)
+            dE = erf_unit_profile_dlog10D(grid, a_meters[j], D_m2s[j], t)
+            mid = int(len(grid)/2.)
+            means.append((np.mean(E), np.mean(dE)))
+            middles.append((E[mid], dE[mid]))
+            grids.append(grid)
+            grid_values.append((E, dE))
+
+    E3 = []
+    dE3 = []
+    for k in range(3):
+        ray = None
+        if raypaths is not None:
+            ray = 'abc'.find(raypaths[k])
+            if ray < 0 or ray == k:
+                print ''.join(('raypaths[', str(k), '] for profile || ', 
+                               'abc'[k], 
+                               ' must be one of the other two directions'))
+                return
+
+        x = np.array(positions_microns[k], dtype=float) / 1E6
+        if centered is False:
+            x = x - a_meters[k]
+
+        E = [None, None, None]
+        dE = [None, None, None]
+        if points is None:
+            E[k] = erf_unit_profile(x, a_meters[k], D_m2s[k], t)
+            dE[k] = erf_unit_profile_dlog10D(x, a_meters[k], D_m2s[k], t)
+        elif points == 'auto':
+            E[k] = np.interp(x, grids[k], grid_values[k][0])
+            dE[k] = np.interp(x, grids[k], grid_values[k][1])
+        else:
+            # use the grid point closest to each position
+            idx = np.abs(grids[k][None, :] - x[:, None]).argmin(axis=1)
+            E[k] = grid_values[k][0][idx]
+            dE[k] = grid_values[k][1][idx]
+        for j in range(3):
+            if j == k:
+                continue
+            elif j == ray:
+                E[j], dE[j] = means[j]
+            else:
+                E[j], dE[j] = middles[j]
+        E3.append(E)
+        dE3.append(dE)
+    return E3, dE3
+
+def diffusion3D_at_positions(microns3, log10D3, time_seconds, 
+                             positions_microns, raypaths=None, init=1., 
+                             fin=0., centered=True, points=None, 
+                             erf_or_sum='erf'):
+    """3D diffusion evaluated at the positions in the list of three 
+    position lists, one per profile direction a, b, c, through the middle 
+    of the block. Whole-block values if raypaths is the list of three ray 
+    path directions, and non-path-integrated values if raypaths is None. 
+    See separable_unit_factors for centered, points, and erf_or_sum.
+    Returns list of three arrays of values.
+    """
+    factors = separable_unit_factors(microns3, log10D3, time_seconds,
+                                     positions_microns, raypaths, centered,
+                                     points, erf_or_sum)
+    if factors is None:
+        return
+    E3 = factors[0]
+    scale, going_out, minimum_value, init1D, fin1D = unit_values_3D(init, 
+                                                                     fin)
+    values = []
+    for k in range(3):
+        product = 1.
+        for j in range(3):
+            product = product * (fin1D + (init1D - fin1D) * E3[k][j])
+        values.append(separable_concentration(product, scale, going_out,
+                                              minimum_value))
+    return values
+
+def diffusion3Dwb_at_positions(microns3, log10D3, time_seconds, 
+                               positions_microns, raypaths,
+                               init=1., fin=0., centered=True, points=None,
+                               erf_or_sum='erf'):
+    """Whole-block model evaluated exactly at the positions in the list of 
+    three position lists, one per profile direction a, b, c. 
+    Positions are centered on 0 unless centered=False, in which case
+    they start at 0. raypaths is the list of three ray path directions.
+    
+    The 1D erf profile is evaluated at each position, and the ray path
+    average uses the exact average of the erf profile, so no model grid
+    is involved. Returns list of three arrays of whole-block values.
+    """
+    return diffusion3D_at_positions(microns3, log10D3, time_seconds,
+                                    positions_microns, raypaths, init, fin,
+                                    centered, points, erf_or_sum)
+
+def diffusion3Dnpi_at_positions(microns3, log10D3, time_seconds,
+                                positions_microns, init=1., fin=0., 
+                                centered=True, erf_or_sum='erf'):
+    """Non-path-integrated 3D diffusion evaluated exactly at the positions
+    in the list of three position lists, one per profile direction a, b, c,
+    along the profiles through the middle of the block.
+    Returns list of three arrays of values."""
+    return diffusion3D_at_positions(microns3, log10D3, time_seconds,
+                                    positions_microns, None, init, fin,
+                                    centered, erf_or_sum=erf_or_sum)
+
+def diffusion3D_derivatives(microns3, log10D3, time_seconds, 
+                            positions_microns, raypaths=None, init=1., 
+                            fin=0., centered=True, points=None,
+                            grid_tolerance=1e-4):
+    """Derivatives of diffusion3D_at_positions, all three profiles joined
+    end to end, with respect to log10Dx, log10Dy, log10Dz, 
+    initial_unit_value, final_unit_value, and time_seconds. 
+    Returns dictionary of arrays with those parameter names as keys."""
+    factors = separable_unit_factors(microns3, log10D3, time_seconds,
+                                     positions_microns, raypaths, centered,
+                                     points, grid_tolerance=grid_tolerance)
+    if factors is None:
+        return
+    E3, dE3 = factors
+    scale, going_out, minimum_value, init1D, fin1D = unit_values_3D(init, 
+                                                                     fin)
+    dinit, dfin = unit_values_3D_derivatives(init, fin)
+    if going_out is True:
+        sign = 1.
+    else:
+        sign = -1.
+
+    D_names = ['log10Dx', 'log10Dy', 'log10Dz']
+    derivatives = {}
+    for name in D_names + ['initial_unit_value', 'final_unit_value']:
+        derivatives[name] = []
+
+    for k in range(3):
+        f = [fin1D + (init1D - fin1D) * E3[k][j] for j in range(3)]
+        # product of the other two factors for each direction
+        others = [f[1]*f[2], f[0]*f[2], f[0]*f[1]]
+        nvalues = len(np.atleast_1d(E3[k][k]))
+        product = f[k] * others[k] * np.ones(nvalues)
+        
+        dP_dinit1D = 0.
+        dP_dfin1D = 0.
+        for j in range(3):
+            dP = (init1D - fin1D) * dE3[k][j] * others[j]
+            derivatives[D_names[j]].append(sign * scale * dP * 
+                                           np.ones(nvalues))
+            dP_dinit1D = dP_dinit1D + E3[k][j] * others[j]
+            dP_dfin1D = dP_dfin1D + (1. - E3[k][j]) * others[j]
+
+        for name, d in [('initial_unit_value', dinit), 
+                        ('final_unit_value', dfin)]:
+            dv = sign * (d['scale'] * product + 
+                         scale * (dP_dinit1D * d['init1D'] + 
+                                  dP_dfin1D * d['fin1D']))
+            if going_out is False:
+                dv = dv + d['minimum_value']
+            derivatives[name].append(dv * np.ones(nvalues))
+
+    for name in derivatives.keys():
+        derivatives[name] = np.concatenate(derivatives[name])
+    # D and t only show up together as D*t
+    derivatives['time_seconds'] = ((derivatives['log10Dx'] + 
+                                    derivatives['log10Dy'] +
+                                    derivatives['log10Dz']) / 
+                                   (time_seconds * np.log(10.)))
+    return derivatives
+
+def diffusion3Dnpi_jacobian(params, data_x_microns=None, 
+                            data_y_unit_areas=None, erf_or_sum='erf', 
+                            centered=True, infinity=100, points=50, 
+                            lazy=False):
+    """Analytic derivatives of the residuals from diffusion3Dnpi_params.
+    Takes the same arguments so it can be passed to lmfit.minimize with
+    Dfun=diffusion3Dnpi_jacobian, col_deriv=1."""
+    p = params.valuesdict()
+    log10D3 = [p['log10Dx'], p['log10Dy'], p['log10Dz']]
+    derivatives = diffusion3D_derivatives(p['microns3'], log10D3, 
+                                          p['time_seconds'], data_x_microns,
+                                          None, p['initial_unit_value'],
+                                          p['final_unit_value'], centered)
+    return jacobian_rows(params, derivatives)
+
+def diffusion3Dwb_jacobian(params, data_x_microns=None, data_y_unit_areas=None, 
+                           raypaths=None, erf_or_sum='erf', show_plot=True, 
+                           fig_ax=None, style=None, need_to_center_x_data=True,
+                           infinity=100, points=50, show_1Dplots=False,
+                           exact_positions=False, grid_tolerance=1e-4):
+    """Analytic derivatives of the residuals from diffusion3Dwb_params, 
+    with or without exact_positions. Takes the same arguments so it can be 
+    passed to lmfit.minimize with Dfun=diffusion3Dwb_jacobian, col_deriv=1.
+    """
+    if exact_positions is True:
+        grid_points = None
+    else:
+        grid_points = points
+    p = params.valuesdict()
+    log10D3 = [p['log10Dx'], p['log10Dy'], p['log10Dz']]
+    derivatives = diffusion3D_derivatives(p['microns3'], log10D3, 
+                                          p['time_seconds'], data_x_microns,
+                                          raypaths, p['initial_unit_value'],
+                                          p['final_unit_value'], 
+                                          not need_to_center_x_data, 
+                                          grid_points, grid_tolerance)
+    return jacobian_rows(params, derivatives)
+
 def diffusion3Dwb_params(params, data_x_microns=None, data_y_unit_areas=None, 
                           raypaths=None, erf_or_sum='erf', show_plot=True, 
                           fig_ax=None, style=None, need_to_center_x_data=True,
-                          infinity=100, points=50, show_1Dplots=False):
+                          infinity=100, points=50, show_1Dplots=False,
+                          exact_positions=False, grid_tolerance=1e-4):
     """ Diffusion in 3 dimensions with path integration.
     Requires setup with params_setup3Dwb
+    
+    When fitting, the model is normally taken from the grid point closest
+    to each data point. With exact_positions=True, the residuals are instead
+    calculated with diffusion3Dwb_at_positions right at the data 
+    positions, which is faster, does not depend on points, and changes 
+    smoothly with D. Nothing is plotted in that case.
+
+    With points='auto', the grids come from auto_grid for the current D
+    (good to about grid_tolerance), and the model is interpolated 
+    between grid points to the data positions.
     """
     if raypaths is None:
         print 'raypaths must be in the form of a list of three abc directions'
         return
 
-    # v is the model 3D array of internal concentrations
-    ### Need to add in all the keywords ###
-    v, sliceprofiles, slicepositions = diffusion3Dnpi_params(params, 
-                    points=points, erf_or_sum=erf_or_sum,
-#                    need_to_center_x_data=need_to_center_x_data
-                    )
+    if ((exact_positions is True) and (data_x_microns is not None) and 
+        (data_y_unit_areas is not None)):
+        p = params.valuesdict()
+        log10D3 = [p['log10Dx'], p['log10Dy'], p['log10Dz']]
+        wb_values = diffusion3Dwb_at_positions(p['microns3'], log10D3, 
+                                       p['time_seconds'], data_x_microns, 
+                                       raypaths, p['initial_unit_value'],
+                                       p['final_unit_value'],
+                                       centered=not need_to_center_x_data,
+                                       erf_or_sum=erf_or_sum)
+        if wb_values is None:
+            return
+        residuals = []
+        for k in range(3):
+            residuals.append(wb_values[k] - np.array(data_y_unit_areas[k]))
+        return np.concatenate(residuals)
 
+    p = params.valuesdict()
+    L3 = p['microns3']
+    log10D3 = [p['log10Dx'], p['log10Dy'], p['log10Dz']]
+    wb = diffusion3Dwb_kernel(L3, log10D3, p['time_seconds'], raypaths, 
+                              p['initial_unit_value'], p['final_unit_value'],
+                              points, erf_or_sum, infinity, grid_tolerance)
+    if wb is None:
+        return
+    wb_positions, wb_profiles = wb
     
     # Fitting to data or not? Default is not
     # Add appropriate x and y data to fit
@@ -502,49 +1835,6 @@ def diffusion3Dwb_params(params, data_x_microns=None, data_y_unit_areas=None,
             print 'x and y data must be the same shape'
             print 'x', np.shape(x_array)
             print 'y', np.shape(y_array)
-            
-    # Whole-block measurements can be obtained through any of the three 
-    # planes of the whole-block, so profiles can come from one of two ray path
-    # directions. These are the planes.
-    raypathA = v.mean(axis=0)
-    raypathB = v.mean(axis=1)
-    raypathC = v.mean(axis=2)
-
-    # Specify whole-block profiles in model
-    mid = points/2
-    if raypaths[0] == 'b':
-        wbA = raypathB[:, mid]
-    elif raypaths[0] == 'c':
-        wbA = raypathC[:, mid]       
-    else:
-        print 'raypaths[0] for profile || a must be "b" or "c"'
-        return
-        
-    if raypaths[1] == 'a':
-        wbB = raypathA[:, mid]
-    elif raypaths[1] == 'c':
-        wbB = raypathC[mid]       
-    else:
-        print 'raypaths[1] for profile || b must be "a" or "c"'
-        return
-
-    if raypaths[2] == 'a':
-        wbC = raypathA[mid]
-    elif raypaths[2] == 'b':
-        wbC = raypathB[mid]       
-    else:
-        print 'raypaths[2] for profile || c must be "a" or "b"'
-        return
-
-    p = params.valuesdict()
-    L3 = p['microns3']
-    
-    wb_profiles = [wbA, wbB, wbC]
-    wb_positions = []
-    for k in range(3):
-        a = L3[k] / 2.
-        x_microns = np.linspace(0., 2.*a, points)
-        wb_positions.append(x_microns)
         
     if show_plot is True:
         if style is None:
@@ -568,13 +1858,18 @@ def diffusion3Dwb_params(params, data_x_microns=None, data_y_unit_areas=None,
         residuals = []
         for k in range(3):
             for pos in range(len(x_array[k])):
-                # wb_positions are centered, data are not
+                # wb_positions start at 0; data may be centered
                 microns = x_array[k][pos]
-                # Find the index of the full model whole-block value 
-                # closest to the data positions
-                idx = (np.abs(wb_positions[k]-microns).argmin())
-                
-                model = wb_profiles[k][idx]
+                if need_to_center_x_data is False:
+                    microns = microns + L3[k] / 2.
+                if points == 'auto':
+                    model = np.interp(microns, wb_positions[k], 
+                                      wb_profiles[k])
+                else:
+                    # Find the index of the full model whole-block value 
+                    # closest to the data positions
+                    idx = (np.abs(wb_positions[k]-microns).argmin())
+                    model = wb_profiles[k][idx]
                 data = y_array[k][pos]
                 res = model - data
                 
@@ -583,18 +1878,80 @@ def diffusion3Dwb_params(params, data_x_microns=None, data_y_unit_areas=None,
                 residuals.append(res)                
         return residuals
 
+def wholeblock_profiles(field, raypaths):
+    """Takes a SeparableField or GridField and list of three ray path
+    directions for the profiles || a, b, and c. Returns the three 
+    whole-block profiles."""
+    # Whole-block measurements can be obtained through any of the three 
+    # planes of the whole-block, so profiles can come from one of two ray path
+    # directions.
+    if raypaths[0] == 'b':
+        wbA = field.wholeblock_profile(0, 1)
+    elif raypaths[0] == 'c':
+        wbA = field.wholeblock_profile(0, 2)
+    else:
+        print 'raypaths[0] for profile || a must be "b" or "c"'
+        return
+        
+    if raypaths[1] == 'a':
+        wbB = field.wholeblock_profile(1, 0)
+    elif raypaths[1] == 'c':
+        wbB = field.wholeblock_profile(1, 2)
+    else:
+        print 'raypaths[1] for profile || b must be "a" or "c"'
+        return
+
+    if raypaths[2] == 'a':
+        wbC = field.wholeblock_profile(2, 0)
+    elif raypaths[2] == 'b':
+        wbC = field.wholeblock_profile(2, 1)
+    else:
+        print 'raypaths[2] for profile || c must be "a" or "b"'
+        return
+    return [wbA, wbB, wbC]
+
+def diffusion3Dwb_kernel(microns3, log10D3, time_seconds, raypaths, init=1.,
+                         fin=0., points=50, erf_or_sum='erf', infinity=100,
+                         grid_tolerance=1e-4):
+    """The calculation behind diffusion3Dwb_params on a grid of points
+    (or the grids of auto_grid for points='auto') using plain numbers 
+    instead of lmfit parameters. Returns positions starting at 0 and 
+    whole-block profiles, one of each per direction.
+    """
+    # field holds the model 3D internal concentrations as 1D profiles
+    field, sliceprofiles, slicepositions = diffusion3Dnpi_kernel(microns3,
+                    log10D3, time_seconds, init, fin, points=points, 
+                    erf_or_sum=erf_or_sum, infinity=infinity, lazy=True,
+                    grid_tolerance=grid_tolerance)
+            
+    # Each whole-block profile is the ray path average through the middle
+    # of the block, which the field gets straight from its 1D profiles, 
+    # so the cost goes as points instead of points**3.
+    wb_profiles = wholeblock_profiles(field, raypaths)
+    if wb_profiles is None:
+        return
+    wb_positions = []
+    for k in range(3):
+        a = microns3[k] / 2.
+        if points == 'auto':
+            x_microns = field.positions_microns[k] + a
+        else:
+            x_microns = np.linspace(0., 2.*a, points)
+        wb_positions.append(x_microns)
+    return wb_positions, wb_profiles
+
 def diffusion3Dwb(lengths_microns, log10Ds_m2s, time_seconds, raypaths,
                    initial=1., final=0., top=1.2, points=50., show_plot=True,
                    figax=None, isotropic=False):
         """Takes list of 3 lengths, list of 3 diffusivities, and time.
         Returns plot of 3D path-averaged (whole-block) diffusion profiles"""
-        params = params_setup3D(lengths_microns, log10Ds_m2s, time_seconds,
-                                initial=initial, final=final)
-
-        return params
-        
-        x, y = diffusion3Dwb_params(params, raypaths=raypaths, show_plot=False,
-                                    points=points)
+        if points != 'auto':
+            points = int(points)
+        wb = diffusion3Dwb_kernel(lengths_microns, log10Ds_m2s, time_seconds,
+                                  raypaths, initial, final, points)
+        if wb is None:
+            return
+        x, y = wb
 
         if show_plot is True:
             if figax is None:
@@ -604,7 +1961,1021 @@ def diffusion3Dwb(lengths_microns, log10Ds_m2s, time_seconds, raypaths,
                 styles.plot_3panels(x, y, top=top, figaxis3=figax)
         return x, y
 
+
+#%% 3D finite differences: alternating direction implicit (ADI)
+#
+# For cases that are not separable, e.g., concentration-dependent D or 
+# reactions between defects, the full 3D field is stepped in time by 
+# splitting each step into implicit 1D steps along x, then y, then z. 
+# Every 1D step solves all the tridiagonal systems along that axis at 
+# once, one node at a time, so the python loop only goes as points.
+#
+class GridField():
+    """3D concentration field stored as the full points**3 matrix v, with
+    the same methods as SeparableField for fields that are not separable.
+    For uneven grids, weights holds one array per direction for averaging
+    along ray paths (see trapezoid_weights). Otherwise averages are 
+    plain means.
+    """
+    def __init__(self, v, positions_microns=None, weights=None):
+        self.v = v
+        self.positions_microns = positions_microns
+        self.weights = weights
+        self.shape = v.shape
+        self.mid = [int(n/2.) for n in self.shape]
+
+    def average(self, values, axis, direction):
+        """Average of values along their axis, which is block direction
+        direction 0, 1, or 2"""
+        if self.weights is None:
+            return values.mean(axis=axis)
+        return np.tensordot(values, self.weights[direction], 
+                            axes=([axis], [0]))
+
+    def make_v(self):
+        """Returns the full 3D concentration matrix v"""
+        return self.v
+
+    def point(self, i, j, k):
+        """Returns concentration at grid indices i, j, k"""
+        return self.v[i, j, k]
+
+    def slice_profile(self, direction):
+        """Returns profile through the center of the block parallel to
+        direction 0, 1, or 2"""
+        index = list(self.mid)
+        index[direction] = slice(None)
+        return self.v[tuple(index)]
+
+    def slice_profiles(self):
+        """Returns list of the three center slice profiles"""
+        return [self.slice_profile(k) for k in range(3)]
+
+    def path_average(self, axis):
+        """Returns 2D array of concentrations averaged along ray paths
+        parallel to axis 0, 1, or 2"""
+        return self.average(self.v, axis, axis)
+
+    def wholeblock_profile(self, direction, raypath):
+        """Returns whole-block profile parallel to direction 0, 1, or 2
+        measured with the infrared beam parallel to raypath 0, 1, or 2"""
+        other = 3 - direction - raypath
+        index = [slice(None)] * 3
+        index[other] = self.mid[other]
+        plane = self.v[tuple(index)]
+        # taking the middle of other leaves only two axes in the plane
+        axis = raypath
+        if raypath > other:
+            axis = raypath - 1
+        return self.average(plane, axis, raypath)
+
+def tridiagonal_sweep(lower, main, upper, rhs):
+    """Solves many tridiagonal systems at once. Each row of the 2D arrays
+    is one system, and lower[:, 0] and upper[:, -1] are not used. 
+    Strung end to end, the systems make one long tridiagonal system with
+    no coupling between rows, which is solved in a single banded call."""
+    m, n = rhs.shape
+    ab = np.zeros((3, m*n), dtype=rhs.dtype)
+    up = np.array(upper, dtype=rhs.dtype)
+    up[:, -1] = 0.
+    lo = np.array(lower, dtype=rhs.dtype)
+    lo[:, 0] = 0.
+    ab[0, 1:] = up.ravel()[:-1]
+    ab[1] = main.ravel()
+    ab[2, :-1] = lo.ravel()[1:]
+    solution = scipy.linalg.solve_banded((1, 1), ab, rhs.ravel(),
+                                         overwrite_ab=True, check_finite=False)
+    return solution.reshape(m, n)
+
+def adi_coefficients(x):
+    """Returns the factors on the fluxes to the lower and upper 
+    neighbors of each inside node for the second derivative on the grid 
+    x, which can be uneven. Both are 1 / dx**2 on an even grid."""
+    h = np.diff(np.array(x, dtype=float))
+    lower = 2. / (h[:-1] * (h[:-1] + h[1:]))
+    upper = 2. / (h[1:] * (h[:-1] + h[1:]))
+    return lower, upper
+
+def adi_sweep(v, axis, r, fin, theta=0.5, log10D_slope=0., 
+              coefficients=None):
+    """One implicit 1D step of the 3D field v along axis with 
+    r = D dt / dx**2 and faces held at fin. The concentration dependence
+    of D is taken from the start of the step. For uneven grids, 
+    r = D dt and coefficients are from adi_coefficients."""
+    u = np.moveaxis(v, axis, -1)[1:-1, 1:-1]
+    lines = u.reshape(-1, u.shape[-1])
+    if coefficients is None:
+        c_lower = c_upper = np.ones(lines.shape[1] - 2)
+    else:
+        c_lower, c_upper = coefficients
+    if log10D_slope != 0.:
+        # same as exponential_D without its derivative
+        d = np.exp((log10D_slope * np.log(10.)) * (lines - 1.))
+        d_face = 0.5 * (d[:, 1:] + d[:, :-1])
+    else:
+        d_face = np.ones((1, lines.shape[1] - 1), dtype=v.dtype)
+    inside = lines[:, 1:-1]
+    flux = d_face * np.diff(lines, axis=1)
+    rhs = inside + (1. - theta) * r * (c_upper * flux[:, 1:] - 
+                                       c_lower * flux[:, :-1])
+    rhs[:, 0] = rhs[:, 0] + theta * r * c_lower[0] * d_face[:, 0] * fin
+    rhs[:, -1] = rhs[:, -1] + theta * r * c_upper[-1] * d_face[:, -1] * fin
+    if log10D_slope != 0.:
+        main = 1. + theta * r * (c_upper * d_face[:, 1:] + 
+                                 c_lower * d_face[:, :-1])
+        lower = -theta * r * c_lower * d_face[:, :-1]
+        upper = -theta * r * c_upper * d_face[:, 1:]
+        new = tridiagonal_sweep(lower, main, upper, rhs)
+    else:
+        # every line has the same matrix, so factor it once for all of them
+        ab = np.empty((3, rhs.shape[1]), dtype=v.dtype)
+        ab[0, 1:] = -theta * r * c_upper[:-1]
+        ab[2, :-1] = -theta * r * c_lower[1:]
+        ab[1] = 1. + theta * r * (c_lower + c_upper)
+        new = scipy.linalg.solve_banded((1, 1), ab, rhs.T, 
+                                        overwrite_b=True,
+                                        check_finite=False).T
+    # u is a view, so this fills in v
+    u[..., 1:-1] = new.reshape(u.shape[:-1] + (u.shape[-1] - 2,))
+    return v
+
+def adi_field(microns3, log10D3, time_seconds, init=1., fin=0., 
+              points='auto', log10D_slope=0., steps=60, dtype='float64', 
+              reaction=None, grid_tolerance=5e-4, max_points=151):
+    """Takes list of three lengths, list of three log10 diffusivities 
+    (at unit concentration 1 if log10D_slope is not 0, as in 
+    diffusion1D_DC_kernel), and time, and returns a GridField for 
+    diffusion with faces held at fin. 
+
+    With points='auto' (default), each direction gets its own uneven 
+    grid from auto_grid, with nodes bunched up where the profile is 
+    steep, to about grid_tolerance and at most max_points nodes per 
+    direction. With constant D, whole-block profiles from the default 
+    grid_tolerance are within about 1e-3 of the separable model. Otherwise the grid is points evenly spaced nodes in each
+    direction. Since the error mostly comes from the grid rather than 
+    the time steps, there is a warning if sqrt(D t) is less than 3 node 
+    spacings at the faces.
+    
+    Time steps get longer as the profiles get less steep. The first two 
+    steps are fully implicit, and the rest are Crank-Nicolson. 
+    Set dtype='float32' to halve the memory. Optionally, 
+    reaction(v, dt_seconds) returns v after reactions during each step.
+    """
+    if time_seconds < 0:
+        print 'no negative time'
+        return
+
+    positions = []
+    weights = None
+    if points == 'auto':
+        weights = []
+        for L, log10D in zip(microns3, log10D3):
+            x = auto_grid(L, log10D, time_seconds, grid_tolerance, 
+                          max_points=max_points) + L / 2.
+            positions.append(x)
+            weights.append(trapezoid_weights(x))
+    else:
+        positions = [np.linspace(0., L, points) for L in microns3]
+
+    D = [10.**log10D for log10D in log10D3]
+    for k in range(3):
+        spacing = (positions[k][1] - positions[k][0]) / 1e6
+        if (D[k] * time_seconds)**0.5 < 3. * spacing:
+            warnings.warn(''.join(('adi_field: sqrt(D t) in direction ', 
+                                   'abc'[k], ' is less than 3 grid ',
+                                   'spacings, so the model is not accurate.',
+                                   " Use points='auto' or more points.")))
+
+    v = np.ones([len(x) for x in positions], dtype=dtype) * init
+    v[0] = v[-1] = fin
+    v[:, 0] = v[:, -1] = fin
+    v[:, :, 0] = v[:, :, -1] = fin
+
+    coefficients = [adi_coefficients(x / 1e6) for x in positions]
+    times = time_seconds * (np.arange(steps + 1.) / steps)**2
+    for step in range(steps):
+        dt = times[step+1] - times[step]
+        if step < 2:
+            theta = 1.
+        else:
+            theta = 0.5
+        for k in range(3):
+            r = np.array(D[k] * dt, dtype=dtype)
+            v = adi_sweep(v, k, r, fin, theta, log10D_slope, 
+                          coefficients[k])
+        if reaction is not None:
+            v = reaction(v, dt)
+
+    return GridField(v, positions, weights)
+
+def diffusion3Dadi_kernel(microns3, log10D3, time_seconds, raypaths, init=1.,
+                          fin=0., points='auto', log10D_slope=0., steps=60,
+                          dtype='float64', reaction=None, 
+                          grid_tolerance=5e-4, max_points=151):
+    """Same as diffusion3Dwb_kernel but with the ADI finite-difference 
+    field from adi_field. Returns positions starting at 0 and whole-block 
+    profiles, one of each per direction."""
+    field = adi_field(microns3, log10D3, time_seconds, init, fin, points,
+                      log10D_slope, steps, dtype, reaction, grid_tolerance,
+                      max_points)
+    if field is None:
+        return
+    wb_profiles = wholeblock_profiles(field, raypaths)
+    if wb_profiles is None:
+        return
+    return field.positions_microns, wb_profiles
+
+def diffusion3Dadi_params(params, data_x_microns=None, data_y_unit_areas=None,
+                          raypaths=None, need_to_center_x_data=True, 
+                          points='auto', steps=60, dtype='float64', 
+                          reaction=None, show_plot=False, fig_ax=None, 
+                          style=None, grid_tolerance=5e-4, max_points=151):
+    """Whole-block diffusion like diffusion3Dwb_params, but with the ADI
+    finite-difference model, so D can depend on concentration through 
+    the optional parameter log10D_slope. The model is interpolated to 
+    the data positions for the residuals."""
+    if raypaths is None:
+        print 'raypaths must be in the form of a list of three abc directions'
+        return
+    p = params.valuesdict()
+    L3 = p['microns3']
+    log10D3 = [p['log10Dx'], p['log10Dy'], p['log10Dz']]
+    wb = diffusion3Dadi_kernel(L3, log10D3, p['time_seconds'], raypaths, 
+                               p['initial_unit_value'], p['final_unit_value'],
+                               points, p.get('log10D_slope', 0.), steps, 
+                               dtype, reaction, grid_tolerance, max_points)
+    if wb is None:
+        return
+    wb_positions, wb_profiles = wb
+
+    if show_plot is True:
+        if style is None:
+            style = [styles.style_lightgreen] * 3
+        if fig_ax is None:
+            f, fig_ax = styles.plot_3panels(wb_positions, wb_profiles, L3, style)
+        else:
+            styles.plot_3panels(wb_positions, wb_profiles, L3, style, 
+                         figaxis3=fig_ax)
+
+    if (data_x_microns is None) or (data_y_unit_areas is None):
+        return wb_positions, wb_profiles
+
+    residuals = []
+    for k in range(3):
+        # wb_positions start at 0; data may be centered
+        x = np.array(data_x_microns[k], dtype=float)
+        if need_to_center_x_data is False:
+            x = x + L3[k] / 2.
+        model = np.interp(x, wb_positions[k], wb_profiles[k])
+        residuals.append(model - np.array(data_y_unit_areas[k]))
+    return np.concatenate(residuals)
+
         
+#%% Grid search for starting diffusivities
+#
+# Starting leastsq far from the answer costs iterations and can end on the
+# wrong branch, so the RSS is first calculated over a whole grid of log10D
+# in one broadcast calculation with the erf models at the data positions.
+# The best grid cell then seeds the fit, and the surface is kept for
+# checking how well determined the diffusivities are.
+#
+def rss_grid1D(x_microns, y, microns, time_seconds, log10D_grid=None,
+               init=1., fin=0., vary_init=False, need_to_center_x_data=True):
+    """Takes 1D data and returns the log10D grid (default -18 to -8 in
+    steps of 0.02), the residual sum of squares of the erf model at each 
+    log10D, and the initial unit value used at each. With vary_init=True, 
+    each log10D gets its own best initial value, which is linear in the 
+    model and so solved directly."""
+    if log10D_grid is None:
+        log10D_grid = np.arange(-18., -7.99, 0.02)
+    log10D_grid = np.array(log10D_grid, dtype=float)
+    x = np.array(x_microns, dtype=float)
+    if need_to_center_x_data is True:
+        x = x - microns / 2.
+    y = np.array(y, dtype=float)
+    D = 10.**log10D_grid[:, None]
+    E = erf_unit_profile(x[None, :] / 1e6, microns / 2e6, D, time_seconds)
+
+    # model = fin + E * (init - fin)
+    if vary_init is True:
+        EE = np.sum(E**2, axis=1)
+        EE[EE == 0.] = np.inf
+        inits = fin + np.sum(E * (y - fin), axis=1) / EE
+    else:
+        inits = np.ones(len(log10D_grid)) * init
+    model = fin + E * (inits[:, None] - fin)
+    RSS = np.sum((model - y)**2, axis=1)
+    return log10D_grid, RSS, inits
+
+def rss_grid3D(x, y, microns3, time_seconds, raypaths=None, 
+               log10D_grid=None, init=1., fin=0., centered=True):
+    """Takes the lists of three x and y data sets and returns the log10D
+    grid (default -16 to -9 in steps of 0.2) and the 3D array of the 
+    residual sum of squares with RSS[i, j, k] for log10Dx = log10D_grid[i],
+    log10Dy = log10D_grid[j], and log10Dz = log10D_grid[k]. Uses the 
+    separable erf model at the data positions, whole-block with raypaths 
+    or non-path-integrated without."""
+    if log10D_grid is None:
+        log10D_grid = np.arange(-16., -8.99, 0.2)
+    log10D_grid = np.array(log10D_grid, dtype=float)
+    n = len(log10D_grid)
+    a_meters = np.array(microns3, dtype=float) / 2.E6
+    D = 10.**log10D_grid
+    t = time_seconds
+    scale, going_out, minimum_value, init1D, fin1D = unit_values_3D(init, 
+                                                                     fin)
+
+    RSS = np.zeros((n, n, n))
+    for k in range(3):
+        ray = None
+        if raypaths is not None:
+            ray = 'abc'.find(raypaths[k])
+            if ray < 0 or ray == k:
+                print ''.join(('raypaths[', str(k), '] for profile || ', 
+                               'abc'[k], 
+                               ' must be one of the other two directions'))
+                return
+        xk = np.array(x[k], dtype=float) / 1E6
+        if centered is False:
+            xk = xk - a_meters[k]
+
+        # one factor per direction, with its log10D along that axis
+        product = 1.
+        for j in range(3):
+            if j == k:
+                E = erf_unit_profile(xk[None, :], a_meters[k], D[:, None], t)
+            elif j == ray:
+                E = erf_unit_mean(a_meters[j], D, t)[:, None]
+            else:
+                E = erf_unit_profile(0., a_meters[j], D, t)[:, None]
+            shape = [1, 1, 1, E.shape[1]]
+            shape[j] = n
+            product = product * (fin1D + (init1D - fin1D) * E.reshape(shape))
+        model = separable_concentration(product, scale, going_out,
+                                        minimum_value)
+        RSS = RSS + np.sum((model - np.array(y[k], dtype=float))**2, axis=3)
+    return log10D_grid, RSS
+
+#%% Fitting 3D diffusion to data
+def fit_diffusion3D(x, y, microns3, time_seconds, raypaths=None,
+                    guesses_log10D=None, init=1., fin=0.,
+                    vary_initials=False, vary_finals=False,
+                    vary_diffusivities=[True, True, True], erf_or_sum='erf',
+                    wb_or_3Dnpi='wb', points=50, exact_positions=True,
+                    adi_kws=None, full_output=False):
+    """Fits whole-block (wb_or_3Dnpi='wb', needs raypaths) or 
+    non-path-integrated (wb_or_3Dnpi='npi') 3D diffusion to the lists of 
+    three x and y data sets with x centered on 0.
+    wb_or_3Dnpi='adi' fits whole-block data with the finite-difference
+    model in diffusion3Dadi_params, with its extra keywords in the 
+    dictionary adi_kws. Including log10D_slope there fits the 
+    concentration dependence of D starting from that value. The adi grid
+    is set by points in adi_kws, which defaults to 'auto'.
+    This is the fitting step of WholeBlock.fitD without the plotting.
+    Without guesses_log10D, the fit starts from the best cell of 
+    rss_grid3D.
+    Returns the best-fit lmfit parameters and the residuals, and with 
+    full_output=True also whether lmfit reports success (False if, e.g., 
+    it stopped at the maximum number of function evaluations).
+    """
+    if guesses_log10D is None:
+        if wb_or_3Dnpi == 'npi':
+            grid = rss_grid3D(x, y, microns3, time_seconds, None, init=init, 
+                              fin=fin)
+        else:
+            grid = rss_grid3D(x, y, microns3, time_seconds, raypaths, 
+                              init=init, fin=fin)
+        if grid is None:
+            return
+        log10D_grid, RSS = grid
+        best = np.unravel_index(np.nanargmin(RSS), RSS.shape)
+        guesses_log10D = [log10D_grid[i] for i in best]
+
+    params = params_setup3D(microns3=microns3, log10D3=guesses_log10D, 
+                            time_seconds=time_seconds, 
+                            initial=init, final=fin,
+                            vinit=vary_initials, vfin=vary_finals,
+                            vD=vary_diffusivities)
+
+    # other keywords needed for forward model
+    dict_fitting = {'points' : points,
+                    'erf_or_sum' : erf_or_sum} 
+
+    # analytic derivatives for the minimizer; these follow the erf model,
+    # which the master curve matches closely enough
+    dict_derivatives = {}
+
+    if wb_or_3Dnpi == 'wb':
+        # don't plot, and x data are already centered
+        dict_fitting['raypaths'] = raypaths
+        dict_fitting['show_plot'] = False
+        dict_fitting['exact_positions'] = exact_positions
+        dict_fitting['need_to_center_x_data'] = False
+        if erf_or_sum in ['erf', 'master']:
+            dict_derivatives['Dfun'] = diffusion3Dwb_jacobian
+            dict_derivatives['col_deriv'] = 1
+        model = diffusion3Dwb_params
+    elif wb_or_3Dnpi == 'npi':
+        # npi model is evaluated at the centered data positions
+        if erf_or_sum in ['erf', 'master']:
+            dict_derivatives['Dfun'] = diffusion3Dnpi_jacobian
+            dict_derivatives['col_deriv'] = 1
+        model = diffusion3Dnpi_params
+    elif wb_or_3Dnpi == 'adi':
+        adi_kws = dict(adi_kws or {})
+        if 'log10D_slope' in adi_kws:
+            params.add('log10D_slope', adi_kws.pop('log10D_slope'))
+        dict_fitting = {'raypaths' : raypaths,
+                        'need_to_center_x_data' : False}
+        dict_fitting.update(adi_kws)
+        model = diffusion3Dadi_params
+    else:
+        print 'wb_or_3Dnpi can only be wb, npi, or adi'
+        return
+
+    fitter = lmfit.minimize(model, params, args=(x, y), kws=dict_fitting, 
+                            **dict_derivatives)
+    resid = model(params, x, y, **dict_fitting)
+    if full_output is True:
+        return params, resid, fitter.success
+    return params, resid
+
+def fit_diffusion3D_unit(unit):
+    """Takes a dictionary with a 'key' and keywords for fit_diffusion3D and
+    returns the key and a dictionary of the best-fit log10D3, errors3, 
+    initial, initial_error, RSS, and success from lmfit (or None if the 
+    fit did not run).
+    Everything in and out can be pickled, so this is what 
+    WholeBlock.fitD_sweep sends to each worker process."""
+    kwargs = dict(unit)
+    key = kwargs.pop('key')
+    kwargs['full_output'] = True
+    fit = fit_diffusion3D(**kwargs)
+    if fit is None:
+        return key, None
+    params, resid, success = fit
+    # stderr is None if lmfit could not estimate it
+    errors = {}
+    for name in ['log10Dx', 'log10Dy', 'log10Dz', 'initial_unit_value']:
+        errors[name] = params[name].stderr
+        if errors[name] is None:
+            errors[name] = np.nan
+    result = {'log10D3' : [params['log10Dx'].value, params['log10Dy'].value, 
+                           params['log10Dz'].value],
+              'errors3' : [errors['log10Dx'], errors['log10Dy'], 
+                           errors['log10Dz']],
+              'initial' : params['initial_unit_value'].value,
+              'initial_error' : errors['initial_unit_value'],
+              'RSS' : np.sum(np.array(resid)**2.),
+              'success' : bool(success)}
+    return key, result
+
+#%% Monte Carlo ensembles for uncertainty in fitted diffusivities
+#
+# lmfit's stderr only reflects the scatter of the data about the best fit.
+# The thickness, the baseline under each spectrum, and the positions are
+# uncertain too, so here every one of them is drawn N times at once as
+# arrays of perturbed data sets, each data set is refit, and the spread in
+# the best-fit values is the uncertainty. All of the draws are made up 
+# front from one seed, so the results do not depend on how the fits are
+# split up between processes.
+#
+def ensemble_percentiles(samples, percentiles=(2.5, 16., 50., 84., 97.5)):
+    """Takes an array of samples (one row per realization) and returns the
+    percentiles of each column ignoring nan, one row per percentile."""
+    samples = np.array(samples, dtype=float)
+    if np.all(np.isnan(samples)):
+        return np.nan * np.ones((len(percentiles),) + samples.shape[1:])
+    return np.nanpercentile(samples, percentiles, axis=0)
+
+def perturbed_values(values, N, sigma=0., relative=False, random_state=None):
+    """Returns an N x len(values) array of values plus normally distributed
+    noise with standard deviation sigma, which can be one number or one 
+    per value. With relative=True, sigma is a fraction of each value."""
+    if random_state is None:
+        random_state = np.random.RandomState()
+    values = np.array(values, dtype=float)
+    sigma = np.ones_like(values) * np.array(sigma, dtype=float)
+    if relative is True:
+        sigma = sigma * np.abs(values)
+    noise = random_state.standard_normal((N,) + values.shape)
+    return values + noise * sigma
+
+def fit_diffusion1D_batch_unit(unit):
+    """Takes a dictionary of keywords for fit_diffusion1D_batch and 
+    returns the fit. For sending chunks of an ensemble to worker 
+    processes."""
+    return fit_diffusion1D_batch(**unit)
+
+def fit_diffusion1D_ensemble(x_microns, y, microns, time_seconds, N=2000,
+                             sigma_x_microns=0., sigma_length_microns=0.,
+                             sigma_y=0., relative_y=True, 
+                             log10D_guess=None, init_guess=1., fin=0.,
+                             vary_init=True, need_to_center_x_data=True,
+                             percentiles=(2.5, 16., 50., 84., 97.5),
+                             processes=1, chunk=1000, seed=None):
+    """Monte Carlo uncertainty for a 1D erf diffusion fit.
+
+    Makes N copies of the data with normally distributed errors added to 
+    the positions (sigma_x_microns), to the length (sigma_length_microns,
+    one draw per realization, which also moves the center of the profile),
+    and to the y data (sigma_y, a fraction of each value if relative_y is 
+    True; one number or one per point), and refits every one of them with 
+    fit_diffusion1D_batch. The realizations are fit in chunks of up to 
+    chunk at a time, spread over a pool of processes if processes is not 
+    1 (None for one per core).
+
+    Without log10D_guess, every fit starts from the best of rss_grid1D on
+    the original data.
+
+    Returns a dictionary with the arrays log10D, initial, RSS, and 
+    converged with one value per realization, percentiles, and
+    log10D_percentiles and initial_percentiles, which are from the 
+    converged fits only.
+    """
+    x = np.array(x_microns, dtype=float)
+    y = np.array(y, dtype=float)
+    if log10D_guess is None:
+        log10D_grid, RSS, inits = rss_grid1D(x, y, microns, time_seconds, 
+                                             init=init_guess, fin=fin, 
+                                             vary_init=vary_init, 
+                                  need_to_center_x_data=need_to_center_x_data)
+        best = np.nanargmin(RSS)
+        log10D_guess = log10D_grid[best]
+        init_guess = inits[best]
+
+    random_state = np.random.RandomState(seed)
+    X = perturbed_values(x, N, sigma_x_microns, random_state=random_state)
+    lengths = perturbed_values([microns], N, sigma_length_microns, 
+                               random_state=random_state)[:, 0]
+    Y = perturbed_values(y, N, sigma_y, relative_y, random_state)
+
+    units = []
+    for start in range(0, N, chunk):
+        stop = min(start + chunk, N)
+        units.append({'x_list_microns' : X[start:stop],
+                      'y_list_unit_areas' : Y[start:stop],
+                      'lengths_microns' : lengths[start:stop],
+                      'times_seconds' : time_seconds,
+                      'log10D_guess' : log10D_guess,
+                      'init_guess' : init_guess,
+                      'fin' : fin,
+                      'vary_init' : vary_init,
+                      'need_to_center_x_data' : need_to_center_x_data})
+
+    if processes == 1 or len(units) == 1:
+        fits = map(fit_diffusion1D_batch_unit, units)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            fits = pool.map(fit_diffusion1D_batch_unit, units, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    results = {}
+    for key in ['log10D', 'initial', 'RSS', 'converged']:
+        results[key] = np.concatenate([fit[key] for fit in fits])
+    good = results['converged']
+    results['percentiles'] = np.array(percentiles, dtype=float)
+    results['log10D_percentiles'] = ensemble_percentiles(
+                                    results['log10D'][good], percentiles)
+    results['initial_percentiles'] = ensemble_percentiles(
+                                     results['initial'][good], percentiles)
+    return results
+
+def fit_diffusion3D_ensemble(x, y, microns3, time_seconds, raypaths=None,
+                             N=200, sigma_x_microns=0., 
+                             sigma_lengths_microns=[0., 0., 0.],
+                             sigma_y=0., relative_y=True, 
+                             guesses_log10D=None, init=1., fin=0.,
+                             vary_initials=False, 
+                             vary_diffusivities=[True, True, True],
+                             wb_or_3Dnpi='wb', erf_or_sum='erf', points=50,
+                             percentiles=(2.5, 16., 50., 84., 97.5),
+                             processes=1, seed=None):
+    """Monte Carlo uncertainty for fit_diffusion3D.
+
+    Makes N copies of the three centered x and y data sets with normally 
+    distributed errors added to the positions (sigma_x_microns), to each 
+    of the three lengths (sigma_lengths_microns), and to the y data 
+    (sigma_y, a fraction of each value if relative_y is True; one number 
+    for everything or a list of three, each one number or one per point). 
+    The lengths only change the size of the block, so the centered
+    positions stay centered.
+    Each realization is fit on its own with fit_diffusion3D_unit and its 
+    analytic derivatives, over a pool of processes if processes is more 
+    than 1 (None for one per core). With a pool on Windows, call this 
+    from under if __name__ == '__main__'.
+
+    Without guesses_log10D, every fit starts from the best cell of 
+    rss_grid3D on the original data.
+
+    Returns a dictionary with log10D3 (N x 3), initial, RSS, and converged 
+    (lmfit reported success) for every realization, percentiles, and 
+    log10D3_percentiles (one row per percentile) and initial_percentiles 
+    from the converged fits only.
+    """
+    if guesses_log10D is None:
+        if wb_or_3Dnpi == 'npi':
+            grid = rss_grid3D(x, y, microns3, time_seconds, None, init=init, 
+                              fin=fin)
+        else:
+            grid = rss_grid3D(x, y, microns3, time_seconds, raypaths, 
+                              init=init, fin=fin)
+        if grid is None:
+            return
+        log10D_grid, RSS = grid
+        best = np.unravel_index(np.nanargmin(RSS), RSS.shape)
+        guesses_log10D = [log10D_grid[i] for i in best]
+
+    if np.ndim(sigma_y) == 0:
+        sigma_y = [sigma_y, sigma_y, sigma_y]
+
+    random_state = np.random.RandomState(seed)
+    lengths = perturbed_values(microns3, N, sigma_lengths_microns, 
+                               random_state=random_state)
+    X = []
+    Y = []
+    for k in range(3):
+        X.append(perturbed_values(x[k], N, sigma_x_microns, 
+                                  random_state=random_state))
+        Y.append(perturbed_values(y[k], N, sigma_y[k], relative_y, 
+                                  random_state))
+
+    units = []
+    for n in range(N):
+        units.append({'key' : n,
+                      'x' : [X[k][n] for k in range(3)],
+                      'y' : [Y[k][n] for k in range(3)],
+                      'microns3' : list(lengths[n]),
+                      'time_seconds' : time_seconds,
+                      'raypaths' : raypaths,
+                      'guesses_log10D' : guesses_log10D,
+                      'init' : init,
+                      'fin' : fin,
+                      'vary_initials' : vary_initials,
+                      'vary_diffusivities' : vary_diffusivities,
+                      'erf_or_sum' : erf_or_sum,
+                      'wb_or_3Dnpi' : wb_or_3Dnpi,
+                      'points' : points})
+
+    if processes == 1:
+        fits = map(fit_diffusion3D_unit, units)
+    else:
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes)
+        try:
+            fits = pool.map(fit_diffusion3D_unit, units, 
+                            chunksize=max(1, N // (4 * processes)))
+        finally:
+            pool.close()
+            pool.join()
+
+    log10D3 = np.nan * np.ones((N, 3))
+    initial = np.nan * np.ones(N)
+    RSS = np.nan * np.ones(N)
+    success = np.zeros(N, dtype=bool)
+    for n, result in fits:
+        if result is None:
+            continue
+        log10D3[n] = result['log10D3']
+        initial[n] = result['initial']
+        RSS[n] = result['RSS']
+        success[n] = result['success']
+    converged = (success & np.all(np.isfinite(log10D3), axis=1) & 
+                 np.isfinite(RSS))
+    results = {'log10D3' : log10D3,
+               'initial' : initial,
+               'RSS' : RSS,
+               'converged' : converged,
+               'percentiles' : np.array(percentiles, dtype=float),
+               'log10D3_percentiles' : ensemble_percentiles(
+                                       log10D3[converged], percentiles),
+               'initial_percentiles' : ensemble_percentiles(
+                                       initial[converged], percentiles)}
+    return results
+
+#%% Posterior sampling with an affine-invariant ensemble sampler
+#
+# The stretch move of Goodman and Weare (2010), as in emcee: the walkers 
+# are split in two halves, and each walker in one half proposes a jump 
+# along the line to a random walker in the other half. Each half is one 
+# batch, so the log-probability takes an array of parameter sets and the 
+# whole-block models are made for all of them at once.
+#
+def diffusion3Dwb_batch(x, microns3, log10D3, time_seconds, raypaths=None,
+                        init=1., fin=0.):
+    """Separable erf whole-block (or non-path-integrated if raypaths is 
+    None) models at the centered positions in the list of three x for 
+    many parameter sets at once. log10D3 is an array with one row of 
+    log10Dx, log10Dy, log10Dz per set, and init and fin can be one value 
+    or one per set. Returns a list of three 2D arrays with one row per set.
+    """
+    log10D3 = np.atleast_2d(np.array(log10D3, dtype=float))
+    nsets = len(log10D3)
+    D = 10.**log10D3
+    a_meters = np.array(microns3, dtype=float) / 2.E6
+    t = time_seconds
+
+    # unit_values_3D for every set at once
+    init = np.ones(nsets) * init
+    fin = np.ones(nsets) * fin
+    scale = np.where(init > 1., init, 1.)
+    init = np.minimum(init, 1.)
+    going_out = init >= fin
+    minimum_value = np.minimum(init, fin)
+    init1D = np.where(going_out, init, fin)[:, None]
+    fin1D = np.where(going_out, fin, init)[:, None]
+
+    models = []
+    for k in range(3):
+        ray = None
+        if raypaths is not None:
+            ray = 'abc'.find(raypaths[k])
+            if ray < 0 or ray == k:
+                print ''.join(('raypaths[', str(k), '] for profile || ', 
+                               'abc'[k], 
+                               ' must be one of the other two directions'))
+                return
+        xk = np.array(x[k], dtype=float)[None, :] / 1E6
+        product = 1.
+        for j in range(3):
+            if j == k:
+                E = erf_unit_profile(xk, a_meters[k], D[:, j:j+1], t)
+            elif j == ray:
+                E = erf_unit_mean(a_meters[j], D[:, j], t)[:, None]
+            else:
+                E = erf_unit_profile(0., a_meters[j], D[:, j], t)[:, None]
+            product = product * (fin1D + (init1D - fin1D) * E)
+        v = product * scale[:, None]
+        v = np.where(going_out[:, None], v, 1. - v + minimum_value[:, None])
+        models.append(v)
+    return models
+
+def diffusion3Dwb_log_probability(theta, x, y, microns3, time_seconds, 
+                                  raypaths=None, bounds=None, sigma_y=None,
+                                  vary_initial=False, init=1., fin=0.):
+    """Log posterior probability for each row of theta: log10Dx, log10Dy,
+    log10Dz, then the initial unit value if vary_initial is True, then 
+    log10 of the data uncertainty if sigma_y is None. 
+    The priors are uniform between the (low, high) bounds, one pair per 
+    column of theta. The likelihood is normal with standard deviation 
+    sigma_y for every point in the three profiles of y.
+    """
+    theta = np.atleast_2d(np.array(theta, dtype=float))
+    lnp = -np.inf * np.ones(len(theta))
+    inside = np.ones(len(theta), dtype=bool)
+    if bounds is not None:
+        for column, (low, high) in enumerate(bounds):
+            inside = (inside & (theta[:, column] >= low) & 
+                      (theta[:, column] <= high))
+    if not np.any(inside):
+        return lnp
+    theta = theta[inside]
+
+    column = 3
+    if vary_initial is True:
+        init = theta[:, column]
+        column = column + 1
+    if sigma_y is None:
+        sigma = 10.**theta[:, column][:, None]
+    else:
+        sigma = sigma_y
+
+    models = diffusion3Dwb_batch(x, microns3, theta[:, :3], time_seconds,
+                                 raypaths, init, fin)
+    lnL = 0.
+    for k in range(3):
+        r = (models[k] - np.array(y[k], dtype=float)[None, :]) / sigma
+        lnL = lnL - 0.5 * np.sum(r**2 + 2. * np.log(sigma) * 
+                                 np.ones_like(r), axis=1)
+    lnp[inside] = lnL
+    return lnp
+
+def batch_log_probability_unit(unit):
+    """Takes a tuple of (log-probability function, array of parameter 
+    sets, dictionary of keywords) and returns the log-probability of each
+    set. For sending chunks of walkers to worker processes."""
+    log_probability, theta, kwargs = unit
+    return log_probability(theta, **kwargs)
+
+def save_sampler_checkpoint(checkpoint, chain, lnprob, accepted, 
+                            random_state):
+    """Save the sampler chain so far and the random state to the .npz
+    file checkpoint, writing a new file first so an interrupted save 
+    leaves the last checkpoint alone."""
+    state = random_state.get_state()
+    temporary = checkpoint + '.partial'
+    with open(temporary, 'wb') as checkpoint_file:
+        np.savez(checkpoint_file, chain=chain, log_probability=lnprob,
+                 accepted=accepted, state_keys=state[1], 
+                 state_position=state[2], state_has_gauss=state[3],
+                 state_cached_gaussian=state[4])
+    if os.path.exists(checkpoint) and os.name == 'nt':
+        os.remove(checkpoint)
+    os.rename(temporary, checkpoint)
+
+def load_sampler_checkpoint(checkpoint):
+    """Returns the chain, log probabilities, accepted counts, and a 
+    RandomState in the saved state from a save_sampler_checkpoint file."""
+    with np.load(checkpoint) as saved:
+        chain = saved['chain']
+        lnprob = saved['log_probability']
+        accepted = saved['accepted']
+        state = ('MT19937', saved['state_keys'], 
+                 int(saved['state_position']), 
+                 int(saved['state_has_gauss']),
+                 float(saved['state_cached_gaussian']))
+    random_state = np.random.RandomState()
+    random_state.set_state(state)
+    return chain, lnprob, accepted, random_state
+
+def ensemble_sampler(log_probability, start, steps=2000, kwargs=None,
+                     stretch=2., processes=1, checkpoint=None, 
+                     checkpoint_every=100, seed=None):
+    """Affine-invariant ensemble MCMC sampler (stretch move).
+    
+    log_probability(theta, **kwargs) takes a 2D array with one parameter 
+    set per row and returns their log posterior probabilities. It has to 
+    be a module-level function to use a pool of processes 
+    (processes=None for one per core), which splits each batch of walkers 
+    between them. start has one row per walker, at least two per 
+    parameter and an even number of them.
+
+    With a checkpoint file name, the chain is saved there every 
+    checkpoint_every steps and at the end. If that file already exists, 
+    the run picks up where it left off and continues to steps in total,
+    as long as it has the same number of walkers and parameters as start.
+
+    Returns the chain (steps x walkers x parameters), the log 
+    probabilities (steps x walkers), and the fraction of proposals 
+    accepted for each walker.
+    """
+    if kwargs is None:
+        kwargs = {}
+    start = np.array(start, dtype=float)
+    nwalkers, ndim = start.shape
+    if nwalkers < 2 * ndim or nwalkers % 2 != 0:
+        print 'Need an even number of walkers and at least 2 per parameter'
+        return
+
+    pool = None
+    if processes != 1:
+        pool = multiprocessing.Pool(processes)
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+
+    def batch(theta):
+        if pool is None:
+            return log_probability(theta, **kwargs)
+        units = [(log_probability, chunk, kwargs) for chunk in 
+                 np.array_split(theta, processes) if len(chunk) > 0]
+        return np.concatenate(pool.map(batch_log_probability_unit, units))
+
+    try:
+        if checkpoint is not None and os.path.exists(checkpoint):
+            saved_chain, saved_lnprob, accepted, random_state = \
+                load_sampler_checkpoint(checkpoint)
+            if saved_chain.shape[1:] != start.shape:
+                print ''.join(('Checkpoint ', checkpoint, ' has ', 
+                               str(saved_chain.shape[1]), ' walkers and ',
+                               str(saved_chain.shape[2]), 
+                               ' parameters, but start has ', 
+                               str(nwalkers), ' and ', str(ndim), 
+                               '. Use a different checkpoint file.'))
+                return
+            done = len(saved_chain)
+            print 'Resuming from', checkpoint, 'after', done, 'steps'
+            chain = np.zeros((max(steps, done), nwalkers, ndim))
+            lnprob = np.zeros((max(steps, done), nwalkers))
+            chain[:done] = saved_chain
+            lnprob[:done] = saved_lnprob
+            position = saved_chain[-1].copy()
+            current = saved_lnprob[-1].copy()
+        else:
+            random_state = np.random.RandomState(seed)
+            done = 0
+            chain = np.zeros((steps, nwalkers, ndim))
+            lnprob = np.zeros((steps, nwalkers))
+            accepted = np.zeros(nwalkers)
+            position = start.copy()
+            current = batch(position)
+
+        halves = [np.arange(0, nwalkers // 2), 
+                  np.arange(nwalkers // 2, nwalkers)]
+        for step in range(done, steps):
+            for half, other in [halves, halves[::-1]]:
+                z = ((stretch - 1.) * random_state.rand(len(half)) + 1.)**2 
+                z = z / stretch
+                partners = position[other[random_state.randint(len(other),
+                                                         size=len(half))]]
+                proposal = partners + z[:, None] * (position[half] - partners)
+                new = batch(proposal)
+                lnq = (ndim - 1.) * np.log(z) + new - current[half]
+                accept = np.log(random_state.rand(len(half))) < lnq
+                position[half[accept]] = proposal[accept]
+                current[half[accept]] = new[accept]
+                accepted[half[accept]] += 1
+            chain[step] = position
+            lnprob[step] = current
+            if (checkpoint is not None and 
+                ((step + 1) % checkpoint_every == 0 or step + 1 == steps)):
+                save_sampler_checkpoint(checkpoint, chain[:step+1], 
+                                        lnprob[:step+1], accepted, 
+                                        random_state)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    acceptance_fraction = accepted / float(max(len(chain), 1))
+    return chain, lnprob, acceptance_fraction
+
+def sample_diffusion3D(x, y, microns3, time_seconds, raypaths=None, 
+                       start=None, walkers=32, steps=2000, burn=None,
+                       bounds=None, sigma_y=None, vary_initial=False, 
+                       init=1., fin=0., start_spread=0.01, processes=1,
+                       checkpoint=None, checkpoint_every=100, seed=None,
+                       percentiles=(2.5, 16., 50., 84., 97.5)):
+    """Posterior distributions of log10Dx, log10Dy, and log10Dz from 
+    whole-block data (centered x and y lists of three as for 
+    fit_diffusion3D) with ensemble_sampler and the separable erf model. 
+    raypaths=None samples the non-path-integrated model instead.
+
+    The initial unit value is sampled too if vary_initial is True. With
+    sigma_y None, the data uncertainty is unknown and log10 of it is 
+    sampled as well. The priors are uniform within bounds, a dictionary 
+    of (low, high) by parameter name: log10Dx, log10Dy, log10Dz (default 
+    -18 to -8), initial_unit_value (0 to 5), and log10_sigma (-5 to 1).
+    Without start values, the walkers start around the best cell of 
+    rss_grid3D, spread by start_spread.
+
+    Returns a dictionary with names, chain, log_probability, 
+    acceptance_fraction, burn (default half of the steps), percentiles,
+    and posterior_percentiles (one row per percentile and one column per
+    name) from the chain after burn.
+    """
+    names = ['log10Dx', 'log10Dy', 'log10Dz']
+    if vary_initial is True:
+        names.append('initial_unit_value')
+    if sigma_y is None:
+        names.append('log10_sigma')
+
+    default_bounds = {'log10Dx' : (-18., -8.), 'log10Dy' : (-18., -8.),
+                      'log10Dz' : (-18., -8.), 
+                      'initial_unit_value' : (0., 5.),
+                      'log10_sigma' : (-5., 1.)}
+    if bounds is not None:
+        default_bounds.update(bounds)
+    bounds = [default_bounds[name] for name in names]
+
+    if start is None:
+        grid = rss_grid3D(x, y, microns3, time_seconds, raypaths, init=init,
+                          fin=fin)
+        if grid is None:
+            return
+        log10D_grid, RSS = grid
+        best = np.unravel_index(np.nanargmin(RSS), RSS.shape)
+        start = [log10D_grid[i] for i in best]
+        if vary_initial is True:
+            start.append(init)
+        if sigma_y is None:
+            npoints = sum([len(yk) for yk in y])
+            start.append(np.log10((np.nanmin(RSS) / npoints)**0.5))
+    start = np.array(start, dtype=float)
+    if np.ndim(start) == 1:
+        random_state = np.random.RandomState(seed)
+        start = (start[None, :] + start_spread * 
+                 random_state.standard_normal((walkers, len(names))))
+    for column, (low, high) in enumerate(bounds):
+        start[:, column] = np.clip(start[:, column], low, high)
+
+    kwargs = {'x' : x, 'y' : y, 'microns3' : microns3, 
+              'time_seconds' : time_seconds, 'raypaths' : raypaths,
+              'bounds' : bounds, 'sigma_y' : sigma_y, 
+              'vary_initial' : vary_initial, 'init' : init, 'fin' : fin}
+    sampled = ensemble_sampler(diffusion3Dwb_log_probability, start, steps,
+                               kwargs, processes=processes, 
+                               checkpoint=checkpoint,
+                               checkpoint_every=checkpoint_every, seed=seed)
+    if sampled is None:
+        return
+    chain, lnprob, acceptance_fraction = sampled
+    if burn is None:
+        burn = len(chain) // 2
+    flat = chain[burn:].reshape(-1, len(names))
+    results = {'names' : names,
+               'chain' : chain,
+               'log_probability' : lnprob,
+               'acceptance_fraction' : acceptance_fraction,
+               'burn' : burn,
+               'percentiles' : np.array(percentiles, dtype=float),
+               'posterior_percentiles' : ensemble_percentiles(flat, 
+                                                              percentiles)}
+    return results
+
 #%% Arrhenius diagram
 def Arrhenius_outline(low=6., high=11., bottom=-18., top=-8.,
                       celsius_labels = np.arange(0, 2000, 100),
@@ -693,6 +3064,175 @@ def whatIsD(Ea, D0, celsius, printout=True):
         print 'log10 D at ', celsius, 'C: ', '{:.1f}'.format(np.log10(D)), ' in m2/s'
     return np.log10(D)
 
+#%% Arrhenius fit straight to whole-block profiles at many temperatures
+#
+# Instead of fitting each whole-block on its own and then a line through
+# the diffusivities, Ea and D0 in each direction are fit to all of the 
+# data together. Each experiment only depends on the 6 Arrhenius 
+# parameters and its own initial value, so the Jacobian is mostly empty 
+# and is passed to least_squares as a sparse matrix.
+#
+# Ea and log10D0 are strongly correlated, so the fit itself uses Ea and
+# log10D at a reference temperature in the middle of the data, and log10D0 
+# and its error come from those at the end.
+#
+def arrhenius_log10D(Ea_kJmol, log10D_reference, celsius, reference_kelvin):
+    """log10D in m2/s at temperature celsius from the activation energy 
+    and the log10D at reference_kelvin."""
+    T = np.array(celsius, dtype=float) + 273.15
+    return (log10D_reference - Ea_kJmol * (1. / T - 1. / reference_kelvin) /
+            (np.log(10.) * GAS_CONSTANT))
+
+def fit_arrhenius3D(experiments, Ea_guesses=None, log10D0_guesses=None,
+                    vary_initials=False, fin=0., max_evaluations=None,
+                    tolerance=1e-10):
+    """Fits Ea and D0 for diffusion || x, y, and z directly to whole-block
+    profiles from experiments at several temperatures.
+
+    experiments is a list of dictionaries, one per whole-block, with the
+    keys x and y (lists of three centered profiles as for 
+    fit_diffusion3D), microns3, time_seconds, celsius, raypaths (None for 
+    non-path-integrated data), and optionally init (default 1). 
+    With vary_initials=True, every experiment gets its own initial value.
+    
+    Without guesses, each experiment starts with the best cell of its own 
+    rss_grid3D, and a line through those gives the starting Ea and log10D0.
+
+    Returns a dictionary with Ea_kJmol and log10D0 (lists of ufloats, one 
+    per direction), initials (one per experiment), log10D3 (each 
+    experiment's best-fit diffusivities), residuals (one array per 
+    experiment, all three profiles end to end), RSS, and success.
+    """
+    nexp = len(experiments)
+    celsius = np.array([e['celsius'] for e in experiments], dtype=float)
+    if len(np.unique(celsius)) < 2:
+        print 'Need experiments at 2 or more temperatures'
+        return
+    reference_kelvin = 1. / np.mean(1. / (celsius + 273.15))
+    inits = np.array([e.get('init', 1.) for e in experiments], dtype=float)
+    y_data = [np.concatenate([np.array(yk, dtype=float) for yk in e['y']])
+              for e in experiments]
+    nrows = [len(y) for y in y_data]
+    row_starts = np.concatenate(([0], np.cumsum(nrows)))
+
+    # starting values from a line through each experiment's grid search
+    if Ea_guesses is None or log10D0_guesses is None:
+        best3 = []
+        for e, init in zip(experiments, inits):
+            grid = rss_grid3D(e['x'], e['y'], e['microns3'], 
+                              e['time_seconds'], e['raypaths'], init=init, 
+                              fin=fin)
+            if grid is None:
+                return
+            log10D_grid, RSS = grid
+            best = np.unravel_index(np.nanargmin(RSS), RSS.shape)
+            best3.append([log10D_grid[i] for i in best])
+        best3 = np.array(best3)
+        inverse_T = 1. / (celsius + 273.15) - 1. / reference_kelvin
+        theta = np.zeros(6)
+        for k in range(3):
+            slope, intercept = np.polyfit(inverse_T, best3[:, k], 1)
+            theta[k] = -slope * np.log(10.) * GAS_CONSTANT
+            theta[k+3] = intercept
+    if Ea_guesses is not None and log10D0_guesses is not None:
+        theta = np.zeros(6)
+        theta[:3] = Ea_guesses
+        theta[3:] = (np.array(log10D0_guesses, dtype=float) - 
+                     np.array(Ea_guesses, dtype=float) / 
+                     (np.log(10.) * GAS_CONSTANT * reference_kelvin))
+    if vary_initials is True:
+        theta = np.concatenate((theta, inits))
+
+    def unpack(theta):
+        log10D3 = np.zeros((nexp, 3))
+        for k in range(3):
+            log10D3[:, k] = arrhenius_log10D(theta[k], theta[k+3], celsius,
+                                             reference_kelvin)
+        if vary_initials is True:
+            return log10D3, theta[6:]
+        return log10D3, inits
+
+    def residuals(theta):
+        log10D3, initials = unpack(theta)
+        r = []
+        for n, e in enumerate(experiments):
+            model = diffusion3D_at_positions(e['microns3'], log10D3[n],
+                                             e['time_seconds'], e['x'],
+                                             e['raypaths'], initials[n], fin)
+            r.append(np.concatenate(model) - y_data[n])
+        return np.concatenate(r)
+
+    def jacobian(theta):
+        log10D3, initials = unpack(theta)
+        rows = []
+        columns = []
+        values = []
+        for n, e in enumerate(experiments):
+            derivatives = diffusion3D_derivatives(e['microns3'], log10D3[n],
+                                                  e['time_seconds'], e['x'],
+                                                  e['raypaths'], initials[n],
+                                                  fin)
+            block_rows = np.arange(row_starts[n], row_starts[n+1])
+            dlog10D_dEa = -((1. / (celsius[n] + 273.15) - 
+                             1. / reference_kelvin) / 
+                            (np.log(10.) * GAS_CONSTANT))
+            blocks = []
+            for k, name in enumerate(['log10Dx', 'log10Dy', 'log10Dz']):
+                blocks.append((k, derivatives[name] * dlog10D_dEa))
+                blocks.append((k+3, derivatives[name]))
+            if vary_initials is True:
+                blocks.append((6+n, derivatives['initial_unit_value']))
+            for column, d in blocks:
+                rows.append(block_rows)
+                columns.append(column * np.ones(len(block_rows), dtype=int))
+                values.append(d)
+        return scipy.sparse.csr_matrix((np.concatenate(values), 
+                                        (np.concatenate(rows), 
+                                         np.concatenate(columns))),
+                                       shape=(row_starts[-1], len(theta)))
+
+    fit = scipy.optimize.least_squares(residuals, theta, jac=jacobian, 
+                                       method='trf', tr_solver='lsmr', 
+                                       x_scale='jac', ftol=tolerance, 
+                                       xtol=tolerance, gtol=tolerance,
+                                       max_nfev=max_evaluations)
+    theta = fit.x
+    r = fit.fun
+    RSS = np.sum(r**2)
+
+    # errors from the curvature, scaled by the reduced chi-square
+    J = fit.jac
+    if scipy.sparse.issparse(J):
+        J = J.toarray()
+    dof = len(r) - len(theta)
+    try:
+        covariance = np.linalg.inv(np.dot(J.T, J)) * RSS / max(dof, 1)
+    except np.linalg.LinAlgError:
+        covariance = np.nan * np.ones((len(theta), len(theta)))
+
+    # log10D0 = log10D_reference + Ea / (ln10 R T_reference)
+    c = 1. / (np.log(10.) * GAS_CONSTANT * reference_kelvin)
+    Ea = []
+    log10D0 = []
+    for k in range(3):
+        Ea_variance = covariance[k, k]
+        log10D0_variance = (covariance[k+3, k+3] + c**2 * Ea_variance + 
+                            2. * c * covariance[k, k+3])
+        Ea.append(ufloat(theta[k], max(Ea_variance, 0.)**0.5))
+        log10D0.append(ufloat(theta[k+3] + c * theta[k], 
+                              max(log10D0_variance, 0.)**0.5))
+
+    log10D3, initials = unpack(theta)
+    results = {'Ea_kJmol' : Ea,
+               'log10D0' : log10D0,
+               'initials' : np.array(initials),
+               'log10D3' : log10D3,
+               'residuals' : [r[row_starts[n]:row_starts[n+1]] 
+                              for n in range(nexp)],
+               'RSS' : RSS,
+               'success' : fit.success}
+    return results
+
 #%%
 def get_iorient(orient):
     """Converts x, y, z, u to 0, 1, 2, 3"""
@@ -893,6 +3433,51 @@ class Diffusivities():
         self.logDy_error = error[1]
         self.logDz_error = error[2]
 
+    def fit_Ea_D0_wholeblocks(self, peak_idx=None, heights_instead=False,
+                              wholeblock=True, vary_initials=False, 
+                              wb_or_3Dnpi='wb', Ea_guesses=None, 
+                              log10D0_guesses=None):
+        """Fits Ea and D0 || x, y, and z straight to the profiles of all 
+        of the whole-blocks in attribute wholeblocks at once with
+        fit_arrhenius3D instead of through diffusivities fit one 
+        whole-block at a time. The results are saved in the attributes
+        activation_energy_kJmol and logD0 and returned as the dictionary 
+        from fit_arrhenius3D."""
+        experiments = []
+        for wb in self.wholeblocks:
+            if wb.temperature_celsius is None:
+                print wb.name, 'needs temperature_celsius attribute'
+                return
+            if wb.raypaths is None:
+                wb.setupWB()
+            xy = wb.xy_picker(peak_idx, wholeblock, heights_instead, 
+                              centered=True)
+            if xy is False:
+                print 'Problem getting data for', wb.name
+                return
+            if wb_or_3Dnpi == 'wb':
+                raypaths = wb.raypaths
+            else:
+                raypaths = None
+            experiments.append({'x' : xy[0],
+                                'y' : xy[1],
+                                'microns3' : wb.lengths,
+                                'time_seconds' : wb.time_seconds,
+                                'celsius' : wb.temperature_celsius,
+                                'raypaths' : raypaths})
+
+        results = fit_arrhenius3D(experiments, Ea_guesses, log10D0_guesses,
+                                  vary_initials=vary_initials)
+        if results is None:
+            return
+        self.activation_energy_kJmol = results['Ea_kJmol'] + [None]
+        self.logD0 = results['log10D0'] + [None]
+        for k, direction in enumerate(['x', 'y', 'z']):
+            print '||', direction, 'Ea', '{:.1f}'.format(
+                  results['Ea_kJmol'][k]), 'kJ/mol, log10D0',
+            print '{:.2f}'.format(results['log10D0'][k]), 'm2/s'
+        return results
+
     def make_styles(self, orient):
         """Marker and line styles for plotting and adding to the legend"""
         iorient = get_iorient(orient)
@@ -569,13 +569,14 @@ def fast_vs_slow(celsius, minutes, abc=[2000., 2000., 2000.], sample=None,
                                                   log10Ds_m2s=D_slow, 
                                                   time_seconds=minutes*60., 
                                                   initial=1., final=0.,
-                                                  plot3=True, centered=False)
+                                                  plot3=True, centered=False,
+                                                  lazy=True)
 
     v2, x2, y2 = diffusion.diffusion3Dnpi(lengths_microns=[a, b, c], 
                                           styles3=[st.style_1]*3,
                                           log10Ds_m2s=D_fast, figaxis3=axes,
                                           time_seconds=minutes*60., 
                                           initial=1., final=0., plot3=True, 
-                                          centered=False)
+                                          centered=False, lazy=True)
                              
     return fig, axes
@@ -18,6 +18,7 @@ This software was developed using Python 2.7.
 """
 import styles
 import diffusion
+import wholeblock
 import gc
 import numpy as np
 import matplotlib.pyplot as plt
@@ -33,6 +34,9 @@ import uncertainties
 from matplotlib.backends.backend_pdf import PdfPages
 import xlsxwriter
 import json
+import zlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from scipy import signal as scipysignal
 import scipy.interpolate as interp
 
@@ -56,6 +60,17 @@ class Sample():
         self.thickness_microns = [twoA, twoB, twoC]
         return [twoA, twoB, twoC]
 
+    def get_thickness_errors(self):
+        """Returns the standard deviations of the thickness measurements
+        in each direction, 0 if there are fewer than 2 measurements."""
+        errors = []
+        for thick_list in [self.twoA_list, self.twoB_list, self.twoC_list]:
+            if len(thick_list) < 2:
+                errors.append(0.)
+            else:
+                errors.append(np.std(thick_list))
+        return errors
+
 def get_3thick(sample_name):
     """Average thickness measurements in 3 directions and return a list"""
     twoA = np.mean(sample_name.twoA_list)
@@ -100,8 +115,730 @@ def area2water(area_cm2, phase='cpx', calibration='Bell', peak_idx=None):
     w = absorption_coeff * area_cm2
     return w
         
+#%% Fast reading of spectrum files
+#
+# np.loadtxt goes through the file line by line in python, which adds up
+# for thousands of spectra with thousands of rows each. read_spectrum_text
+# parses the whole file in one go instead and only falls back on loadtxt
+# if the file is not a plain table of numbers.
+#
+# The optional cache is a small binary file next to the spectrum file 
+# (filename + SPECTRUM_CACHE_ENDING): a 32 byte header with the 
+# SPECTRUM_CACHE_MAGIC, the modification time and size of the spectrum 
+# file it came from, and the number of rows, then the wavenumbers and 
+# absorbances as float64, already sorted by wavenumber. A cache that does
+# not match its spectrum file is ignored and written again.
+#
+SPECTRUM_CACHE_ENDING = '.cache'
+SPECTRUM_CACHE_MAGIC = 'PYNAMS1\x00'
+SPECTRUM_CACHE_HEADER = np.dtype([('magic', 'S8'), ('mtime', '<f8'),
+                                  ('size', '<i8'), ('rows', '<i8')])
+
+def read_spectrum_text(filename, delimiter=','):
+    """Reads a 2-column text file of wavenumber and absorbance and returns 
+    the two columns sorted by wavenumber"""
+    with open(filename, 'r') as f:
+        text = f.read()
+    lines = [line for line in text.splitlines() if line.strip() != '']
+    signal = None
+    if len(lines) > 0:
+        ncolumns = len(lines[0].split(delimiter))
+        values = np.fromstring(text.replace(delimiter, ' '), sep=' ')
+        if len(values) == len(lines) * ncolumns:
+            signal = values.reshape(len(lines), ncolumns)
+    if signal is None:
+        signal = np.loadtxt(filename, delimiter=delimiter)
+
+    wn = signal[:, 0]
+    # usually saved from high to low wavenumber
+    if np.all(np.diff(wn) < 0):
+        signal = signal[::-1]
+    elif np.any(np.diff(wn) < 0):
+        signal = signal[wn.argsort()]
+    return (np.ascontiguousarray(signal[:, 0]), 
+            np.ascontiguousarray(signal[:, 1]))
+
+def read_spectrum_cache(filename):
+    """Returns the wavenumbers and absorbances for the spectrum file 
+    filename from its cache, or None if there is no cache or it does not 
+    match the spectrum file. The data are read into memory, so no file 
+    stays open however many spectra are kept."""
+    cache_filename = filename + SPECTRUM_CACHE_ENDING
+    if not os.path.isfile(cache_filename):
+        return None
+    source = os.stat(filename)
+    with open(cache_filename, 'rb') as f:
+        header = np.fromfile(f, dtype=SPECTRUM_CACHE_HEADER, count=1)
+        if len(header) != 1:
+            return None
+        header = header[0]
+        if (header['magic'] != SPECTRUM_CACHE_MAGIC.rstrip('\x00') or 
+            header['mtime'] != source.st_mtime or 
+            header['size'] != source.st_size):
+            return None
+        rows = int(header['rows'])
+        expected = SPECTRUM_CACHE_HEADER.itemsize + 16 * rows
+        if rows < 1 or os.path.getsize(cache_filename) != expected:
+            return None
+        signal = np.fromfile(f, dtype='<f8', count=2*rows)
+    if len(signal) != 2 * rows:
+        return None
+    signal = signal.reshape(2, rows)
+    return signal[0], signal[1]
+
+def write_spectrum_cache(filename, wn, absorbance):
+    """Saves sorted wavenumbers and absorbances as the cache for the 
+    spectrum file filename. Returns False if it could not be written."""
+    cache_filename = filename + SPECTRUM_CACHE_ENDING
+    source = os.stat(filename)
+    header = np.zeros(1, dtype=SPECTRUM_CACHE_HEADER)
+    header['magic'] = SPECTRUM_CACHE_MAGIC
+    header['mtime'] = source.st_mtime
+    header['size'] = source.st_size
+    header['rows'] = len(wn)
+    temporary = cache_filename + '.partial'
+    try:
+        with open(temporary, 'wb') as f:
+            header.tofile(f)
+            np.array([wn, absorbance], dtype='<f8').tofile(f)
+        if os.path.exists(cache_filename) and os.name == 'nt':
+            os.remove(cache_filename)
+        os.rename(temporary, cache_filename)
+    except (IOError, OSError):
+        return False
+    return True
+
+def read_spectrum_file(filename, filetype='.CSV', use_cache=False):
+    """Returns wavenumbers and absorbances sorted by wavenumber from
+    spectrum file, using and updating the cache if use_cache=True.
+    Raises IOError if the file isn't there and ValueError if it can't be
+    read. Safe to call from several threads at once."""
+    if os.path.isfile(filename) is False:
+        raise IOError('There is a problem finding the file.')
+    if use_cache is True:
+        cached = read_spectrum_cache(filename)
+        if cached is not None:
+            return cached
+
+    if filetype == '.CSV':
+        signal = read_spectrum_text(filename, delimiter=',')
+    elif filetype == '.txt':
+        signal = read_spectrum_text(filename, delimiter='\t')
+    else:
+        raise ValueError('check filetype')
+
+    if use_cache is True:
+        write_spectrum_cache(filename, signal[0], signal[1])
+    return signal
+
+#%% Shared wavenumber axes
+#
+# Spectra from the same instrument and settings all have the same 
+# wavenumbers, so rather than every Spectrum keeping its own copy, 
+# shared_axis looks each new axis up in WAVENUMBER_AXES, keyed by length,
+# endpoints, and a crc32 checksum, and hands back the one read-only array
+# already there if the values match. Because these arrays stay put, 
+# nearest_index can remember the index it found for each wavenumber on 
+# each shared axis instead of searching the whole axis again.
+#
+WAVENUMBER_AXES = {}
+AXIS_INDEXES = {}
+
+def axis_key(wn):
+    """Returns the key used to look up wavenumber axis wn"""
+    if len(wn) == 0:
+        return (0, None, None, 0)
+    checksum = zlib.crc32(np.ascontiguousarray(wn).view(np.uint8))
+    return (len(wn), float(wn[0]), float(wn[-1]), checksum)
+
+def shared_axis(wn):
+    """Returns the read-only shared wavenumber axis with the same values
+    as wn. If there isn't one yet, a read-only copy of wn becomes the 
+    shared axis, so wn itself is left as it was."""
+    if wn is None:
+        return None
+    if id(wn) in AXIS_INDEXES:
+        return wn
+    wn = np.asarray(wn, dtype=float)
+    key = axis_key(wn)
+    axes = WAVENUMBER_AXES.setdefault(key, [])
+    for axis in axes:
+        if np.array_equal(axis, wn):
+            return axis
+    axis = np.array(wn, dtype=float)
+    axis.flags.writeable = False
+    axes.append(axis)
+    AXIS_INDEXES[id(axis)] = {}
+    return axis
+
+def clear_shared_axes():
+    """Forgets all shared wavenumber axes and their cached indexes. 
+    Spectra keep the axes they already have."""
+    WAVENUMBER_AXES.clear()
+    AXIS_INDEXES.clear()
+
+def nearest_index(wn, wavenumber):
+    """Returns index of the value in wn closest to wavenumber, remembered
+    for next time if wn is a shared axis"""
+    indexes = AXIS_INDEXES.get(id(wn))
+    if indexes is None:
+        return (np.abs(wn-wavenumber)).argmin()
+    wavenumber = float(wavenumber)
+    if wavenumber not in indexes:
+        indexes[wavenumber] = (np.abs(wn-wavenumber)).argmin()
+    return indexes[wavenumber]
+
+#%% Loading many spectra at once
+#
+# Reading spectra one after another is slow when every file open has to
+# wait on network storage. prefetch_spectra reads the files of many 
+# spectra at once with a bounded pool of threads (numpy and file reads 
+# release the GIL) and then hands the data to each spectrum in order in 
+# the main thread, so only the reading is concurrent.
+#
+PREFETCH_THREADS = 8
+
+def read_spectrum_unit(args):
+    """Reads one spectrum file for prefetch_spectra. Returns the data and
+    None, or None and the error message."""
+    filename, filetype, use_cache = args
+    try:
+        return read_spectrum_file(filename, filetype, use_cache), None
+    except (IOError, OSError, ValueError) as err:
+        return None, str(err)
+
+def prefetch_spectra(spectra, threads=PREFETCH_THREADS, use_cache=None,
+                     verbose=True):
+    """Reads data for all spectra in list that don't have them yet using
+    up to threads threads. Returns a list of (filename, error message) 
+    for files that could not be read, which are also printed out if 
+    verbose is True."""
+    todo = []
+    seen = set()
+    for spec in spectra:
+        if spec.has_data() is True or id(spec) in seen:
+            continue
+        seen.add(id(spec))
+        if spec.filename is None:
+            if spec.fname is None:
+                continue
+            spec.filename = spec.folder + spec.fname + spec.filetype
+        todo.append(spec)
+    if len(todo) == 0:
+        return []
+
+    jobs = []
+    for spec in todo:
+        if use_cache is None:
+            jobs.append((spec.filename, spec.filetype, spec.use_cache))
+        else:
+            jobs.append((spec.filename, spec.filetype, use_cache))
+
+    if threads > 1 and len(jobs) > 1:
+        pool = ThreadPool(min(threads, len(jobs)))
+        try:
+            results = pool.map(read_spectrum_unit, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [read_spectrum_unit(job) for job in jobs]
+
+    errors = []
+    for spec, (signal, err) in zip(todo, results):
+        if err is None:
+            spec.set_data(signal[0], signal[1])
+        else:
+            errors.append((spec.filename, err))
+            if verbose is True:
+                print 'Problem reading', spec.filename, ':', err
+    return errors
+
+#%% Single-file archives of spectra, profiles, and whole-blocks
+#
+# An archive holds everything that otherwise sits in separate small files
+# (spectra, -baseline.CSV, -peakfit.CSV, -diffusivities.txt) in one file:
+# ARCHIVE_MAGIC, the length of a JSON header as a little-endian uint64, 
+# the header, and then the arrays, each starting on a 64 byte boundary. 
+# The header has the metadata and the offset, shape, and dtype of every 
+# array. Spectra that share a wavenumber axis are stored as rows of one 
+# 2D absorbance block, and the same goes for baselines. read_archive maps
+# the whole file once, and the arrays are views into that map, so nothing 
+# is read from disk until it is used.
+#
+ARCHIVE_MAGIC = 'PYNAMSA1'
+ARCHIVE_ENDING = '.pynams'
+ARCHIVE_ALIGNMENT = 64
+
+def json_ready(value):
+    """Returns value with numpy numbers and arrays turned into python 
+    floats, ints, and lists so json can write it"""
+    if isinstance(value, dict):
+        return dict([(key, json_ready(v)) for key, v in value.items()])
+    if isinstance(value, (list, tuple)):
+        return [json_ready(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return json_ready(value.tolist())
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def write_archive(filename, arrays, metadata):
+    """Writes the dictionary of numpy arrays and the json-compatible
+    metadata dictionary to a single archive file"""
+    names = sorted(arrays.keys())
+    layout = {}
+    offset = 0
+    for name in names:
+        a = np.ascontiguousarray(arrays[name])
+        arrays[name] = a
+        layout[name] = {'offset' : offset, 'shape' : list(a.shape), 
+                        'dtype' : a.dtype.str}
+        offset = offset + -(-a.nbytes // ARCHIVE_ALIGNMENT) * ARCHIVE_ALIGNMENT
+    header = json.dumps({'metadata' : json_ready(metadata), 
+                         'arrays' : layout})
+    start = 16 + len(header)
+    start = -(-start // ARCHIVE_ALIGNMENT) * ARCHIVE_ALIGNMENT
+    header = header + ' ' * (start - 16 - len(header))
+
+    temporary = filename + '.partial'
+    with open(temporary, 'wb') as f:
+        f.write(ARCHIVE_MAGIC)
+        f.write(np.array([len(header)], dtype='<u8').tobytes())
+        f.write(header)
+        for name in names:
+            f.seek(start + layout[name]['offset'])
+            f.write(arrays[name].tobytes())
+        f.truncate(max(f.tell(), start + offset))
+    if os.path.exists(filename) and os.name == 'nt':
+        os.remove(filename)
+    os.rename(temporary, filename)
+
+def read_archive(filename):
+    """Returns the arrays (a dictionary of copy-on-write views into one
+    memory map of the file) and the metadata from an archive file"""
+    with open(filename, 'rb') as f:
+        if f.read(8) != ARCHIVE_MAGIC:
+            print filename, 'is not a pynams archive'
+            return
+        length = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        header = json.loads(f.read(length))
+    start = 16 + length
+    whole = np.memmap(filename, dtype=np.uint8, mode='c')
+    arrays = {}
+    for name, layout in header['arrays'].items():
+        dtype = np.dtype(str(layout['dtype']))
+        shape = tuple(layout['shape'])
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        first = start + layout['offset']
+        arrays[name] = whole[first:first+nbytes].view(dtype).reshape(shape)
+    return arrays, header['metadata']
+
+def group_index(groups, x):
+    """Returns the index of the array in list groups equal to x, adding x
+    to the end of groups if there isn't one"""
+    for k, g in enumerate(groups):
+        if len(g) == len(x) and np.array_equal(g, x):
+            return k
+    groups.append(np.array(x, dtype=float))
+    return len(groups) - 1
+
+def pack_spectra(spectra, get_data=True):
+    """Returns the arrays and a list of metadata dictionaries, one per 
+    spectrum, for storing spectra in an archive. With get_data=True, data
+    are read from file for spectra that don't have them yet."""
+    axes = []
+    absorbances = []
+    base_axes = []
+    baselines = []
+    peakfit_rows = []
+    records = []
+    for spec in spectra:
+        record = {}
+        for key in ['fname', 'folder', 'filetype', 'thick_microns', 'raypath',
+                    'base_low_wn', 'base_high_wn', 'base_mid_wn', 'polar',
+                    'other_name', 'position_microns_a', 'position_microns_b',
+                    'position_microns_c']:
+            record[key] = getattr(spec, key, None)
+
+        if get_data is True:
+            spec.load_data()
+        if spec.has_data() is True:
+            g = group_index(axes, spec.wn_full)
+            if g == len(absorbances):
+                absorbances.append([])
+            record['data'] = [g, len(absorbances[g])]
+            absorbances[g].append(np.array(spec.abs_raw, dtype=float))
+
+        if spec.base_wn is not None and spec.base_abs is not None:
+            g = group_index(base_axes, spec.base_wn)
+            if g == len(baselines):
+                baselines.append([])
+            nobase = spec.abs_nobase_cm
+            if nobase is None or len(nobase) != len(spec.base_abs):
+                nobase = np.nan * np.ones(len(spec.base_abs))
+            record['baseline'] = [g, len(baselines[g])]
+            baselines[g].append(np.vstack((spec.base_abs, nobase)))
+
+        if spec.peakpos is not None:
+            record['peakfit'] = [sum([len(p) for p in peakfit_rows]), 
+                                 len(spec.peakpos)]
+            peakfit_rows.append(np.column_stack((spec.peakpos, 
+                                                 spec.peak_heights,
+                                                 spec.peak_widths,
+                                                 spec.peak_areas)))
+        records.append(record)
+
+    arrays = {}
+    for g in range(len(axes)):
+        arrays['wn_' + str(g)] = axes[g]
+        arrays['absorbance_' + str(g)] = np.vstack(absorbances[g])
+    for g in range(len(base_axes)):
+        arrays['base_wn_' + str(g)] = base_axes[g]
+        # rows of baseline, then baseline-subtracted absorbance
+        arrays['baseline_' + str(g)] = np.array(baselines[g])
+    if len(peakfit_rows) > 0:
+        arrays['peakfit'] = np.vstack(peakfit_rows)
+    return arrays, records
+
+def unpack_spectra(arrays, records):
+    """Returns list of Spectrum from the arrays and records made by 
+    pack_spectra. The data are views of the arrays, not copies."""
+    spectra = []
+    for record in records:
+        spec = Spectrum(fname=record['fname'], folder=record['folder'], 
+                        filetype=record['filetype'])
+        for key, value in record.items():
+            if key not in ['data', 'baseline', 'peakfit']:
+                setattr(spec, key, value)
+
+        if 'data' in record:
+            g, row = record['data']
+            spec.wn_full = shared_axis(arrays['wn_' + str(g)])
+            spec.abs_raw = arrays['absorbance_' + str(g)][row]
+
+        if 'baseline' in record:
+            g, row = record['baseline']
+            spec.base_wn = shared_axis(arrays['base_wn_' + str(g)])
+            spec.base_abs = arrays['baseline_' + str(g)][row, 0]
+            spec.abs_nobase_cm = arrays['baseline_' + str(g)][row, 1]
+            if np.all(np.isnan(spec.abs_nobase_cm)):
+                spec.abs_nobase_cm = None
+
+        if 'peakfit' in record:
+            start, npeaks = record['peakfit']
+            table = arrays['peakfit'][start:start+npeaks]
+            spec.peakpos = table[:, 0]
+            spec.numPeaks = npeaks
+            spec.peak_heights = table[:, 1]
+            spec.peak_widths = table[:, 2]
+            spec.peak_areas = table[:, 3]
+        spectra.append(spec)
+    return spectra
+
+def pack_profiles(profiles, get_data=True):
+    """Returns arrays and list of metadata dictionaries for storing 
+    profiles and their spectra in an archive. Each profile is stored only
+    once, in the order given, followed by any initial profiles."""
+    everything = []
+    for prof in profiles:
+        if prof not in everything:
+            everything.append(prof)
+    for prof in profiles:
+        initial = prof.initial_profile
+        if initial is not None and initial not in everything:
+            everything.append(initial)
+
+    spectra = []
+    records = []
+    for prof in everything:
+        record = {}
+        for key in ['profile_name', 'short_name', 'folder', 'fname_list',
+                    'direction', 'raypath', 'positions_microns',
+                    'length_microns', 'time_seconds', 'thick_microns']:
+            record[key] = getattr(prof, key, None)
+        record['spectra'] = range(len(spectra), 
+                                  len(spectra) + len(prof.spectra_list))
+        spectra = spectra + list(prof.spectra_list)
+        if prof.initial_profile is not None:
+            record['initial_profile'] = everything.index(prof.initial_profile)
+        record['diffusivities'] = prof.diffusivities_list()
+        if prof.sample is not None:
+            sample = prof.sample
+            record['sample'] = {'thickness_microns' : sample.thickness_microns,
+                                'IGSN' : sample.IGSN,
+                                'mineral_name' : sample.mineral_name,
+                                'initial_water' : sample.initial_water,
+                                'twoA_list' : sample.twoA_list,
+                                'twoB_list' : sample.twoB_list,
+                                'twoC_list' : sample.twoC_list}
+        records.append(record)
+
+    arrays, spectrum_records = pack_spectra(spectra, get_data)
+    return arrays, records, spectrum_records
+
+def unpack_profiles(arrays, records, spectrum_records):
+    """Returns list of Profile from pack_profiles output"""
+    spectra = unpack_spectra(arrays, spectrum_records)
+    samples = {}
+    profiles = []
+    for record in records:
+        sample = None
+        if 'sample' in record:
+            key = json.dumps(record['sample'], sort_keys=True)
+            if key not in samples:
+                samples[key] = Sample(**record['sample'])
+            sample = samples[key]
+        prof = Profile(profile_name=record['profile_name'], 
+                       folder=record['folder'], sample=sample,
+                       direction=record['direction'], 
+                       raypath=record['raypath'],
+                       short_name=record['short_name'],
+                       time_seconds=record['time_seconds'],
+                       length_microns=record['length_microns'],
+                       thick_microns=record['thick_microns'],
+                       fname_list=record['fname_list'],
+                       spectra_list=[spectra[k] for k in record['spectra']])
+        if record['positions_microns'] is not None:
+            prof.positions_microns = np.array(record['positions_microns'])
+        profiles.append(prof)
+
+    for prof, record in zip(profiles, records):
+        if 'initial_profile' in record:
+            prof.initial_profile = profiles[record['initial_profile']]
+        if prof.get_peak_info() is not False:
+            prof.set_diffusivities_list(record['diffusivities'])
+        else:
+            prof.set_diffusivities_list(record['diffusivities'][:2])
+    return profiles
+#%% Compact tables of many spectra
+#
+# A Spectrum keeps its metadata in its own __dict__, which for a mapping
+# project with hundreds of thousands of spectra costs more memory than 
+# the spectra themselves. A SpectraTable keeps the same metadata for all 
+# of them as columns (one numpy array per attribute, with raypaths as 
+# small integer codes) and the absorbances as rows of one 2D array per 
+# wavenumber axis. table[k] is a SpectrumRow, which only holds the table
+# and k, and table.spectrum(k) makes a full Spectrum when its methods 
+# are needed.
+#
+RAYPATH_CODES = {'a' : 0, 'b' : 1, 'c' : 2}
+RAYPATHS = ['a', 'b', 'c']
+
+def table_column(name, doc=None):
+    """Returns property for SpectrumRow that reads and writes row index
+    of the table column name"""
+    def getter(self):
+        return getattr(self.table, name)[self.index]
+    def setter(self, value):
+        getattr(self.table, name)[self.index] = value
+    return property(getter, setter, doc=doc)
+
+class SpectraTable(object):
+    __slots__ = ('fnames', 'folder', 'filetype', 'thick_microns', 
+                 'raypath_codes', 'position_microns_a', 'position_microns_b',
+                 'position_microns_c', 'base_low_wn', 'base_high_wn', 
+                 'base_mid_wn', 'wn_groups', 'blocks', 'group', 'row')
+
+    def __init__(self, fnames, folder='', filetype='.CSV', 
+                 thick_microns=None, raypath=None, position_microns_a=None,
+                 position_microns_b=None, position_microns_c=None, 
+                 base_low_wn=3200, base_high_wn=3700, base_mid_wn=3550):
+        """Table of len(fnames) spectra that share a folder and filetype.
+        The other arguments can be single values for all the spectra or
+        one value per spectrum; missing values are nan (or None for 
+        raypath)."""
+        n = len(fnames)
+        self.fnames = np.array(fnames, dtype=object)
+        self.folder = folder
+        self.filetype = filetype
+        self.thick_microns = self.column(thick_microns, n)
+        self.position_microns_a = self.column(position_microns_a, n)
+        self.position_microns_b = self.column(position_microns_b, n)
+        self.position_microns_c = self.column(position_microns_c, n)
+        self.base_low_wn = self.column(base_low_wn, n)
+        self.base_high_wn = self.column(base_high_wn, n)
+        self.base_mid_wn = self.column(base_mid_wn, n)
+        if raypath is None or isinstance(raypath, str):
+            raypath = [raypath] * n
+        self.raypath_codes = np.array([RAYPATH_CODES.get(r, -1) 
+                                       for r in raypath], dtype=np.int8)
+        # data: wavenumber axes, absorbance blocks, and where each 
+        # spectrum is in them (group -1 means not read yet)
+        self.wn_groups = []
+        self.blocks = []
+        self.group = -np.ones(n, dtype=np.int32)
+        self.row = np.zeros(n, dtype=np.int32)
+
+    def column(self, value, n):
+        """Returns float array of length n from value or list of values"""
+        if value is None:
+            return np.nan * np.ones(n)
+        return np.array(value, dtype=float) * np.ones(n)
+
+    def __len__(self):
+        return len(self.fnames)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index = index + len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('spectrum index out of range')
+        return SpectrumRow(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield SpectrumRow(self, index)
+
+    def filename(self, index):
+        return ''.join((self.folder, self.fnames[index], self.filetype))
+
+    def raypath(self, index):
+        code = self.raypath_codes[index]
+        if code < 0:
+            return None
+        return RAYPATHS[code]
+
+    def load(self, threads=PREFETCH_THREADS, use_cache=False, verbose=True):
+        """Reads the data for all spectra not read yet, as in 
+        prefetch_spectra. Spectra with the same wavenumbers become rows of
+        the same 2D absorbance block. Returns a list of (filename, error 
+        message) for files that could not be read."""
+        todo = list(np.where(self.group < 0)[0])
+        jobs = [(self.filename(k), self.filetype, use_cache) for k in todo]
+        if len(jobs) == 0:
+            return []
+        if threads > 1 and len(jobs) > 1:
+            pool = ThreadPool(min(threads, len(jobs)))
+            try:
+                results = pool.map(read_spectrum_unit, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [read_spectrum_unit(job) for job in jobs]
+
+        errors = []
+        rows = [[] for g in self.blocks]
+        for k, (signal, err) in zip(todo, results):
+            if err is not None:
+                errors.append((self.filename(k), err))
+                if verbose is True:
+                    print 'Problem reading', self.filename(k), ':', err
+                continue
+            g = group_index(self.wn_groups, signal[0])
+            if g == len(rows):
+                rows.append([])
+            rows[g].append((k, signal[1]))
+
+        for g, new_rows in enumerate(rows):
+            if len(new_rows) == 0:
+                continue
+            if g == len(self.blocks):
+                self.wn_groups[g] = shared_axis(self.wn_groups[g])
+                self.blocks.append(np.zeros((0, len(self.wn_groups[g]))))
+            first = len(self.blocks[g])
+            self.blocks[g] = np.vstack([self.blocks[g]] + 
+                                       [absorbance for k, absorbance in new_rows])
+            for r, (k, absorbance) in enumerate(new_rows):
+                self.group[k] = g
+                self.row[k] = first + r
+        return errors
+
+    def wn_full(self, index):
+        g = self.group[index]
+        if g < 0:
+            return None
+        return self.wn_groups[g]
+
+    def abs_raw(self, index):
+        g = self.group[index]
+        if g < 0:
+            return None
+        return self.blocks[g][self.row[index]]
+
+    def spectrum(self, index, sample=None):
+        """Returns a full Spectrum for row index. Its data are views into
+        the table."""
+        spec = Spectrum(fname=self.fnames[index], folder=self.folder,
+                        filetype=self.filetype, sample=sample,
+                        raypath=self.raypath(index))
+        for name in ['thick_microns', 'position_microns_a', 
+                     'position_microns_b', 'position_microns_c',
+                     'base_low_wn', 'base_high_wn', 'base_mid_wn']:
+            value = getattr(self, name)[index]
+            if np.isnan(value) == False:
+                setattr(spec, name, float(value))
+        if self.group[index] >= 0:
+            spec.set_data(self.wn_full(index), self.abs_raw(index))
+        return spec
+
+    def spectra(self, sample=None):
+        """Returns list of full Spectrum, one per row"""
+        return [self.spectrum(k, sample) for k in range(len(self))]
+
+    def nbytes(self):
+        """Returns approximate memory used by metadata and data in bytes"""
+        total = self.fnames.nbytes + self.raypath_codes.nbytes
+        total = total + sum([len(f) for f in self.fnames])
+        for name in ['thick_microns', 'position_microns_a', 
+                     'position_microns_b', 'position_microns_c',
+                     'base_low_wn', 'base_high_wn', 'base_mid_wn', 
+                     'group', 'row']:
+            total = total + getattr(self, name).nbytes
+        total = total + sum([wn.nbytes for wn in self.wn_groups])
+        return total + sum([block.nbytes for block in self.blocks])
+
+class SpectrumRow(object):
+    """One spectrum in a SpectraTable, read and written through the table"""
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    fname = table_column('fnames')
+    thick_microns = table_column('thick_microns')
+    position_microns_a = table_column('position_microns_a')
+    position_microns_b = table_column('position_microns_b')
+    position_microns_c = table_column('position_microns_c')
+    base_low_wn = table_column('base_low_wn')
+    base_high_wn = table_column('base_high_wn')
+    base_mid_wn = table_column('base_mid_wn')
+
+    @property
+    def filename(self):
+        return self.table.filename(self.index)
+
+    @property
+    def raypath(self):
+        return self.table.raypath(self.index)
+
+    @raypath.setter
+    def raypath(self, value):
+        self.table.raypath_codes[self.index] = RAYPATH_CODES.get(value, -1)
+
+    @property
+    def wn_full(self):
+        return self.table.wn_full(self.index)
+
+    @property
+    def abs_raw(self):
+        return self.table.abs_raw(self.index)
+
+    @property
+    def abs_full_cm(self):
+        """Raw absorbance divided by thickness in cm"""
+        if self.abs_raw is None or np.isnan(self.thick_microns):
+            return None
+        return self.abs_raw * 1e4 / self.thick_microns
+
+    def spectrum(self, sample=None):
+        """Returns a full Spectrum for this row"""
+        return self.table.spectrum(self.index, sample)
+
 #%% Define classes and functions related to FTIR spectra        
-class Spectrum():
+class Spectrum(object):
     def __init__(self, fname, folder='', sample=None, filename=None,
                  thick_microns=None, raypath=None,
                  base_low_wn=3200, base_high_wn=3700,
@@ -124,10 +861,99 @@ class Spectrum():
         if self.filename is None and self.fname is not None:
             self.filename = self.folder + self.fname + self.filetype
 
-    # full range of measured wavenumber and absorbances
-    wn_full = None
-    abs_raw = None
-    abs_full_cm = None
+    # Full range of measured wavenumber and absorbances. These are read
+    # from file (wn_full, abs_raw) or worked out from them (abs_full_cm) 
+    # the first time they are needed and then kept until the file or 
+    # thickness changes or clear_data is called.
+    _wn_full = None
+    _abs_raw = None
+    _abs_full_cm = None
+    _thick_microns = None
+    _filename = None
+    # wavenumber range used by start_at_zero on the current abs_full_cm,
+    # or 'as set' if abs_full_cm was set directly
+    zero_range = None
+
+    def has_data(self):
+        """True if the raw data are in memory already"""
+        return self._wn_full is not None and self._abs_raw is not None
+
+    def load_data(self):
+        """Reads the data from file if not done already and possible"""
+        if self.has_data() is True:
+            return True
+        if self._filename is None or os.path.isfile(self._filename) is False:
+            return False
+        return self.get_data()
+
+    def clear_data(self):
+        """Forgets the data and everything worked out from them, so they 
+        are read from file again when next needed"""
+        self._wn_full = None
+        self._abs_raw = None
+        self.clear_normalized()
+
+    def clear_normalized(self):
+        """Forgets thickness-normalized absorbance abs_full_cm"""
+        self._abs_full_cm = None
+        self.zero_range = None
+
+    @property
+    def wn_full(self):
+        if self._wn_full is None:
+            self.load_data()
+        return self._wn_full
+
+    @wn_full.setter
+    def wn_full(self, value):
+        self._wn_full = value
+        self.clear_normalized()
+
+    @property
+    def abs_raw(self):
+        if self._abs_raw is None:
+            self.load_data()
+        return self._abs_raw
+
+    @abs_raw.setter
+    def abs_raw(self, value):
+        self._abs_raw = value
+        self.clear_normalized()
+
+    @property
+    def abs_full_cm(self):
+        """Raw absorbance divided by thickness in cm, made when first 
+        needed if thick_microns is known"""
+        if self._abs_full_cm is None and self._thick_microns is not None:
+            if self.abs_raw is not None:
+                self.divide_by_thickness()
+        return self._abs_full_cm
+
+    @abs_full_cm.setter
+    def abs_full_cm(self, value):
+        self._abs_full_cm = value
+        self.zero_range = 'as set'
+
+    @property
+    def thick_microns(self):
+        return self._thick_microns
+
+    @thick_microns.setter
+    def thick_microns(self, value):
+        if value is None or self._thick_microns is None or \
+           np.any(value != self._thick_microns):
+            self.clear_normalized()
+        self._thick_microns = value
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @filename.setter
+    def filename(self, value):
+        if self._filename is not None and value != self._filename:
+            self.clear_data()
+        self._filename = value
 
     # other metadata with a few defaults
     position_microns_a = None
@@ -143,6 +969,10 @@ class Spectrum():
     # default baseline range
     base_wn = None
     base_abs = None
+    # keep sorted data in binary files next to the spectra for get_data
+    use_cache = False
+    # share one read-only wavenumber axis among spectra (see shared_axis)
+    share_axes = True
     # need these for quadratic baseline
     base_mid_yshift = 0.04
     base_w_small = 0.02
@@ -239,14 +1069,14 @@ class Spectrum():
                                         relative=True):
         """Take a spectrum and wavenumber range (default 3300-3500 cm-1)
         and returns the wavenumber with the lowest absorbance within that range."""
-        if self.abs_full_cm is None:
+        if self.zero_range is None:
             self.start_at_zero()
     
         ## find minimum relative to a linear baseline
         if relative is True:            
             self.make_baseline(linetype='line', show_plot=False)
-            idx_mid_high = (np.abs(self.base_wn-wn_mid_range_high)).argmin()
-            idx_mid_low = (np.abs(self.base_wn-wn_mid_range_low)).argmin()
+            idx_mid_high = nearest_index(self.base_wn, wn_mid_range_high)
+            idx_mid_low = nearest_index(self.base_wn, wn_mid_range_low)
             if idx_mid_high == idx_mid_low:
                 print 'basenumber range not established. Check wavenumber range'
                 return False
@@ -260,8 +1090,8 @@ class Spectrum():
 
         else:        
             ## finds absolute minimum over range
-            idx_mid_high = (np.abs(self.wn_full-wn_mid_range_high)).argmin()
-            idx_mid_low = (np.abs(self.wn_full-wn_mid_range_low)).argmin()
+            idx_mid_high = nearest_index(self.wn_full, wn_mid_range_high)
+            idx_mid_low = nearest_index(self.wn_full, wn_mid_range_low)
             mid_abs_range = self.abs_full_cm[idx_mid_low:idx_mid_high]
             mid_wn_range = self.wn_full[idx_mid_low:idx_mid_high]
             idx_abs_mid = mid_abs_range.argmin()
@@ -322,34 +1152,38 @@ class Spectrum():
         self.abs_full_cm = ave_abs
         self.start_at_zero()
     
-    def get_data(self):
-        """Get the data from file"""
+    def get_data(self, use_cache=None):
+        """Get the data from file sorted by wavenumber.
+        With use_cache=True (default is the attribute use_cache), the 
+        sorted data are also saved in a binary cache next to the file
+        (see read_spectrum_cache), which is used instead of the file 
+        as long as the file has not changed."""
         if self.filename is None:
             self.filename = self.folder + self.fname + self.filetype
+        if use_cache is None:
+            use_cache = self.use_cache
 
-        if os.path.isfile(self.filename):
-            if self.filetype == '.CSV':
-                signal = np.loadtxt(self.filename, delimiter=',')
-            elif self.filetype == '.txt':
-                try:
-                    signal = np.loadtxt(self.filename, delimiter='\t', 
-                                        dtype=None) 
-                except ValueError:
-                    print '\nProblem reading this file format'
-                    return False
-            else:
-                print 'check filetype'
-        else:
-            print 'There is a problem finding the file.'
+        try:
+            signal = read_spectrum_file(self.filename, self.filetype, 
+                                        use_cache)
+        except IOError as err:
+            print err
 #            print 'You may need to run pynams.make_filenames(folder=)'
             print 'filename =', self.filename
             return False
-        
-        # sort signal by wavenumber
-        signal = signal[signal[:,0].argsort()]
-        self.wn_full = signal[:, 0]
-        self.abs_raw = signal[:, 1]
+        except ValueError as err:
+            print '\nProblem reading this file format:', err
+            return False
+        self.set_data(signal[0], signal[1])
         return True
+
+    def set_data(self, wn, absorbance):
+        """Sets wn_full and abs_raw, sharing the wavenumber axis if 
+        share_axes is True"""
+        if self.share_axes is True:
+            wn = shared_axis(wn)
+        self.wn_full = wn
+        self.abs_raw = absorbance
     
     def divide_by_thickness(self):
         """Divide raw absorbance by thickness"""
@@ -358,13 +1192,10 @@ class Spectrum():
             if check is False:
                 return False
                 
-        if self.fname is None:
-            print 'Need .fname to know what to call saved file'
-            return False
-            
         # Get the data from the file
-        if self.wn_full is None or self.abs_raw is None:
-            self.get_data()
+        if self.load_data() is False:
+            print 'Problem getting data from', self.filename
+            return False
 
         # Convert from numpy.float64 to regular python float
         # or else element-wise division doesn't work.
@@ -375,20 +1206,24 @@ class Spectrum():
         else:
             th = np.asscalar(self.thick_microns)
             
-        self.abs_full_cm = self.abs_raw * 1e4 / th
-        return self.abs_full_cm
+        self.abs_full_cm = self._abs_raw * 1e4 / th
+        self.zero_range = None
+        return self._abs_full_cm
 
     def start_at_zero(self, wn_xlim_left=4000., wn_xlim_right=3000.):
         """Divide raw absorbance by thickness and
         shift minimum to 0 within specified wavenumber range specified
-        by wn_xlim_left and _right"""
+        by wn_xlim_left and _right. Nothing is done if it's already been 
+        shifted over the same range."""
+        if self.zero_range == (wn_xlim_left, wn_xlim_right):
+            return self.abs_full_cm
         if self.abs_full_cm is None:
             check = self.divide_by_thickness()
             if check is False:
                 return False
 
-        index_lo = (np.abs(self.wn_full-wn_xlim_right)).argmin()
-        index_hi = (np.abs(self.wn_full-wn_xlim_left)).argmin()
+        index_lo = nearest_index(self.wn_full, wn_xlim_right)
+        index_hi = nearest_index(self.wn_full, wn_xlim_left)
 
         indices = range(index_lo, index_hi, 1)
 
@@ -399,6 +1234,7 @@ class Spectrum():
             print 'index_lo at wn', wn_xlim_right, ':', index_lo
             print 'index_hi at wn', wn_xlim_left, ':', index_hi
             return False        
+        self.zero_range = (wn_xlim_left, wn_xlim_right)
         return self.abs_full_cm
 
     def make_baseline(self, linetype='line', shiftline=0.02, 
@@ -413,19 +1249,9 @@ class Spectrum():
         argmument shiftline determining extent of curvature) 
         and return baseline absorption curve. Shiftline value determines
         how much quadratic deviates from linearity"""
-        if self.thick_microns is not None:
-            if self.abs_full_cm is None:
-                check = self.start_at_zero()
-                if check is False:
-                    return False
-            absorbance = self.abs_full_cm
-        else: 
-            if self.abs_raw is None:
-                self.get_data()
-                check = self.start_at_zero()
-                if check is False:
-                    return False
-            absorbance = self.abs_raw
+        absorbance = self.absorbance_picker()
+        if absorbance is None:
+            return False
 
         if wn_low is not None:
             self.base_low_wn = wn_low
@@ -433,8 +1259,8 @@ class Spectrum():
         if wn_high is not None:
             self.base_high_wn = wn_high
         
-        index_lo = (np.abs(self.wn_full-self.base_low_wn)).argmin()
-        index_hi = (np.abs(self.wn_full-self.base_high_wn)).argmin()        
+        index_lo = nearest_index(self.wn_full, self.base_low_wn)
+        index_hi = nearest_index(self.wn_full, self.base_high_wn)        
         self.base_wn = self.wn_full[index_lo:index_hi]
 
         # Smearing start and stop over a range of wavenumbers
@@ -473,7 +1299,7 @@ class Spectrum():
             # add in a point to fit curve to
             if wn_mid is not None:      
                 self.base_mid_wn = wn_mid
-                index_mid = (np.abs(self.wn_full-self.base_mid_wn)).argmin()
+                index_mid = nearest_index(self.wn_full, self.base_mid_wn)
                 abs_at_wn_mid = absorbance[index_mid]
                 yadd = abs_at_wn_mid
             elif shiftline is not None:
@@ -554,8 +1380,8 @@ class Spectrum():
             print 'Making', linetype, 'baseline'
             base_abs = self.make_baseline(linetype=linetype, shiftline=shiftline)
         
-        index_lo = (np.abs(self.wn_full-self.base_low_wn)).argmin()
-        index_hi = (np.abs(self.wn_full-self.base_high_wn)).argmin()
+        index_lo = nearest_index(self.wn_full, self.base_low_wn)
+        index_hi = nearest_index(self.wn_full, self.base_high_wn)
 #            
         absorbance = self.absorbance_picker()
         humps = absorbance[index_lo:index_hi]
@@ -616,6 +1442,29 @@ class Spectrum():
         self.area = area
         return area
 
+    def baseline_area_spread(self, main_yshift=None, window_large=None, 
+                             window_small=None):
+        """Returns the mean and standard deviation of the areas under the 
+        curve for the same 3 quadratic baselines used in water_from_spectra. 
+        The spectrum's own baseline and area are left as they were."""
+        if main_yshift is None:
+            main_yshift = self.base_mid_yshift
+        if window_large is None:
+            window_large = self.base_w_large
+        if window_small is None:
+            window_small = self.base_w_small
+
+        saved = (self.base_abs, self.base_wn, self.area)
+        areas = []
+        for shift in [main_yshift - window_small, main_yshift, 
+                      main_yshift + window_large]:
+            base_abs = self.make_baseline('quadratic', shiftline=shift)
+            abs_nobase_cm = self.subtract_baseline(bline=base_abs)
+            dx = self.base_high_wn - self.base_low_wn
+            areas.append(dx * np.mean(abs_nobase_cm))
+        self.base_abs, self.base_wn, self.area = saved
+        return np.mean(areas), np.std(areas)
+
     def water(self, phase_name='cpx', calibration='Bell', numformat='{:.1f}',
               show_plot=True, show_water=True, printout_area=False,
               shiftline=None, linetype='line'):
@@ -717,6 +1566,8 @@ class Spectrum():
 
         print 'Baseline information taken from file', baseline_ending
         self.base_wn = data[:, 0]
+        if self.share_axes is True:
+            self.base_wn = shared_axis(self.base_wn)
         self.base_abs = data[:, 1]
         self.abs_nobase_cm = data[:, 2]
         self.base_high_wn = max(data[:, 0])
@@ -813,9 +1664,6 @@ class Spectrum():
         """Returns reasonable min and max values for y-axis of
         plots based on the absorbance values for the specified wavenumber
         range and padded top and bottom with pad variable"""
-        if self.wn_full is None:
-            self.get_data()
-            
         if self.thick_microns is None:
             absorbance = self.abs_raw           
         else:
@@ -823,8 +1671,8 @@ class Spectrum():
                                wn_xlim_right=wn_xlim_right)
             absorbance = self.abs_full_cm
             
-        idx_lo = (np.abs(self.wn_full-wn_xlim_right)).argmin()
-        idx_hi = (np.abs(self.wn_full-wn_xlim_left)).argmin()
+        idx_lo = nearest_index(self.wn_full, wn_xlim_right)
+        idx_hi = nearest_index(self.wn_full, wn_xlim_left)
         
         y = absorbance[idx_lo:idx_hi]
 
@@ -875,9 +1723,6 @@ class Spectrum():
                       wn_xlim_left=4000., wn_xlim_right=3000., 
                       pad_top=0.1, pad_bot=0., plot_raw=False):
         """Plot the raw spectrum divided by thickness"""
-        if self.wn_full is None:
-            self.get_data()
-
         if self.thick_microns is not None:
             check = self.start_at_zero()
             if check is False:
@@ -1009,14 +1854,12 @@ class Spectrum():
 
         # check you know what the wavenumbers are
         if self.wn_full is None:
-            check = self.get_data()
-            if check is False:
-                return False
+            return False
 
-        idx = (np.abs(self.wn_full-wn)).argmin()
+        idx = nearest_index(self.wn_full, wn)
                 
         if absorbance == 'thickness normalized':
-            if self.abs_full_cm is None:
+            if self.zero_range is None:
                 self.start_at_zero()
             abs_at_wn = self.abs_full_cm[idx]
             return abs_at_wn
@@ -1038,14 +1881,11 @@ class Spectrum():
     def absorbance_picker(self):
         """Is this raw or thickness normalized absorbance you're after?"""
         if self.thick_microns is None:
-            if self.abs_raw is None:
-                self.get_data()
-            absorbance = self.abs_raw
-        else:
-            if self.abs_full_cm is None:
-                self.start_at_zero()
-            absorbance = self.abs_full_cm
-        return absorbance            
+            return self.abs_raw
+        if self.zero_range is None:
+            if self.start_at_zero() is False:
+                return None
+        return self.abs_full_cm            
         
     def plot_showbaseline(self, linetype='line', shiftline=None,
                           wn_baseline=None, abs_baseline=None, 
@@ -1222,7 +2062,7 @@ def water_from_spectra(list3, folder, phase='cpx',
         if window_small is None:
             window_small = spec.base_w_small
 
-        if spec.abs_full_cm is None:
+        if spec.zero_range is None:
             spec.start_at_zero()
         # Generate list of 3 possible areas under the curve
         area_list = np.array([])
@@ -1323,12 +2163,14 @@ class Profile():
                  spectra_list=[], set_thickness=False,
                  initial_profile=None, base_low_wn=None, base_high_wn=None,
                  diffusivity_log10m2s=None, diff_error=None, length_microns=None,
-                 peak_diffusivities=[], peak_diff_error=[], thick_microns=None):
+                 peak_diffusivities=[], peak_diff_error=[], thick_microns=None,
+                 prefetch=False):
         """fname_list = list of spectra filenames without the .CSV extension.
         Raypath and direction expressed as 'a', 'b', 'c' with thickness/length
         info contained in sample's twoA_list, twoB_list, and twoC_list.
         base_low_wn and base_high_wn can be used to set the wavenumber
         range of the baseline for the spectra.
+        prefetch=True reads all the spectra files at once (see prefetch).
         
         """
         self.profile_name = profile_name
@@ -1358,7 +2200,7 @@ class Profile():
             for spectrum in self.spectra_list:
                 spectrum.base_low_wn = base_high_wn
 
-        self.make_spectra_list(set_thickness=set_thickness)
+        self.make_spectra_list(set_thickness=set_thickness, prefetch=prefetch)
 
     short_name = None # short string for saving diffusivities, etc.
     thick_microns_list = None
@@ -1371,12 +2213,14 @@ class Profile():
     # e.g., to set different baseline limits consistently
     spectra_list = []
     spectrum_class_name = None 
+    spectra_table = None # compact alternative made by make_spectra_table
     avespec = None # averaged spectra made by self.average_spectra()
     iavespec = None # initial averaged spectra
     length_microns = None # length, but I usually use set_len() directly each time
     waters_list = []
     waters_errors = []
     areas_list = None
+    area_errors_list = None # from the spread of 3 baselines
     bestfitline_areas = None
     # Bulk whole-block 3D-WB information and diffusivities if applicable
     wb_areas = None 
@@ -1435,6 +2279,9 @@ class Profile():
     D_area_wb_error = 0.
     D_peakarea_wb_error = None
     D_height_wb_error = None
+
+    # log10D grid, RSS, and initial values from the last fitD grid search
+    rss_grid = None
     
     def set_all_thicknesses_from_SiO(self):
         """Individually set thicknesses for all spectra based on the area
@@ -1505,9 +2352,11 @@ class Profile():
                     max(self.thick_microns_list)+0.05*max(self.thick_microns_list))
         return fig, ax            
 
-    def make_spectra_list(self, set_thickness=True):
+    def make_spectra_list(self, set_thickness=True, prefetch=False,
+                          threads=PREFETCH_THREADS):
         """Set profile length and generate spectra_list 
-        with key attributes"""
+        with key attributes. With prefetch=True, the data for all spectra
+        are read at once before thicknesses are set."""
         try:
             if (self.raypath is not None) and (self.raypath == self.direction):
                 print "raypath cannot be the same as profile direction"
@@ -1533,10 +2382,43 @@ class Profile():
             spec.sample = self.sample
             spec.raypath = self.raypath
 
+        if prefetch is True:
+            self.prefetch(threads=threads)
+
         if set_thickness is True:
             self.set_thicknesses()
         return
 
+    def make_spectra_table(self, load=False, threads=PREFETCH_THREADS,
+                           use_cache=False):
+        """Makes a SpectraTable for the spectra in fname_list without making
+        a Spectrum for each one, and reads the data if load=True"""
+        if len(self.fname_list) == 0:
+            print 'Need fnames'
+            return False
+        positions = {}
+        if self.direction in RAYPATH_CODES and \
+           len(self.positions_microns) == len(self.fname_list):
+            positions['position_microns_' + self.direction] = \
+                self.positions_microns
+        table = SpectraTable(self.fname_list, folder=self.folder, 
+                             thick_microns=self.thick_microns,
+                             raypath=self.raypath, **positions)
+        if load is True:
+            table.load(threads=threads, use_cache=use_cache)
+        self.spectra_table = table
+        return table
+
+    def prefetch(self, initial_too=False, threads=PREFETCH_THREADS, 
+                 use_cache=None):
+        """Reads the data for all spectra in the profile (and its initial
+        profile) at once using a pool of threads. Returns a list of 
+        (filename, error message) for files that could not be read."""
+        spectra = list(self.spectra_list)
+        if initial_too is True and self.initial_profile is not None:
+            spectra = spectra + list(self.initial_profile.spectra_list)
+        return prefetch_spectra(spectra, threads=threads, use_cache=use_cache)
+
     def set_thicknesses(self):
         """Sets thickness for each spectrum and makes list of thickness for profile"""
         if self.thick_microns_list is None:
@@ -1738,6 +2620,23 @@ class Profile():
                 print 'peak positions:', peaklist
                 return False
         return areas
+
+    def make_area_error_list(self, main_yshift=None, window_large=None,
+                             window_small=None):
+        """Make list of the uncertainty in the bulk area of each spectrum 
+        from the spread of 3 baselines (see Spectrum.baseline_area_spread)
+        and store it in attribute area_errors_list."""
+        if len(self.spectra_list) < 1:
+            check = self.make_spectra_list()
+            if check is False:
+                return False
+        errors = []
+        for spec in self.spectra_list:
+            area, error = spec.baseline_area_spread(main_yshift, window_large,
+                                                    window_small)
+            errors.append(error)
+        self.area_errors_list = np.array(errors)
+        return self.area_errors_list
         
     def get_peakfit(self, peak_ending='-peakfit.CSV',
                     baseline_ending='-baseline.CSV'):
@@ -2445,8 +3344,12 @@ class Profile():
                        heights_instead=False, points=200., symmetric=True,
                        labelD=True, labelDx=None, labelDy=None,
                        erf_or_sum='erf', label4legend=None,
-                       initial_unit_value=1., final_unit_value=0.):
-        """Plot diffusion curve with profile data."""
+                       initial_unit_value=1., final_unit_value=0.,
+                       forward_model='erf', history=None):
+        """Plot diffusion curve with profile data.
+        Set forward_model='history' to use the finite-difference model with
+        the temperature and boundary histories in the dictionary history
+        (see diffusion.diffusion1D_history_kernel)."""
         if wholeblock is True and self.initial_profile is None:
             print 'Need to specify an initial profile'
             return False, False
@@ -2496,20 +3399,25 @@ class Profile():
        
         # Setup and plot diffusion curves
         if symmetric is True:
-            params = diffusion.params_setup1D(microns, log10D_m2s, time_seconds,
+            x_diffusion, y_diffusion = diffusion.diffusion1D_forward(microns, 
+                                              log10D_m2s, time_seconds,
                                               init=initial_unit_value, 
-                                              fin=final_unit_value)
-            x_diffusion, y_diffusion = diffusion.diffusion1D_params(params, 
-                                                                    points=points)        
+                                              fin=final_unit_value,
+                                              points=points,
+                                              forward_model=forward_model,
+                                              erf_or_sum=erf_or_sum,
+                                              history=history)
             if centered is False:
                 x_diffusion = x_diffusion + (self.length_microns/2.)
         else:
-            params = diffusion.params_setup1D(microns*2, log10D_m2s, 
-                                              time_seconds,
+            x_diffusion, y_diffusion = diffusion.diffusion1D_forward(microns*2,
+                                              log10D_m2s, time_seconds,
                                               init=initial_unit_value, 
-                                              fin=final_unit_value)
-            x_diffusion, y_diffusion = diffusion.diffusion1D_params(params, 
-                                                                points=points)        
+                                              fin=final_unit_value,
+                                              points=points,
+                                              forward_model=forward_model,
+                                              erf_or_sum=erf_or_sum,
+                                              history=history)
             x_diffusion = x_diffusion[int(points/2):]
             y_diffusion = y_diffusion[int(points/2):]
 
@@ -2539,7 +3447,8 @@ class Profile():
                             heights_instead=False, peak_idx=None,
                             initial_unit_value=1., final_unit_value=0.,
                             show_plot=True, top=1.2, 
-                            maximum_value=None):
+                            maximum_value=None, forward_model='erf',
+                            history=None):
         """Compare 1D diffusion curve with profile data.
         Returns vector containing the residuals and 
         and the variance = sqrt(sum of squares of the residuals)"""
@@ -2564,11 +3473,12 @@ class Profile():
             
         fin = final_unit_value
         
-        params = diffusion.params_setup1D(L, log10D_m2s, t, init, fin, 
-                                          False, False, False)
-
-        xdif, model = diffusion.diffusion1D_params(params)
-        resid = diffusion.diffusion1D_params(params, x, y)
+        # data positions start at 0
+        xdif, model = diffusion.diffusion1D_forward(L, log10D_m2s, t, init, fin,
+                                        x_microns=np.array(x) - L/2.,
+                                        forward_model=forward_model,
+                                        history=history)
+        resid = model - y
         RSS = np.sum(resid**2)
 #        plt.plot(x-L/2., y, '+k')
 #        plt.plot(xdif, model, '-r')
@@ -2577,17 +3487,37 @@ class Profile():
             f, ax = self.plot_diffusion(log10D_m2s, t, peak_idx, top,
                                         wholeblock=wholeblock, 
                                         heights_instead=heights_instead,
-                                        maximum_value=maximum_value)
+                                        maximum_value=maximum_value,
+                                        forward_model=forward_model,
+                                        history=history)
         return resid, RSS
             
     def fitD(self, time_seconds=None, points=200, 
              initial_unit_value=1., vary_initial=True,
-             varyD=True, guess=-13., peak_idx=None, top=1.2, 
+             varyD=True, guess=None, peak_idx=None, top=1.2, 
              peakwn=None, wholeblock=True, centered=False,
              show_plot=True, polyorder=1, heights_instead=False,
              final_unit_value=0., vary_final=False, 
-             maximum_value=None, min_water=0., symmetric=False):
-        """Fits 1D diffusion curve to profile data."""
+             maximum_value=None, min_water=0., symmetric=False,
+             forward_model='erf', history=None):
+        """Fits 1D diffusion curve to profile data.
+        
+        The default forward model uses the constant-condition error function
+        solution. For heating and cooling ramps or changes in the surface
+        concentration, set forward_model='history' and pass the keywords
+        for diffusion.diffusion1D_history_kernel (celsius_history, 
+        boundary_history, Ea_kJmol, ...) in the dictionary history. 
+        The best-fit log10D is then at the reference temperature.
+        
+        Without a guess for log10D, the fit starts from the best log10D on 
+        a grid (see diffusion.rss_grid1D), which is saved along with the 
+        RSS at each log10D as the attribute rss_grid.
+        
+        For a diffusivity that depends on concentration, set 
+        forward_model='DC'. The slope of log10D with unit concentration is
+        fit along with log10D, which is then the diffusivity at the initial
+        unit concentration 1. Pass an initial guess for the slope as 
+        log10D_slope in history (default 0)."""
         if self.time_seconds is None and time_seconds is None:
             print 'Need time_seconds'
             return
@@ -2617,6 +3547,15 @@ class Profile():
         D0 = guess
         init = initial_unit_value
         fin = final_unit_value
+
+        # coarse search over all log10D for a place to start
+        if guess is None:
+            self.rss_grid = diffusion.rss_grid1D(x, y, L, t, init=init, fin=fin,
+                                                 vary_init=vary_initial)
+            log10D_grid, RSS, inits = self.rss_grid
+            best = np.nanargmin(RSS)
+            D0 = log10D_grid[best]
+            init = inits[best]
         params = diffusion.params_setup1D(L, D0, t, init, fin, vD=varyD, 
                                           vinit=vary_initial, vfin=vary_final)
 
@@ -2625,9 +3564,29 @@ class Profile():
 #                        'centered' : centered
                         }
 
-#        # minimization
-        lmfit.minimize(diffusion.diffusion1D_params, params, args=(x, y), 
-                       kws=dict_fitting)
+        if forward_model == 'history':
+            if history is not None:
+                dict_fitting.update(history)
+            lmfit.minimize(diffusion.diffusion1D_history_params, params, 
+                           args=(x, y), kws=dict_fitting)
+        elif forward_model == 'DC':
+            history = dict(history or {})
+            params.add('log10D_slope', history.pop('log10D_slope', 0.))
+            dict_fitting.update(history)
+            lmfit.minimize(diffusion.diffusion1D_DC_params, params, 
+                           args=(x, y), kws=dict_fitting)
+            best_slope = ufloat(params['log10D_slope'].value, 
+                                params['log10D_slope'].stderr)
+            print 'best-fit log10D slope', best_slope
+            history['log10D_slope'] = best_slope.n
+        elif forward_model == 'erf':
+#            # minimization, with analytic derivatives
+            lmfit.minimize(diffusion.diffusion1D_params, params, args=(x, y), 
+                           kws=dict_fitting, 
+                           Dfun=diffusion.diffusion1D_jacobian, col_deriv=1)
+        else:
+            print 'forward_model must be "erf", "history", or "DC"'
+            return
         best_D = ufloat(params['log10D_m2s'].value, 
                         params['log10D_m2s'].stderr)
         best_init = ufloat(params['initial_unit_value'].value, 
@@ -2666,7 +3625,9 @@ class Profile():
                                               initial_unit_value=best_init.n,
                                               final_unit_value=final_unit_value,
                                               show_plot=False,
-                                              maximum_value=best_init.n)
+                                              maximum_value=best_init.n,
+                                              forward_model=forward_model,
+                                              history=history)
         # report results
         print '\ntime in hours:', params['time_seconds'].value / 3600.
         print 'initial unit value:', '{:.2f}'.format(best_init*scaling_factor)
@@ -2681,36 +3642,117 @@ class Profile():
                                           symmetric=symmetric,
                                           heights_instead=heights_instead, 
                                           maximum_value=best_init.n*scaling_factor,
-                                          final_unit_value=final_unit_value
+                                          final_unit_value=final_unit_value,
+                                          forward_model=forward_model,
+                                          history=history
                                           )
             return fig, ax
 #        else:
 #            return 1, 2
 ##        return best_D, best_init, RSS
 
-    def save_diffusivities(self, folder=None, 
-                           file_ending='-diffusivities.txt'):
-        """Save diffusivities for profile to a file"""
-        if folder is None:
-            folder = self.folder
-            
-        if self.short_name is None:
-            print 'Need profile short_name attribute to label file'
+    def ensemble_errors(self, peak_idx=None, heights_instead=False,
+                        sigma_length_microns=None, sigma_y=None):
+        """Returns the uncertainty in the profile length from the sample's
+        thickness measurements along the profile direction and the relative
+        uncertainty in each bulk area from the spread of 3 baselines. 
+        Values passed in are returned as they are. Anything not available
+        is 0. The baselines only apply to bulk areas, not peaks or heights.
+        """
+        if sigma_length_microns is None:
+            sigma_length_microns = 0.
+            if self.sample is not None and self.direction in ['a', 'b', 'c']:
+                errors = self.sample.get_thickness_errors()
+                sigma_length_microns = errors['abc'.find(self.direction)]
+
+        if sigma_y is None:
+            sigma_y = 0.
+            if peak_idx is None and heights_instead is False:
+                if self.area_errors_list is None:
+                    self.make_area_error_list()
+                if self.areas_list is None:
+                    self.make_area_list()
+                if self.area_errors_list is not False:
+                    sigma_y = (np.array(self.area_errors_list, dtype=float) / 
+                               np.array(self.areas_list, dtype=float))
+        return sigma_length_microns, sigma_y
+
+    def fitD_ensemble(self, time_seconds=None, N=2000, sigma_x_microns=0.,
+                      sigma_length_microns=None, sigma_y=None, 
+                      peak_idx=None, wholeblock=True, heights_instead=False,
+                      initial_unit_value=1., vary_initial=True, 
+                      final_unit_value=0., guess=None, processes=1, 
+                      seed=None, percentiles=(2.5, 16., 50., 84., 97.5)):
+        """Monte Carlo uncertainty for fitD with the erf model. 
+        
+        Refits N copies of the data with normal errors in the positions 
+        (sigma_x_microns), the length, and the y data using
+        diffusion.fit_diffusion1D_ensemble. By default the length error 
+        comes from the sample thickness measurements and the y errors from 
+        the spread of 3 baselines under each spectrum as a fraction of 
+        each area (see ensemble_errors). Nothing is plotted.
+
+        Returns the dictionary from fit_diffusion1D_ensemble with the 
+        initial values back in data units.
+        """
+        if self.time_seconds is None and time_seconds is None:
+            print 'Need time_seconds'
+            return
+        elif time_seconds is None:
+            time_seconds = self.time_seconds            
+
+        if self.length_microns is None:
+            print 'Need to set profile attribute length_microns'
             return
             
-        if self.peakpos is None:
-            self.get_peakfit()
+        if self.positions_microns is None:
+            print 'Need to set profile positions'
+            return
+
+        if self.areas_list is None:
+            self.make_area_list()
 
-        # Same format as output by print_diffusivities:
+        y = np.array(self.y_data_picker(wholeblock, heights_instead, 
+                                        peak_idx), dtype=float)
+        scaling_factor = max(y)
+        y = y / scaling_factor
+        sigma_length_microns, sigma_y = self.ensemble_errors(peak_idx, 
+                                        heights_instead, sigma_length_microns,
+                                        sigma_y)
+
+        results = diffusion.fit_diffusion1D_ensemble(self.positions_microns, 
+                                y, self.length_microns, time_seconds, N=N,
+                                sigma_x_microns=sigma_x_microns,
+                                sigma_length_microns=sigma_length_microns,
+                                sigma_y=sigma_y, relative_y=True,
+                                log10D_guess=guess, 
+                                init_guess=initial_unit_value,
+                                fin=final_unit_value, vary_init=vary_initial,
+                                percentiles=percentiles, processes=processes,
+                                seed=seed)
+        results['initial'] = results['initial'] * scaling_factor
+        results['initial_percentiles'] = (results['initial_percentiles'] * 
+                                          scaling_factor)
+
+        print 'converged', np.sum(results['converged']), 'of', N
+        for k, p in enumerate(results['percentiles']):
+            print '{:5.1f}'.format(p), 'percentile log10D m2/s', 
+            print '{:.2f}'.format(results['log10D_percentiles'][k]),
+            print 'initial', '{:.2f}'.format(results['initial_percentiles'][k])
+        return results
+
+    def diffusivities_list(self):
+        """Returns list of diffusivities in the format used by 
+        save_diffusivities and print_diffusivities"""
         # Diffuvities from WB areas - area - WB heights - heights 
         # Diffusivity - error - maximum value to scale up to for each
-
-        # Saving diffusivities in first column, errors in 2nd, 
-        # Bulk H in first row, then each peak-specific value
+        # Bulk H in first two rows, then each peak-specific value
         a = []
         a.append([self.D_area_wb, self.D_area_wb_error, self.maximum_wb_area])
         a.append([self.D_area,    self.D_area_error,    self.maximum_area])
         
+        if self.peakpos is None:
+            return json_ready(a)
         for k in range(len(self.peakpos)):
             a.append([self.D_peakarea_wb[k], self.D_peakarea_wb_error[k],
                      self.peak_maximum_areas_wb[k]])
@@ -2721,6 +3763,82 @@ class Profile():
                      self.peak_maximum_heights_wb[k]])
             a.append([self.D_height[k],
                      self.D_height_error[k], self.peak_maximum_heights[k]])
+        return json_ready(a)
+
+    def set_diffusivities_list(self, diffusivities):
+        """Sets diffusivities from list in the format made by
+        diffusivities_list. Peak-specific values need self.peakpos."""
+        self.D_area_wb = diffusivities[0][0]
+        self.D_area_wb_error = diffusivities[0][1]
+        self.maximum_wb_area = diffusivities[0][2]
+        
+        self.D_area = diffusivities[1][0]
+        self.D_area_error = diffusivities[1][1]
+        self.maximum_area = diffusivities[1][2]
+
+        npeaks = (len(diffusivities) - 2) // 4
+        for k in range(npeaks):
+            self.D_peakarea_wb[k] = diffusivities[2+4*k][0]
+            self.D_peakarea_wb_error[k] = diffusivities[2+4*k][1]
+            self.peak_maximum_areas_wb[k] = diffusivities[2+4*k][2]
+            self.D_peakarea[k] = diffusivities[3+4*k][0]
+            self.D_peakarea_error[k] = diffusivities[3+4*k][1]
+            self.peak_maximum_areas[k] = diffusivities[3+4*k][2]
+            self.D_height_wb[k] = diffusivities[4+4*k][0]
+            self.D_height_wb_error[k] = diffusivities[4+4*k][1]
+            self.peak_maximum_heights_wb[k] = diffusivities[4+4*k][2]
+            self.D_height[k] = diffusivities[5+4*k][0]
+            self.D_height_error[k] = diffusivities[5+4*k][1]
+            self.peak_maximum_heights[k] = diffusivities[5+4*k][2]
+
+    def save_archive(self, filename=None, get_data=True):
+        """Saves the profile, its initial profile, and all their spectra,
+        baselines, peak fits, and diffusivities to a single archive file, 
+        by default folder + short_name + ARCHIVE_ENDING"""
+        if filename is None:
+            if self.short_name is None:
+                print 'Need profile short_name attribute to label file'
+                return
+            filename = ''.join((self.folder, self.short_name, ARCHIVE_ENDING))
+        arrays, records, spectrum_records = pack_profiles([self], get_data)
+        write_archive(filename, arrays, {'profiles' : records, 
+                                         'spectra' : spectrum_records})
+        return filename
+
+    def get_archive(self, filename=None):
+        """Sets up the profile from an archive made by save_archive. 
+        Spectra data are views into the memory-mapped file."""
+        if filename is None:
+            if self.short_name is None:
+                print 'Need profile short_name attribute to find file'
+                return
+            filename = ''.join((self.folder, self.short_name, ARCHIVE_ENDING))
+        archive = read_archive(filename)
+        if archive is None:
+            return
+        arrays, metadata = archive
+        profiles = unpack_profiles(arrays, metadata['profiles'], 
+                                   metadata['spectra'])
+        loaded = profiles[0]
+        self.__dict__.update(loaded.__dict__)
+        if self.initial_profile is loaded:
+            self.initial_profile = self
+        return self
+
+    def save_diffusivities(self, folder=None, 
+                           file_ending='-diffusivities.txt'):
+        """Save diffusivities for profile to a file"""
+        if folder is None:
+            folder = self.folder
+            
+        if self.short_name is None:
+            print 'Need profile short_name attribute to label file'
+            return
+            
+        if self.peakpos is None:
+            self.get_peakfit()
+
+        a = self.diffusivities_list()
         
         workfile = ''.join((folder, self.short_name, file_ending))
         with open(workfile, 'w') as diff_file:
@@ -2753,35 +3871,14 @@ class Profile():
 
         diffusivities = json.loads(diffusivities_string)
 
-        self.D_area_wb = diffusivities[0][0]
-        self.D_area_wb_error = diffusivities[0][1]
-        self.maximum_wb_area = diffusivities[0][2]
-        
-        self.D_area = diffusivities[1][0]
-        self.D_area_error = diffusivities[1][1]
-        self.maximum_area = diffusivities[1][2]
-        
         if self.peakpos is None:
             self.get_peakfit()
         if self.peakpos is None:
             print 'Having trouble getting peakfit info to grab diffusivities'
+            self.set_diffusivities_list(diffusivities[:2])
             return            
-                    
-        npeaks = len(self.peakpos)
-        for k in range(npeaks):
-            self.D_peakarea_wb[k] = diffusivities[2+4*k][0]
-            self.D_peakarea_wb_error[k] = diffusivities[2+4*k][1]
-            self.peak_maximum_areas_wb[k] = diffusivities[2+4*k][2]
-            self.D_peakarea[k] = diffusivities[3+4*k][0]
-            self.D_peakarea_error[k] = diffusivities[3+4*k][1]
-            self.peak_maximum_areas[k] = diffusivities[3+4*k][2]
-            self.D_height_wb[k] = diffusivities[4+4*k][0]
-            self.D_height_wb_error[k] = diffusivities[4+4*k][1]
-            self.peak_maximum_heights_wb[k] = diffusivities[4+4*k][2]
-            self.D_height[k] = diffusivities[5+4*k][0]
-            self.D_height_error[k] = diffusivities[5+4*k][1]
-            self.peak_maximum_heights[k] = diffusivities[5+4*k][2]
-        
+
+        self.set_diffusivities_list(diffusivities)
         return diffusivities
         
     def print_diffusivities(self, show_on_screen=True):
@@ -2869,7 +3966,7 @@ class Profile():
                 if check is False:
                     return False
             # print 'Setting to zero at wn_matchup'
-            index = (np.abs(x.wn_full - wn_matchup)).argmin()
+            index = nearest_index(x.wn_full, wn_matchup)
             abs_matched = (x.abs_full_cm - x.abs_full_cm[index]) + offset
             x.abs_full_cm = abs_matched
         return
@@ -2916,12 +4013,13 @@ class TimeSeries(Profile):
         ax.set_ylabel('Concentration/\nMaximum Concentration', fontsize=12)
         ax.set_xlim(0, max_hours)
 
-        # curves for diffusivities in D_list    
-        for D in D_list:
-             t, cc = diffusion.diffusionThinSlab(log10D_m2s=D, 
-                                        thickness_microns=thickness_microns, 
+        # curves for diffusivities in D_list, all calculated at once
+        if len(D_list) > 0:
+            t, cc = diffusion.diffusionThinSlab(log10D_m2s=np.array(D_list),
+                                        thickness_microns=thickness_microns,
                                         max_time_hours=max_hours)
-             ax.plot(t, cc, '-k', linewidth=1)
+            for curve in cc:
+                ax.plot(t, curve, '-k', linewidth=1)
     
         # plot area data
         x = self.times_hours
@@ -2957,7 +4055,7 @@ def subtract_2spectra(list2, wn_high=4000, wn_low=3000):
             print x, 'is not a Spectrum'
             return
         # Check for and if necessary make absorbance and wavenumber full range
-        if x.abs_full_cm is None:
+        if x.zero_range is None:
             check = x.start_at_zero()
             if check is False:
                 return False
@@ -2966,8 +4064,8 @@ def subtract_2spectra(list2, wn_high=4000, wn_low=3000):
 
     # Set up wavenumber list for just the main spectrum 0
     x = list2[0]
-    index_lo = (np.abs(x.wn_full-wn_low)).argmin()
-    index_hi = (np.abs(x.wn_full-wn_high)).argmin()
+    index_lo = nearest_index(x.wn_full, wn_low)
+    index_hi = nearest_index(x.wn_full, wn_high)
     
     wn_upper_spectrum = x.wn_full[index_lo:index_hi]
     abs_upper_spectrum = x.abs_full_cm[index_lo:index_hi]
@@ -2976,7 +4074,7 @@ def subtract_2spectra(list2, wn_high=4000, wn_low=3000):
     idx = 0
     for wn in wn_upper_spectrum:
         # find index of nearest wavenumber in spectrum to be subtracted off
-        idx_subtract = (np.abs(list2[1].wn_full-wn)).argmin()
+        idx_subtract = nearest_index(list2[1].wn_full, wn)
         # subtract
 #        abs_difference[idx] = (x.abs_full_cm[idx_upper_spectrum] - 
 #                           list2[1].abs_full_cm[idx_subtract])
@@ -3133,6 +4231,84 @@ def plotsetup_3stacked(yhi=2, ylo=0, xlo = 3200, xhi = 3800,
         plt.setp(ax.get_xticklabels(), visible=False)
     return axis_list
 
+#%% Fit diffusivities to many profiles and peaks at once
+def fitD_batch(profiles, targets=[(None, False, True)], time_seconds=None,
+               guess=None, initial_unit_value=None, vary_initial=True,
+               final_unit_value=0., max_iterations=200):
+    """Fits 1D diffusivities like Profile.fitD for every profile and
+    every target at once without any plotting. 
+    targets is a list of (peak_idx, heights_instead, wholeblock) as
+    used by Profile.fitD. The default is just bulk whole-block areas.
+
+    The data are scaled to a maximum of 1 as in Profile.fitD, stacked 
+    together, and all fit at the same time with 
+    diffusion.fit_diffusion1D_batch. Without guess, each case starts from
+    the best log10D of a grid search as in Profile.fitD, and without 
+    initial_unit_value from the best initial value there.
+
+    Returns a list of dictionaries, one per profile and target in order,
+    with keys profile, peak_idx, heights_instead, wholeblock, log10D, 
+    error, initial (back in data units), and RSS (of the scaled data).
+    Profiles missing time, length, or positions are left out.
+    """
+    cases = []
+    x_list = []
+    y_list = []
+    lengths = []
+    times = []
+    for prof in profiles:
+        if prof.time_seconds is None and time_seconds is None:
+            print prof.profile_name, 'needs time_seconds'
+            continue
+        elif time_seconds is None:
+            t = prof.time_seconds
+        else:
+            t = time_seconds
+
+        if prof.length_microns is None:
+            print prof.profile_name, 'needs attribute length_microns'
+            continue
+            
+        if prof.positions_microns is None:
+            print prof.profile_name, 'needs profile positions'
+            continue
+
+        if prof.areas_list is None:
+            prof.make_area_list()
+
+        for peak_idx, heights_instead, wholeblock in targets:
+            y = np.array(prof.y_data_picker(wholeblock, heights_instead, 
+                                            peak_idx), dtype=float)
+            scaling_factor = max(y)
+            cases.append((prof, peak_idx, heights_instead, wholeblock,
+                          scaling_factor))
+            x_list.append(prof.positions_microns)
+            y_list.append(y / scaling_factor)
+            lengths.append(prof.length_microns)
+            times.append(t)
+
+    if len(cases) == 0:
+        return []
+
+    fit = diffusion.fit_diffusion1D_batch(x_list, y_list, lengths, times,
+                                          log10D_guess=guess, 
+                                          init_guess=initial_unit_value,
+                                          fin=final_unit_value,
+                                          vary_init=vary_initial,
+                                          max_iterations=max_iterations)
+    results = []
+    for k, case in enumerate(cases):
+        prof, peak_idx, heights_instead, wholeblock, scaling_factor = case
+        results.append({'profile' : prof,
+                        'peak_idx' : peak_idx,
+                        'heights_instead' : heights_instead,
+                        'wholeblock' : wholeblock,
+                        'log10D' : fit['log10D'][k],
+                        'error' : fit['log10D_error'][k],
+                        'initial' : fit['initial'][k] * scaling_factor,
+                        'RSS' : fit['RSS'][k]})
+    return results
+
 #%% Generate 3D whole-block area and water profiles
 def make_3DWB_area_profile(final_profile, 
                            initial_profile=None, 
@@ -3345,7 +4521,8 @@ class WholeBlock():
                  make_wb_areas=False, time_seconds=None, worksheetname=None,
                  style_base = None, temperature_celsius=None,
                  diffusivities_log10_m2s=None, get_baselines=False,
-                 diffusivity_errors=None, sample=None, D_area_wb=[-12., -12., -12.]):
+                 diffusivity_errors=None, sample=None, D_area_wb=[-12., -12., -12.],
+                 prefetch=False):
         self.profiles = profiles
         self.folder = folder
         self.name = name
@@ -3358,13 +4535,19 @@ class WholeBlock():
         self.D_area_wb_error = [0., 0., 0.]
         self.peak_diffusivities = []
         self.peak_diffusivities_errors = []
+        # log10D grid and 3D RSS array from the last fitD grid search
+        self.rss_grid = None
+        # chains and percentiles from the last sampleD
+        self.posterior = None
         
         if len(self.profiles) > 0:
             self.setupWB(peakfit=peakfit, make_wb_areas=make_wb_areas,
-                         get_baselines=get_baselines)
+                         get_baselines=get_baselines, prefetch=prefetch)
                 
-    def setupWB(self, peakfit=False, make_wb_areas=False, get_baselines=False):
+    def setupWB(self, peakfit=False, make_wb_areas=False, get_baselines=False,
+                prefetch=False):
         """Sets up and checks WholeBlock instance
+        - With prefetch=True, first read all spectra files at once
         - Check that profiles list contains a list of three (3) profiles
         - Generate list of initial profiles
         - Generate list of profile directions
@@ -3375,6 +4558,8 @@ class WholeBlock():
         if len(self.profiles) != 3:
             print 'For now, only a list of 3 profiles is allowed'
             return False
+        if prefetch is True:
+            self.prefetch()
         d = []
         r = []
         ip = []
@@ -3439,6 +4624,18 @@ class WholeBlock():
 
         return True
 
+    def prefetch(self, initial_too=True, threads=PREFETCH_THREADS, 
+                 use_cache=None):
+        """Reads the data for all spectra in all profiles (and initial 
+        profiles) at once using one pool of threads. Returns a list of 
+        (filename, error message) for files that could not be read."""
+        spectra = []
+        for prof in self.profiles:
+            spectra = spectra + list(prof.spectra_list)
+            if initial_too is True and prof.initial_profile is not None:
+                spectra = spectra + list(prof.initial_profile.spectra_list)
+        return prefetch_spectra(spectra, threads=threads, use_cache=use_cache)
+
     def get_peakfit(self, peak_ending='-peakfit.CSV', 
                     baseline_ending='-baseline.CSV'):
         """Get peakfit information for all profiles"""
@@ -4453,6 +5650,60 @@ class WholeBlock():
         print prof.D_peakarea_wb
         print prof.peak_D_area_wb_error
 
+    def save_archive(self, filename=None, get_data=True):
+        """Saves the whole-block profiles, initial profiles, spectra, 
+        baselines, peak fits, and diffusivities to a single archive file,
+        by default folder + name + ARCHIVE_ENDING"""
+        if filename is None:
+            filename = ''.join((self.folder, self.name, ARCHIVE_ENDING))
+        arrays, records, spectrum_records = pack_profiles(self.profiles, 
+                                                          get_data)
+        wb = {'name' : self.name, 'folder' : self.folder,
+              'time_seconds' : self.time_seconds,
+              'temperature_celsius' : self.temperature_celsius,
+              'worksheetname' : self.worksheetname,
+              'D_area_wb' : self.D_area_wb, 
+              'D_area_wb_error' : self.D_area_wb_error,
+              'profiles' : range(len(self.profiles)),
+              'lengths' : getattr(self, 'lengths', None)}
+        write_archive(filename, arrays, {'profiles' : records, 
+                                         'spectra' : spectrum_records,
+                                         'wholeblock' : wb})
+        return filename
+
+    def get_archive(self, filename=None):
+        """Sets up the whole-block from an archive made by save_archive
+        with a single file open. Spectra data are views into the 
+        memory-mapped file."""
+        if filename is None:
+            filename = ''.join((self.folder, self.name, ARCHIVE_ENDING))
+        archive = read_archive(filename)
+        if archive is None:
+            return
+        arrays, metadata = archive
+        if 'wholeblock' not in metadata:
+            print filename, 'is not a whole-block archive'
+            return
+        profiles = unpack_profiles(arrays, metadata['profiles'], 
+                                   metadata['spectra'])
+        wb = metadata['wholeblock']
+        self.profiles = [profiles[k] for k in wb['profiles']]
+        for key in ['name', 'folder', 'time_seconds', 'temperature_celsius',
+                    'worksheetname', 'D_area_wb', 'D_area_wb_error']:
+            setattr(self, key, wb[key])
+        self.sample = self.profiles[0].sample
+        self.directions = [prof.direction for prof in self.profiles]
+        self.raypaths = [prof.raypath for prof in self.profiles]
+        for prof in self.profiles:
+            if prof.initial_profile is None:
+                prof.initial_profile = prof
+        self.initial_profiles = [prof.initial_profile for prof in self.profiles]
+        if wb['lengths'] is not None:
+            self.lengths = wb['lengths']
+        else:
+            self.lengths = [prof.length_microns for prof in self.profiles]
+        return self
+
     def save_diffusivities(self, folder=None, 
                            file_ending='-diffusivities.txt'):
         """Save diffusivities for all profiles in whole-block instance
@@ -4482,14 +5733,15 @@ class WholeBlock():
                        heights_instead=False, init=1., centered=True,
                        fin=0, approximation1D=False, labelD=True,
                        show_errorbars=True, labelDy=None, 
-                       labelDx=[None, None, None]):
+                       labelDx=[None, None, None], adi_kws=None):
         """For whole-block data. See above for profiles.
         Applies 3-dimensionsal diffusion equations using equations in 
         pynams.diffusion and plots them on 3 panels with whole-block data.
         Requires lengths, time in seconds, and three diffusivities either
         explicitly passed here or as attributes of the WholeBlock object.
         Assuming whole-block diffusion (wb_or_3Dnpi='wb') but could also 
-        do 3D non-path-integrated ('npi')
+        do 3D non-path-integrated ('npi') or the whole-block 
+        finite-difference model ('adi') with keywords in adi_kws.
         """        
         if self.lengths is None:
             self.setupWB(peakfit=False, make_wb_areas=False)
@@ -4497,8 +5749,8 @@ class WholeBlock():
             print 'Need to setup self.lengths, which is in microns'
             return False
 
-        if (wb_or_3Dnpi != 'npi') and (wb_or_3Dnpi != 'wb'):
-            print 'wb_or_3Dnpi only takes "wb" or "npi"'
+        if wb_or_3Dnpi not in ['npi', 'wb', 'adi']:
+            print 'wb_or_3Dnpi only takes "wb", "npi", or "adi"'
             return False
 
         if self.directions is None:           
@@ -4544,10 +5796,18 @@ class WholeBlock():
         params = diffusion.params_setup3D(L3, D3, time_seconds, 
                                           init, fin)
 
-        xdiff, ydiff = diffusion.diffusion3Dwb_params(params, 
-                                                      raypaths=self.raypaths, 
-                                                      erf_or_sum=erf_or_sum,
-                                                      show_plot=False)
+        if wb_or_3Dnpi == 'adi':
+            # same grid as the fit, set by points in adi_kws
+            if adi_kws is None:
+                adi_kws = {}
+            xdiff, ydiff = diffusion.diffusion3Dadi_kernel(L3, D3, 
+                                                      time_seconds,
+                                                      self.raypaths, init, fin,
+                                                      **adi_kws)
+        else:
+            xdiff, ydiff = diffusion.diffusion3Dwb_kernel(L3, D3, time_seconds,
+                                                      self.raypaths, init, fin,
+                                                      erf_or_sum=erf_or_sum)
         if show_plot is False:
             return params, xdiff, ydiff
             
@@ -4598,16 +5858,32 @@ class WholeBlock():
             return params, fig, fig_ax
        
     def fitD(self, peak_idx=None, init=1., fin=0.,
-             guesses_log10D=[-13., -13., -13.], 
+             guesses_log10D=None, 
              heights_instead=False, wholeblock=True,
              vary_initials=False, vary_finals=False, 
              vary_diffusivities=[True, True, True],
              erf_or_sum='erf',
              show_plot=True, wb_or_3Dnpi='wb', centered=True,
              show_initial_guess=True, style_initial=None,
-             style_final={'color' : 'red'}, points=50, top=1.2):
+             style_final={'color' : 'red'}, points=50, top=1.2,
+             exact_positions=True, adi_kws=None):
         """Forward modeling to determine diffusivities in three dimensions 
         from whole-block data. 
+        
+        With exact_positions=True (default), the whole-block model is 
+        evaluated right at the data positions instead of on a grid of 
+        points, so points only matters for the npi model.
+
+        wb_or_3Dnpi='adi' uses the 3D finite-difference whole-block model 
+        for cases that are not separable. Keywords for 
+        diffusion.diffusion3Dadi_params go in the dictionary adi_kws, 
+        and including log10D_slope there also fits how D depends on 
+        concentration. Its grid is set by points in adi_kws (default 
+        'auto'), not by points.
+
+        Without guesses_log10D, the fit starts from the best cell of a grid
+        of log10D in all three directions (see diffusion.rss_grid3D), which
+        is saved along with the RSS array as the attribute rss_grid.
         """        
         # x and y are the data that we will fit to, centered for fitting
         x, y = self.xy_picker(peak_idx, wholeblock, heights_instead, 
@@ -4618,44 +5894,46 @@ class WholeBlock():
         D3 = []
         e3 = []
 
-        # set up fitting parameters in the reqquired format
-        params = diffusion.params_setup3D(microns3=self.lengths, 
-                 log10D3=guesses_log10D, 
-                 time_seconds=self.time_seconds, 
-                 initial=init, final=fin,
-                 vinit=vary_initials, vfin=vary_finals,
-                 vD=vary_diffusivities)
-
-        # other keywords needed for forward model
-        dict_fitting = {'points' : points,
-                        'erf_or_sum' : erf_or_sum} 
+        if wb_or_3Dnpi in ['wb', 'adi'] and self.raypaths is None:
+            self.setupWB()
 
-        if wb_or_3Dnpi == 'wb':
-            # need raypaths and don't plot twice
-            if self.raypaths is None:
-                self.setupWB()
-            dict_fitting['raypaths'] = self.raypaths
-            dict_fitting['show_plot'] = False
-            
-            # run the minimizer
-            lmfit.minimize(diffusion.diffusion3Dwb_params, 
-                           params, args=(x, y), 
-                           kws=dict_fitting)
-            resid = diffusion.diffusion3Dwb_params(params, x, y, 
-                                            raypaths=self.raypaths,
-                                            erf_or_sum=erf_or_sum,
-                                            show_plot=False)
-        elif wb_or_3Dnpi == 'npi':
-            print 'npi not working well right now, sorry'
-            lmfit.minimize(diffusion.diffusion3Dnpi_params, 
-                           params, args=(x, y), 
-                           kws=dict_fitting)
-     
-            resid = diffusion.diffusion3Dnpi(params, x, y)
-        else:
-            print 'wb_or_3Dnpi can only be wb or npi'
-            return            
+        # coarse search over all log10D for a place to start
+        if guesses_log10D is None:
+            if wb_or_3Dnpi == 'npi':
+                raypaths = None
+            else:
+                raypaths = self.raypaths
+            self.rss_grid = diffusion.rss_grid3D(x, y, self.lengths, 
+                                                 self.time_seconds, raypaths,
+                                                 init=init, fin=fin)
+            if self.rss_grid is None:
+                return
+            log10D_grid, RSS = self.rss_grid
+            best = np.unravel_index(np.nanargmin(RSS), RSS.shape)
+            guesses_log10D = [log10D_grid[i] for i in best]
+
+        # run the minimizer
+        fit = diffusion.fit_diffusion3D(x, y, self.lengths, self.time_seconds,
+                                        raypaths=self.raypaths,
+                                        guesses_log10D=guesses_log10D,
+                                        init=init, fin=fin,
+                                        vary_initials=vary_initials,
+                                        vary_finals=vary_finals,
+                                        vary_diffusivities=vary_diffusivities,
+                                        erf_or_sum=erf_or_sum,
+                                        wb_or_3Dnpi=wb_or_3Dnpi, 
+                                        points=points,
+                                        exact_positions=exact_positions,
+                                        adi_kws=adi_kws)
+        if fit is None:
+            return
+        params, resid = fit
 
+        if 'log10D_slope' in params:
+            adi_kws = dict(adi_kws)
+            adi_kws['log10D_slope'] = params['log10D_slope'].value
+            print '\nbestfit log10D slope:', ufloat(
+                params['log10D_slope'].value, params['log10D_slope'].stderr)
 
         # convert to ufloats because ufloats are fun
         bestD.append(ufloat(params['log10Dx'].value, 
@@ -4673,12 +5951,14 @@ class WholeBlock():
             e3.append(bestD[k].s)
 
         if show_plot is True:
-            if wb_or_3Dnpi == 'wb':
+            if wb_or_3Dnpi in ['wb', 'adi']:
                 self.plot_diffusion(init=init, top=top, 
                                     peak_idx=peak_idx,
                                     diffusivities_log10D_m2s=D3,
                                     heights_instead=heights_instead,
-                                    centered=centered)
+                                    centered=centered, 
+                                    wb_or_3Dnpi=wb_or_3Dnpi,
+                                    points=points, adi_kws=adi_kws)
             else:
                  print 'sorry, only plotting wholeblock right now'
                                              
@@ -4696,17 +5976,249 @@ class WholeBlock():
                             heights_instead, peak_idx)
         return bestD
     
+    def fitD_sweep(self, peak_list=None, bulk=True, areas=True, heights=True,
+                   wholeblock=True, processes=None, init=1., fin=0.,
+                   guesses_log10D=None, 
+                   vary_initials=False, vary_finals=False, 
+                   vary_diffusivities=[True, True, True],
+                   erf_or_sum='erf', wb_or_3Dnpi='wb', points=50,
+                   exact_positions=True):
+        """Fits diffusivities like fitD for bulk hydrogen and for the areas
+        and/or heights of every peak in peak_list (default all peaks) 
+        spread out over a pool of processes, by default one per core. 
+        processes=1 runs everything here without a pool. Nothing is plotted.
+
+        The data are picked out here first, and each fit runs on its own in
+        diffusion.fit_diffusion3D_unit, so the results do not depend on the
+        number of processes. They are saved into the profile diffusivity 
+        attributes with D_saver all at once at the end.
+        Without guesses_log10D, each fit starts from its own grid search.
+        On Windows, call this from under if __name__ == '__main__':
+
+        Returns list of results from fit_diffusion3D_unit in order: 
+        (peak_idx, heights_instead, wholeblock) and a dictionary of 
+        log10D3, errors3, initial, initial_error, and RSS.
+        """
+        if wb_or_3Dnpi == 'wb' and self.raypaths is None:
+            self.setupWB()
+
+        # list of (peak_idx, heights_instead, wholeblock) to fit
+        targets = []
+        if bulk is True:
+            targets.append((None, False, wholeblock))
+
+        if areas is True or heights is True:
+            for prof in self.profiles:
+                if prof.D_peakarea_wb is None:
+                    prof.get_peak_info()
+            if self.profiles[0].peakpos is None:
+                print 'No peak information, so only fitting bulk'
+                peak_list = []
+            elif peak_list is None:
+                peak_list = range(len(self.profiles[0].peakpos))
+            for peak_idx in peak_list:
+                if areas is True:
+                    targets.append((peak_idx, False, wholeblock))
+                if heights is True:
+                    targets.append((peak_idx, True, wholeblock))
+
+        # picklable work units with all the data each fit needs
+        units = []
+        for key in targets:
+            peak_idx, heights_instead, wb = key
+            xy = self.xy_picker(peak_idx, wb, heights_instead, centered=True)
+            if xy is False:
+                print 'Problem getting data for', key
+                continue
+            units.append({'key' : key,
+                          'x' : xy[0],
+                          'y' : xy[1],
+                          'microns3' : self.lengths,
+                          'time_seconds' : self.time_seconds,
+                          'raypaths' : self.raypaths,
+                          'guesses_log10D' : guesses_log10D,
+                          'init' : init,
+                          'fin' : fin,
+                          'vary_initials' : vary_initials,
+                          'vary_finals' : vary_finals,
+                          'vary_diffusivities' : vary_diffusivities,
+                          'erf_or_sum' : erf_or_sum,
+                          'wb_or_3Dnpi' : wb_or_3Dnpi,
+                          'points' : points,
+                          'exact_positions' : exact_positions})
+
+        if processes == 1:
+            results = map(diffusion.fit_diffusion3D_unit, units)
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(diffusion.fit_diffusion3D_unit, units,
+                                   chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+
+        # Store values in profile attributes
+        for key, result in results:
+            if result is None:
+                continue
+            peak_idx, heights_instead, wb = key
+            for k in range(3):
+                self.profiles[k].D_saver(result['log10D3'][k], 
+                                         result['errors3'][k], wb, 
+                                         heights_instead, peak_idx)
+        return results
+    
+    def fitD_ensemble(self, N=500, sigma_x_microns=0., 
+                      sigma_lengths_microns=None, sigma_y=None, 
+                      peak_idx=None, heights_instead=False, wholeblock=True,
+                      init=1., fin=0., guesses_log10D=None, 
+                      vary_initials=False, 
+                      vary_diffusivities=[True, True, True],
+                      wb_or_3Dnpi='wb', processes=1, seed=None,
+                      percentiles=(2.5, 16., 50., 84., 97.5)):
+        """Monte Carlo uncertainty for fitD with the separable erf models. 
+
+        Refits N copies of the data with normal errors in the positions 
+        (sigma_x_microns), the three lengths, and the y data using
+        diffusion.fit_diffusion3D_ensemble, over a pool of processes if 
+        processes is more than 1 (None for one per core). By default the length 
+        errors come from the sample thickness measurements and the y errors 
+        from the spread of 3 baselines under each spectrum as a fraction of 
+        each area (see Profile.ensemble_errors). Nothing is plotted.
+        On Windows, call this from under if __name__ == '__main__':
+
+        Returns the dictionary from fit_diffusion3D_ensemble.
+        """
+        if wb_or_3Dnpi == 'wb' and self.raypaths is None:
+            self.setupWB()
+
+        xy = self.xy_picker(peak_idx, wholeblock, heights_instead, 
+                            centered=True)
+        if xy is False:
+            return
+        x, y = xy
+
+        if sigma_lengths_microns is None:
+            sigma_lengths_microns = [0., 0., 0.]
+            if self.sample is not None:
+                sigma_lengths_microns = self.sample.get_thickness_errors()
+
+        if sigma_y is None:
+            sigma_y = []
+            for prof in self.profiles:
+                sigma_y.append(prof.ensemble_errors(peak_idx, heights_instead,
+                                                    0., None)[1])
+
+        results = diffusion.fit_diffusion3D_ensemble(x, y, self.lengths, 
+                                self.time_seconds, self.raypaths, N=N,
+                                sigma_x_microns=sigma_x_microns,
+                                sigma_lengths_microns=sigma_lengths_microns,
+                                sigma_y=sigma_y, relative_y=True, 
+                                guesses_log10D=guesses_log10D, init=init,
+                                fin=fin, vary_initials=vary_initials,
+                                vary_diffusivities=vary_diffusivities,
+                                wb_or_3Dnpi=wb_or_3Dnpi, 
+                                percentiles=percentiles, processes=processes,
+                                seed=seed)
+        if results is None:
+            return
+
+        print 'converged', np.sum(results['converged']), 'of', N
+        for k, p in enumerate(results['percentiles']):
+            print '{:5.1f}'.format(p), 'percentile log10D m2/s',
+            print ', '.join(['{:.2f}'.format(D) for D in 
+                             results['log10D3_percentiles'][k]])
+        return results
+
+    def sampleD(self, peak_idx=None, heights_instead=False, wholeblock=True,
+                walkers=32, steps=2000, burn=None, bounds=None, start=None,
+                sigma_y=None, vary_initial=False, init=1., fin=0., 
+                wb_or_3Dnpi='wb', processes=1, checkpoint=None, 
+                checkpoint_every=100, seed=None,
+                percentiles=(2.5, 16., 50., 84., 97.5)):
+        """Samples the posterior distributions of the three diffusivities
+        with diffusion.sample_diffusion3D, an affine-invariant ensemble 
+        MCMC sampler, using the same data as fitD. Priors are uniform 
+        within bounds, a dictionary of (low, high) by parameter name. 
+        Pass a checkpoint file name to save the chains as they go and to
+        resume an interrupted run. Nothing is plotted.
+        
+        The results are saved as the attribute posterior and returned:
+        a dictionary with names, chain, log_probability, 
+        acceptance_fraction, burn, percentiles, and posterior_percentiles.
+        """
+        if wb_or_3Dnpi == 'wb' and self.raypaths is None:
+            self.setupWB()
+        if wb_or_3Dnpi == 'wb':
+            raypaths = self.raypaths
+        else:
+            raypaths = None
+
+        xy = self.xy_picker(peak_idx, wholeblock, heights_instead, 
+                            centered=True)
+        if xy is False:
+            return
+        x, y = xy
+
+        results = diffusion.sample_diffusion3D(x, y, self.lengths,
+                                self.time_seconds, raypaths, start=start,
+                                walkers=walkers, steps=steps, burn=burn,
+                                bounds=bounds, sigma_y=sigma_y,
+                                vary_initial=vary_initial, init=init, fin=fin,
+                                processes=processes, checkpoint=checkpoint,
+                                checkpoint_every=checkpoint_every, seed=seed,
+                                percentiles=percentiles)
+        if results is None:
+            return
+        self.posterior = results
+
+        print 'mean acceptance fraction', '{:.2f}'.format(
+              np.mean(results['acceptance_fraction']))
+        for k, p in enumerate(results['percentiles']):
+            print '{:5.1f}'.format(p), 'percentile',
+            print ', '.join([''.join((name, ' ', '{:.2f}'.format(value))) 
+                             for name, value in zip(results['names'], 
+                                     results['posterior_percentiles'][k])])
+        return results
+
     def invert(self, grid_xyz, symmetry_constraint=True, 
                smoothness_constraint=True, rim_constraint=True, 
                rim_value=None, weighting_factor_lambda=0.2, 
-               show_residuals_plot=True):
+               show_residuals_plot=True, peak_idx=None, 
+               heights_instead=False, solver='lsmr'):
         """Takes a list of three whole-block concentration profiles (either A/Ao 
         or water ok but must be consistent for all three) in three orthogonal 
         directions and list of three integers to indicate number of divisions
         in each direction. Returns matrix of values in each grid cell. 
         Default plot showing residuals for how well results match the whole-block
-        observations."""
-        pass
+        observations.
+        Also returns the residuals (model - data) for each profile.
+        The grid is solved as a sparse least-squares problem, so it handles
+        grids of about 100 x 100 x 100 cells."""
+        if self.initial_profiles is None:
+            self.setupWB()
+        xy = self.xy_picker(peak_idx=peak_idx, wholeblock=True,
+                            heights_instead=heights_instead, centered=False)
+        if xy is False:
+            return
+        positions, y = xy
+        
+        result = wholeblock.invert_wholeblock(grid_xyz, self.lengths, 
+                        positions, y, self.directions, self.raypaths,
+                        symmetry_constraint=symmetry_constraint,
+                        smoothness_constraint=smoothness_constraint,
+                        rim_constraint=rim_constraint, rim_value=rim_value,
+                        weighting_factor_lambda=weighting_factor_lambda,
+                        solver=solver)
+        if result is None:
+            return
+        cells, residuals = result
+
+        if show_residuals_plot is True:
+            wholeblock.plot_inversion_residuals(positions, residuals, 
+                                                self.lengths)
+        return cells, residuals
 
 def make_line_style(direction, style_marker):
     """Take direction and marker style and return line style dictionary
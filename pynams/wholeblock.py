@@ -15,11 +15,14 @@ MIT license
 """
 import numpy as np
 import scipy
+import scipy.sparse
+import scipy.sparse.linalg
 import matplotlib.pyplot as plt
 import uncertainties
 from uncertainties import ufloat
 from mpl_toolkits.axes_grid1.parasite_axes import SubplotHost
 import lmfit
+import diffusion
 
 # - plotting profiles in three panels
 # - Generating whole-block area and water profiles
@@ -365,14 +368,8 @@ def diffusion_1D(params, data_x_microns=None, data_y_unit_areas=None,
         x = np.linspace(-a_meters, a_meters, points)
     
     if erf_or_sum == 'infsum':
-        xsum = np.zeros_like(x)
-        for n in range(infinity):
-            xadd =  ((((-1.)**n) / ((2.*n)+1.))    + 
-                    (np.exp((-D * (((2.*n)+1.)**2.) * (np.pi**2.) * t) / 
-                        (L_meters**2.)))    + 
-                    (np.cos(((2.*n)+1.) * np.pi * x / L_meters)))
-            xsum = xsum + xadd        
-        model = xsum * 4. / np.pi        
+        model, error = diffusion.infsum_unit_profile(x, a_meters, D, t, 
+                                                     infinity=infinity)
 
     elif erf_or_sum == 'erf':
         sqrtDt = (D*t)**0.5
@@ -488,11 +485,7 @@ def diffusion_3D(params, data_x_microns=None, data_y_unit_areas=None,
         yprofiles.append(y)
                                       
     # Then multiply them together to get a 3D matrix
-    v = np.ones((points, points, points))
-    for d in range(0, points):
-        for e in range(0, points):
-            for f in range(0, points):
-                v[d][e][f] = yprofiles[0][d]*yprofiles[1][e]*yprofiles[2][f]
+    v = np.einsum('i,j,k->ijk', yprofiles[0], yprofiles[1], yprofiles[2])
 
     mid = points/2        
     aslice = v[:, mid][:, mid]
@@ -657,7 +650,215 @@ def diffusion_3DWB(params, data_x_microns=None, data_y_unit_areas=None,
         return residuals
 
 
-                
+#%% Whole-block inversion for internal concentrations
+#
+#
+# The block is divided into a grid of cells, and each whole-block
+# measurement is the average of the cells it passes through along its
+# ray path. With far more cells than measurements, the problem is only
+# solvable with extra constraints (rim value, mirror symmetry, smoothness),
+# which are stacked below the data as weighted sparse operator rows and
+# solved together with an iterative least-squares solver.
+#
+#
+def inversion_data_operator(grid_xyz, lengths_microns, positions_microns,
+                            directions, raypaths):
+    """Takes the number of cells in each direction, the block lengths,
+    and the whole-block measurement positions (starting at 0) for the
+    three profiles. Returns a sparse matrix with one row per measurement
+    that averages the grid cells along that measurement's ray path
+    through the middle of the block."""
+    grid_xyz = [int(n) for n in grid_xyz]
+    rows = []
+    cols = []
+    vals = []
+    row = 0
+    for k in range(3):
+        if raypaths[k] not in directions or raypaths[k] == directions[k]:
+            print 'ray path', raypaths[k], 'does not fit directions', directions
+            return
+        r = directions.index(raypaths[k])
+        t = 3 - k - r
+
+        # the measurement goes through the middle of the third direction,
+        # which is between two cells for an even number of divisions
+        if grid_xyz[t] % 2 == 1:
+            tcells = [grid_xyz[t] // 2]
+        else:
+            tcells = [grid_xyz[t] // 2 - 1, grid_xyz[t] // 2]
+        weight = 1. / (grid_xyz[r] * len(tcells))
+
+        x = np.array(positions_microns[k], dtype=float)
+        icells = np.floor(x * grid_xyz[k] / lengths_microns[k]).astype(int)
+        icells = np.clip(icells, 0, grid_xyz[k] - 1)
+
+        rcells, tcells = np.meshgrid(np.arange(grid_xyz[r]), tcells)
+        for i in icells:
+            idx = [None, None, None]
+            idx[k] = np.ones(rcells.size, dtype=int) * i
+            idx[r] = rcells.ravel()
+            idx[t] = tcells.ravel()
+            cells = np.ravel_multi_index(idx, grid_xyz)
+            rows.append(np.ones(cells.size, dtype=int) * row)
+            cols.append(cells)
+            vals.append(np.ones(cells.size) * weight)
+            row = row + 1
+
+    ncells = np.prod(grid_xyz)
+    G = scipy.sparse.coo_matrix((np.concatenate(vals),
+                                 (np.concatenate(rows), np.concatenate(cols))),
+                                 shape=(row, ncells))
+    return G.tocsr()
+
+def axis_operator(grid_xyz, axis, operator1D):
+    """Applies a sparse 1D operator along one axis of the cell grid"""
+    grid_xyz = [int(n) for n in grid_xyz]
+    before = scipy.sparse.identity(int(np.prod(grid_xyz[:axis])))
+    after = scipy.sparse.identity(int(np.prod(grid_xyz[axis+1:])))
+    op = scipy.sparse.kron(before, operator1D)
+    return scipy.sparse.kron(op, after).tocsr()
+
+def smoothness_operator(grid_xyz):
+    """Sparse second differences between neighboring cells in all three
+    directions"""
+    ops = []
+    for k in range(3):
+        n = int(grid_xyz[k])
+        if n < 3:
+            continue
+        D2 = scipy.sparse.diags([1., -2., 1.], [0, 1, 2], shape=(n-2, n))
+        ops.append(axis_operator(grid_xyz, k, D2))
+    if len(ops) == 0:
+        return None
+    return scipy.sparse.vstack(ops).tocsr()
+
+def symmetry_operator(grid_xyz):
+    """Sparse differences between each cell and its mirror image across
+    the center of the block in all three directions"""
+    ops = []
+    for k in range(3):
+        n = int(grid_xyz[k])
+        half = n // 2
+        if half == 0:
+            continue
+        i = np.arange(half)
+        M = scipy.sparse.coo_matrix((np.hstack((np.ones(half), -np.ones(half))),
+                                     (np.hstack((i, i)), np.hstack((i, n-1-i)))),
+                                     shape=(half, n))
+        ops.append(axis_operator(grid_xyz, k, M))
+    if len(ops) == 0:
+        return None
+    return scipy.sparse.vstack(ops).tocsr()
+
+def rim_operator(grid_xyz):
+    """Sparse selection of all cells on the outside faces of the block"""
+    grid_xyz = [int(n) for n in grid_xyz]
+    rim = np.zeros(grid_xyz, dtype=bool)
+    rim[0, :, :] = rim[-1, :, :] = True
+    rim[:, 0, :] = rim[:, -1, :] = True
+    rim[:, :, 0] = rim[:, :, -1] = True
+    cells = np.flatnonzero(rim)
+    R = scipy.sparse.coo_matrix((np.ones(cells.size),
+                                 (np.arange(cells.size), cells)),
+                                 shape=(cells.size, rim.size))
+    return R.tocsr()
+
+def invert_wholeblock(grid_xyz, lengths_microns, positions_microns,
+                      wb_values, directions, raypaths,
+                      symmetry_constraint=True, smoothness_constraint=True,
+                      rim_constraint=True, rim_value=None,
+                      weighting_factor_lambda=0.2, solver='lsmr',
+                      tolerance=1e-8, max_iterations=None):
+    """Takes list of three integers for the number of cells in each
+    direction, the block lengths, and the positions (starting at 0) and
+    values of the three whole-block profiles. Returns the values in each
+    grid cell as a 3D array and the residuals (model - data) for each
+    profile.
+
+    The constraint rows are multiplied by weighting_factor_lambda.
+    The rim value defaults to 0, the final value for complete loss.
+    Measurements that are nan are left out.
+    """
+    grid_xyz = [int(n) for n in grid_xyz]
+    x = []
+    y = []
+    goods = []
+    for k in range(3):
+        xk = np.array(positions_microns[k], dtype=float)
+        yk = np.array(wb_values[k], dtype=float)
+        good = np.isfinite(yk)
+        x.append(xk[good])
+        y.append(yk[good])
+        goods.append(good)
+
+    G = inversion_data_operator(grid_xyz, lengths_microns, x, directions,
+                                raypaths)
+    if G is None:
+        return
+    ncells = G.shape[1]
+    A = [G]
+    b = [np.concatenate(y)]
+
+    lam = weighting_factor_lambda
+    if smoothness_constraint is True:
+        S = smoothness_operator(grid_xyz)
+        if S is not None:
+            A.append(lam * S)
+            b.append(np.zeros(S.shape[0]))
+    if symmetry_constraint is True:
+        M = symmetry_operator(grid_xyz)
+        if M is not None:
+            A.append(lam * M)
+            b.append(np.zeros(M.shape[0]))
+    if rim_constraint is True:
+        if rim_value is None:
+            rim_value = 0.
+        R = rim_operator(grid_xyz)
+        A.append(lam * R)
+        b.append(np.ones(R.shape[0]) * rim_value)
+
+    A = scipy.sparse.vstack(A).tocsr()
+    b = np.concatenate(b)
+
+    if solver == 'lsmr':
+        solution = scipy.sparse.linalg.lsmr(A, b, atol=tolerance,
+                                            btol=tolerance,
+                                            maxiter=max_iterations)
+    elif solver == 'lsqr':
+        solution = scipy.sparse.linalg.lsqr(A, b, atol=tolerance,
+                                            btol=tolerance,
+                                            iter_lim=max_iterations)
+    else:
+        print 'solver must be lsmr or lsqr'
+        return
+    cells = solution[0]
+
+    model = G.dot(cells)
+    residuals = []
+    start = 0
+    for k in range(3):
+        res = np.ones(len(goods[k])) * np.nan
+        res[goods[k]] = model[start:start+len(y[k])] - y[k]
+        residuals.append(res)
+        start = start + len(y[k])
+    return cells.reshape(grid_xyz), residuals
+
+def plot_inversion_residuals(positions_microns, residuals, lengths_microns,
+                             fig_ax3=None):
+    """Plot whole-block inversion residuals (model - data) on three panels
+    with centered positions"""
+    if fig_ax3 is None:
+        fig, fig_ax3 = plt.subplots(nrows=1, ncols=3)
+    for k in range(3):
+        a = lengths_microns[k] / 2.
+        fig_ax3[k].plot(np.array(positions_microns[k]) - a, residuals[k], 'o')
+        fig_ax3[k].plot([-a, a], [0., 0.], '-k')
+        fig_ax3[k].set_xlim(-a, a)
+    fig_ax3[0].set_ylabel('residual (model - data)')
+    fig_ax3[1].set_xlabel('position ($\mu$m)')
+    return fig_ax3
+
+
 #%% Group profiles together as whole-block unit
 class WholeBlock():
     profiles = []
@@ -1116,11 +1317,43 @@ class WholeBlock():
     def invert(self, grid_xyz, symmetry_constraint=True, 
                smoothness_constraint=True, rim_constraint=True, 
                rim_value=None, weighting_factor_lambda=0.2, 
-               show_residuals_plot=True):
+               show_residuals_plot=True, peak_idx=None, peakwn=None,
+               solver='lsmr'):
         """Takes a list of three whole-block concentration profiles (either A/Ao 
         or water ok but must be consistent for all three) in three orthogonal 
         directions and list of three integers to indicate number of divisions
         in each direction. Returns matrix of values in each grid cell. 
         Default plot showing residuals for how well results match the whole-block
-        observations."""
-        pass
+        observations.
+        Also returns the residuals (model - data) for each profile."""
+        if ((self.directions is None) or (self.raypaths is None) or
+            (self.initial_profiles is None) or (self.lengths is None)):
+                self.setupWB(make_wb_areas=False, peakfit=False)
+
+        positions = []
+        y = []
+        for prof in self.profiles:
+            positions.append(prof.positions_microns)
+            if peak_idx is None and peakwn is None:
+                if prof.wb_areas is None:
+                    make_3DWB_area_profile(prof, show_plot=False)
+                y.append(prof.wb_areas)
+            else:
+                peak_wb_areas, peakwn = prof.get_peak_wb_areas(peak_idx, 
+                                                               peakwn)
+                y.append(peak_wb_areas)
+
+        result = invert_wholeblock(grid_xyz, self.lengths, positions, y,
+                        self.directions, self.raypaths,
+                        symmetry_constraint=symmetry_constraint,
+                        smoothness_constraint=smoothness_constraint,
+                        rim_constraint=rim_constraint, rim_value=rim_value,
+                        weighting_factor_lambda=weighting_factor_lambda,
+                        solver=solver)
+        if result is None:
+            return
+        cells, residuals = result
+
+        if show_residuals_plot is True:
+            plot_inversion_residuals(positions, residuals, self.lengths)
+        return cells, residuals